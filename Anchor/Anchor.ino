@@ -15,6 +15,10 @@
 // change depending on which anchor you are programming
 #define ADDRESS 11
 #define CPIN "00000000000000000000000000000001"
+// address of the tag this anchor ranges against (see ANCHOR_SendMSG_cmd)
+#define TAG_ADDRESS 9
+// 1 to send compact binary packets instead of JSON (see Client/wire_format.py)
+#define BINARY_PACKETS 0
 
 HardwareSerial uwbSerial(2);
 
@@ -34,6 +38,24 @@ String ANCHOR_SendMSG_cmd = "AT+ANCHOR_SEND=9,4,TEST\r\n";
 unsigned long sendInterval = 1000;
 unsigned long previousTime = 0;
 
+// Ranging counter sent with binary packets
+uint16_t sequenceNumber = 0;
+
+// Binary packet layout, little-endian (matches Client/wire_format.py)
+struct __attribute__((packed)) BinaryHeader {
+  char magic[2];     // "UW"
+  uint8_t version;   // 1
+  uint8_t count;     // number of readings that follow
+};
+
+struct __attribute__((packed)) BinaryReading {
+  uint16_t anchor;     // UWB address of this anchor
+  uint16_t tag;        // UWB address of the tag
+  uint16_t distance;   // distance in cm
+  uint16_t sequence;   // ranging counter
+  uint32_t timestamp;  // millis() when the distance was received
+};
+
 void setup() {
   // Serial for debugging
   Serial.begin(115200);
@@ -121,7 +143,11 @@ void checkSerial() {
     Serial.println(distance);
 
     // Send the distance value via UDP
-    sendDistanceUDP(distance);
+    if (BINARY_PACKETS) {
+      sendDistanceBinaryUDP(distance);
+    } else {
+      sendDistanceUDP(distance);
+    }
   }
 }
 
@@ -147,6 +173,22 @@ void sendDistanceUDP(String distance) {
   Serial.println("Device Address: " + String(ADDRESS));
 }
 
+// Function to send distance over UDP as a binary packet
+void sendDistanceBinaryUDP(String distance) {
+  uint8_t buffer[sizeof(BinaryHeader) + sizeof(BinaryReading)];
+  BinaryHeader header = {{'U', 'W'}, 1, 1};
+  BinaryReading reading = {ADDRESS, TAG_ADDRESS, (uint16_t)distance.toInt(), sequenceNumber++, (uint32_t)millis()};
+  memcpy(buffer, &header, sizeof(header));
+  memcpy(buffer + sizeof(header), &reading, sizeof(reading));
+
+  // Send binary data via UDP
+  udp.beginPacket(host, port);
+  udp.write(buffer, sizeof(buffer));
+  udp.endPacket();
+
+  Serial.println("Distance sent over UDP (binary): " + distance);
+}
+
 // Function to configure the UWB device
 void configureUWBDevice() {
   Serial.println("Configuring UWB Device...");
@@ -0,0 +1,177 @@
+import numpy as np
+
+# Seconds an anchor may stay silent before it is marked degraded
+DEFAULT_TIMEOUT = 5.0
+
+# An anchor polling slower than DEFAULT_TIMEOUT is only degraded after missing
+# this many of its own report intervals
+TIMEOUT_INTERVALS = 3
+
+# Weight of the newest batch in the smoothed statistics
+SMOOTHING = 0.1
+
+# Fields of AnchorHealth.status
+STATUS_DTYPE = np.dtype([
+    ("address", "<i8"),
+    ("healthy", "?"),
+    ("age", "<f8"),
+    ("readings", "<i8"),
+    ("reading_rate", "<f8"),
+    ("interval", "<f8"),
+    ("jitter", "<f8"),
+    ("range_variance", "<f8"),
+    ("degradations", "<i8"),
+])
+
+
+class AnchorHealth:
+    """
+    Liveness and signal statistics of every anchor.
+
+    A batch of readings updates each anchor that reported in it once: last
+    seen time, reading count, smoothed interval between reports and its
+    standard deviation (jitter), smoothed reading rate, and the variance of the
+    ranges (half the mean squared change between consecutive readings of the
+    same tag, which is the range noise while tags stand still). All of it lives
+    in (N,) arrays, so the cost per reading is constant and querying is free.
+
+    An anchor is degraded once it has been silent for longer than the timeout
+    (or TIMEOUT_INTERVALS of its own report intervals, if that is longer) and
+    healthy again with its next reading. Solvers leave degraded anchors out, so
+    their last distances don't keep producing fixes.
+    """
+
+    def __init__(self, anchor_addresses, timeout=DEFAULT_TIMEOUT):
+        """
+        Args:
+            anchor_addresses: UWB addresses of the anchors, in table order
+            timeout: Seconds of silence after which an anchor is degraded
+        """
+        self.anchor_addresses = np.asarray(anchor_addresses, dtype=np.int64)
+        num_anchors = len(self.anchor_addresses)
+        self.num_anchors = num_anchors
+        self.timeout = timeout
+
+        self.last_seen = np.full(num_anchors, np.nan)
+        self.readings = np.zeros(num_anchors, dtype=np.int64)
+        self.interval_mean = np.full(num_anchors, np.nan)
+        self.interval_var = np.zeros(num_anchors)
+        self.reading_rate = np.full(num_anchors, np.nan)
+        self.range_variance = np.full(num_anchors, np.nan)
+
+        # Time of the first reading of any anchor. Anchors that never reported
+        # are degraded once they have been silent that long after it.
+        self.started = np.nan
+        self.degraded = np.zeros(num_anchors, dtype=bool)
+        self.degradations = np.zeros(num_anchors, dtype=np.int64)
+        self._reported = self.degraded.copy()
+
+    def observe(self, anchor_indices, timestamps, distances=None, previous_distances=None):
+        """
+        Record a batch of readings.
+
+        Args:
+            anchor_indices: Anchor columns of the readings
+            timestamps: Receive times in seconds (array or scalar)
+            distances: Optional distances in cm, for the range variance
+            previous_distances: Last distances of the same (tag, anchor)
+                streams before this batch, NaN where there is none
+        """
+        anchor_indices = np.asarray(anchor_indices, dtype=np.int64)
+        if not len(anchor_indices):
+            return
+        timestamps = np.broadcast_to(np.asarray(timestamps, dtype=float), anchor_indices.shape)
+        n = self.num_anchors
+
+        counts = np.bincount(anchor_indices, minlength=n)
+        latest = np.full(n, -np.inf)
+        np.maximum.at(latest, anchor_indices, timestamps)
+        seen = counts > 0
+        if np.isnan(self.started):
+            self.started = float(timestamps.min())
+
+        # A burst holds every packet of a round, so one report per anchor and
+        # batch. The silence of a degraded anchor is an outage, not an interval.
+        interval = latest - self.last_seen
+        timed = seen & (interval > 0) & ~self.degraded
+        deviation = np.where(timed & ~np.isnan(self.interval_mean), interval - self.interval_mean, 0.0)
+        self.interval_var[timed] = (1 - SMOOTHING) * self.interval_var[timed] + SMOOTHING * deviation[timed]**2
+        self._smooth(self.interval_mean, timed, interval)
+        self._smooth(self.reading_rate, timed, np.divide(counts, interval, out=np.zeros(n), where=timed))
+
+        if distances is not None and previous_distances is not None:
+            changes = np.asarray(distances, dtype=float) - np.asarray(previous_distances, dtype=float)
+            paired = ~np.isnan(changes)
+            pairs = np.bincount(anchor_indices[paired], minlength=n)
+            squares = np.bincount(anchor_indices[paired], weights=changes[paired]**2, minlength=n)
+            self._smooth(self.range_variance, pairs > 0,
+                         np.divide(squares, 2 * pairs, out=np.zeros(n), where=pairs > 0))
+
+        self.last_seen[seen] = np.fmax(self.last_seen[seen], latest[seen])
+        self.readings += counts
+        # Any reading brings an anchor back
+        self.degraded[seen] = False
+
+    @staticmethod
+    def _smooth(values, mask, samples):
+        values[mask] = np.where(np.isnan(values[mask]), samples[mask],
+                                values[mask] + SMOOTHING * (samples[mask] - values[mask]))
+
+    def timeouts(self):
+        """
+        Returns:
+            Seconds of silence after which each anchor is degraded
+        """
+        return np.fmax(self.timeout, TIMEOUT_INTERVALS * self.interval_mean)
+
+    def check(self, now):
+        """
+        Mark the anchors that went silent as degraded.
+
+        Returns:
+            Tuple (degraded, recovered) with the anchor columns whose state
+            changed since the last check
+        """
+        last_heard = np.where(np.isnan(self.last_seen), self.started, self.last_seen)
+        self.degraded |= now - last_heard > self.timeouts()
+        changed = self.degraded != self._reported
+        degraded = np.flatnonzero(changed & self.degraded)
+        recovered = np.flatnonzero(changed & ~self.degraded)
+        self.degradations[degraded] += 1
+        self._reported = self.degraded.copy()
+        return degraded, recovered
+
+    def healthy(self):
+        """
+        Returns:
+            Boolean mask of the anchors solvers may use
+        """
+        return ~self.degraded
+
+    def status(self, now):
+        """
+        Returns:
+            Structured array (N,) of STATUS_DTYPE with the health of every anchor
+        """
+        status = np.empty(self.num_anchors, dtype=STATUS_DTYPE)
+        status["address"] = self.anchor_addresses
+        status["healthy"] = ~self.degraded
+        status["age"] = now - self.last_seen
+        status["readings"] = self.readings
+        status["reading_rate"] = self.reading_rate
+        status["interval"] = self.interval_mean
+        status["jitter"] = np.sqrt(self.interval_var)
+        status["range_variance"] = self.range_variance
+        status["degradations"] = self.degradations
+        return status
+
+    def describe(self, anchor, now):
+        """
+        Returns:
+            One line summary of an anchor's health
+        """
+        s = self.status(now)[anchor]
+        state = "healthy" if s["healthy"] else "degraded"
+        return (f"Anchor {s['address']} {state}: last seen {s['age']:.1f} s ago, "
+                f"{s['reading_rate']:.1f} readings/s, interval {1000 * s['interval']:.0f} "
+                f"+/- {1000 * s['jitter']:.0f} ms, range std {np.sqrt(s['range_variance']):.1f} cm")
@@ -0,0 +1,251 @@
+import argparse
+import json
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+from gdop import evaluate_gdop
+from multilateration import DEFAULT_TAG_HEIGHT
+from zones import DEFAULT_ZONES_PATH, load_zones
+
+# Spacing in cm of the points the coverage is evaluated at
+DEFAULT_COVERAGE_SPACING = 25.0
+
+# Spacing in cm of the positions anchors may be mounted at
+DEFAULT_SITE_SPACING = 50.0
+
+# Mounting height of the anchors in cm
+DEFAULT_ANCHOR_HEIGHT = 80.0
+
+# Search budget: independent searches (spread over the process pool), rounds
+# per search and candidate layouts evaluated together per round
+DEFAULT_RESTARTS = 16
+DEFAULT_ROUNDS = 200
+DEFAULT_BATCH = 128
+
+# Cost of a layout is worst_weight * worst-case GDOP + mean GDOP
+DEFAULT_WORST_WEIGHT = 1.0
+
+# Worst-case GDOP counted for layouts that leave part of the floor without a fix
+UNCOVERED_GDOP = 1e6
+
+# Anchor config written by this tool and read by load_anchor_config
+CONFIG_VERSION = 1
+
+
+def floor_points(zone_map, spacing):
+    """
+    Grid points inside the zones (the rooms drawn by ui_test.py), e.g. the
+    points coverage is evaluated at or the candidate anchor sites.
+
+    Returns:
+        Array (P, 2) of points in cm
+    """
+    low = zone_map.bounds_min.min(axis=0)
+    high = zone_map.bounds_max.max(axis=0)
+    xs = np.arange(low[0] + spacing / 2, high[0], spacing)
+    ys = np.arange(low[1] + spacing / 2, high[1], spacing)
+    grid = np.stack(np.meshgrid(xs, ys), axis=-1).reshape(-1, 2)
+    inside, _ = zone_map.classify(grid)
+    return grid[np.unique(inside)]
+
+
+def layout_cost(gdop, worst_weight=DEFAULT_WORST_WEIGHT):
+    """
+    Args:
+        gdop: Array (..., P) of GDOP values over the coverage points
+
+    Returns:
+        Tuple (cost, worst, mean) of arrays (...)
+    """
+    worst = np.minimum(gdop.max(axis=-1), UNCOVERED_GDOP)
+    mean = np.minimum(gdop, UNCOVERED_GDOP).mean(axis=-1)
+    return worst_weight * worst + mean, worst, mean
+
+
+def search_layout(task):
+    """
+    One randomized local search, run in a pool process.
+
+    Every round moves one anchor of the current layout in each of `batch`
+    candidates, either to a random site or to the site nearest a random
+    offset from where it is, with offsets shrinking as the search goes on.
+    All candidates are evaluated in one vectorized GDOP call and the best is
+    kept if it lowers the cost.
+
+    Args:
+        task: Dict with sites (S, 3), site_spacing, points (P, 3),
+            num_anchors, rounds, batch, worst_weight, dims and seed
+
+    Returns:
+        Tuple (cost, site indices of the best layout)
+    """
+    sites, points = task["sites"], task["points"]
+    num_anchors, batch = task["num_anchors"], task["batch"]
+    rng = np.random.default_rng(task["seed"])
+    span = float(np.ptp(sites[:, :2], axis=0).max())
+
+    def cost(layouts):
+        return layout_cost(evaluate_gdop(sites[layouts], points, task["dims"]), task["worst_weight"])[0]
+
+    current = rng.choice(len(sites), num_anchors, replace=False)
+    current_cost = float(cost(current[None])[0])
+    for step in range(task["rounds"]):
+        radius = span * (1 - step / task["rounds"]) / 2 + task["site_spacing"]
+        candidates = np.repeat(current[None], batch, axis=0)
+        moved = rng.integers(num_anchors, size=batch)
+        # A quarter of the moves jump anywhere, the rest stay near the anchor's site
+        targets = sites[current[moved], :2] + rng.normal(0, radius, (batch, 2))
+        local = np.argmin(((sites[None, :, :2] - targets[:, None]) ** 2).sum(axis=2), axis=1)
+        jump = rng.random(batch) < 0.25
+        candidates[np.arange(batch), moved] = np.where(jump, rng.integers(len(sites), size=batch), local)
+
+        costs = cost(candidates)
+        best = int(np.argmin(costs))
+        if costs[best] < current_cost:
+            current, current_cost = candidates[best], float(costs[best])
+    return current_cost, current
+
+
+def optimize_layout(sites, site_spacing, points, num_anchors, restarts=DEFAULT_RESTARTS, rounds=DEFAULT_ROUNDS,
+                    batch=DEFAULT_BATCH, worst_weight=DEFAULT_WORST_WEIGHT, dims=2, workers=None, seed=0):
+    """
+    Search anchor layouts over the candidate sites, spreading independent
+    searches over a process pool.
+
+    Args:
+        sites: Array (S, 3) of positions anchors may be mounted at in cm
+        site_spacing: Distance between neighboring sites in cm
+        points: Array (P, 3) of tag positions the GDOP is evaluated at in cm
+        num_anchors: Number of anchors to place
+        workers: Number of processes, defaults to the number of CPUs
+
+    Returns:
+        Tuple (positions, cost) of the best layout found, positions (N, 3) in cm
+    """
+    tasks = [
+        {"sites": sites, "site_spacing": site_spacing, "points": points, "num_anchors": num_anchors,
+         "rounds": rounds, "batch": batch, "worst_weight": worst_weight, "dims": dims, "seed": seed + i}
+        for i in range(restarts)
+    ]
+    workers = min(workers or os.cpu_count() or 1, restarts)
+    if workers > 1:
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.map(search_layout, tasks)
+    else:
+        results = [search_layout(task) for task in tasks]
+    cost, layout = min(results, key=lambda result: result[0])
+    # Sorted by position so the config reads in a stable order
+    positions = sites[layout]
+    return positions[np.lexsort((positions[:, 0], positions[:, 1]))], cost
+
+
+def save_anchor_config(path, addresses, positions, **stats):
+    """
+    Write an anchor config: the address and position of every anchor, plus
+    optional statistics of the layout.
+    """
+    config = {
+        "version": CONFIG_VERSION,
+        "anchors": [
+            {"address": int(address), "position": [round(float(v), 1) for v in position]}
+            for address, position in zip(addresses, positions)
+        ],
+    }
+    if stats:
+        config["coverage"] = stats
+    with open(path, "w") as f:
+        json.dump(config, f, indent=2)
+
+
+def load_anchor_config(path, addresses=None):
+    """
+    Read an anchor config written by save_anchor_config.
+
+    Args:
+        addresses: Optional anchor addresses to return the positions of, in this order
+
+    Returns:
+        Tuple (addresses, positions) with positions (N, 3) in cm
+
+    Raises:
+        ValueError: If the file isn't an anchor config or lacks one of the addresses
+    """
+    with open(path) as f:
+        config = json.load(f)
+    if config.get("version") != CONFIG_VERSION or "anchors" not in config:
+        raise ValueError(f"{path} is not an anchor config")
+    positions = {int(anchor["address"]): tuple(anchor["position"]) for anchor in config["anchors"]}
+    if addresses is None:
+        addresses = list(positions)
+    missing = [address for address in addresses if address not in positions]
+    if missing:
+        raise ValueError(f"{path} has no position for anchors {missing}")
+    return list(addresses), np.array([positions[address] for address in addresses], dtype=float)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Search anchor placements minimizing GDOP over the floor of a zone config")
+    parser.add_argument("num_anchors", type=int, help="number of anchors to place")
+    parser.add_argument("--zones", default=DEFAULT_ZONES_PATH, help="zone config whose rooms make up the floor (default: zones.json)")
+    parser.add_argument("--addresses", type=int, nargs="+",
+                        help="UWB addresses of the anchors (default: 10, 11, ... like trilateration.py)")
+    parser.add_argument("--height", type=float, default=DEFAULT_ANCHOR_HEIGHT, help="anchor mounting height in cm")
+    parser.add_argument("--tag-height", type=float, default=DEFAULT_TAG_HEIGHT, help="tag height in cm")
+    parser.add_argument("--spacing", type=float, default=DEFAULT_COVERAGE_SPACING,
+                        help="spacing in cm of the points coverage is evaluated at")
+    parser.add_argument("--site-spacing", type=float, default=DEFAULT_SITE_SPACING,
+                        help="spacing in cm of the candidate anchor positions")
+    parser.add_argument("--restarts", type=int, default=DEFAULT_RESTARTS, help="independent searches")
+    parser.add_argument("--rounds", type=int, default=DEFAULT_ROUNDS, help="rounds per search")
+    parser.add_argument("--batch", type=int, default=DEFAULT_BATCH, help="candidate layouts evaluated per round")
+    parser.add_argument("--worst-weight", type=float, default=DEFAULT_WORST_WEIGHT,
+                        help="weight of the worst-case GDOP against the mean GDOP in the cost")
+    parser.add_argument("--3d", dest="dims", action="store_const", const=3, default=2,
+                        help="minimize the 3D GDOP instead of the horizontal one")
+    parser.add_argument("--workers", type=int, help="search processes (default: number of CPUs)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("-o", "--output", default="anchors.json", help="anchor config to write")
+    args = parser.parse_args()
+
+    addresses = args.addresses or list(range(10, 10 + args.num_anchors))
+    if len(addresses) != args.num_anchors:
+        parser.error(f"--addresses lists {len(addresses)} anchors, expected {args.num_anchors}")
+
+    zone_map = load_zones(args.zones)
+    points = floor_points(zone_map, args.spacing)
+    sites = floor_points(zone_map, args.site_spacing)
+    points = np.column_stack([points, np.full(len(points), args.tag_height)])
+    sites = np.column_stack([sites, np.full(len(sites), args.height)])
+    print(f"Placing {args.num_anchors} anchors at {len(sites)} candidate sites, "
+          f"evaluating {len(points)} points of {zone_map.num_zones} zones")
+
+    start = time.perf_counter()
+    positions, _ = optimize_layout(
+        sites, args.site_spacing, points, args.num_anchors, args.restarts, args.rounds, args.batch, args.worst_weight,
+        args.dims, args.workers, args.seed,
+    )
+    elapsed = time.perf_counter() - start
+
+    gdop = evaluate_gdop(positions, points, args.dims)
+    _, worst, mean = layout_cost(gdop)
+    covered = np.isfinite(gdop)
+    stats = {
+        "gdop_max": round(float(worst), 3),
+        "gdop_mean": round(float(mean), 3),
+        "gdop_p95": round(float(np.percentile(np.minimum(gdop, UNCOVERED_GDOP), 95)), 3),
+        "covered": round(float(covered.mean()), 4),
+    }
+    save_anchor_config(args.output, addresses, positions, **stats)
+
+    print(f"Searched {args.restarts * args.rounds * args.batch} layouts in {elapsed:.1f} s, wrote {args.output}")
+    for address, (x, y, z) in zip(addresses, positions):
+        print(f"  Anchor {address}: ({x:.0f}, {y:.0f}, {z:.0f})")
+    print(f"GDOP: max {stats['gdop_max']:.2f}, mean {stats['gdop_mean']:.2f}, p95 {stats['gdop_p95']:.2f}, "
+          f"{100 * stats['covered']:.1f}% of the floor covered")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,365 @@
+import argparse
+import asyncio
+import json
+import time
+
+import numpy as np
+
+from calibration import CALIBRATION_DATA_PATH, marker_statistics
+from measurement_table import DEFAULT_TAG_ADDRESS
+from wire_format import MAX_READINGS_PER_PACKET, encode_readings
+
+# Polling period the anchors start with, and the range the firmware accepts
+DEFAULT_POLLING_PERIOD_MS = 1000
+MIN_POLLING_PERIOD_MS = 10
+MAX_POLLING_PERIOD_MS = 60000
+
+# Floor extent (x_min, x_max, y_min, y_max) in cm used for anchors and tags
+DEFAULT_BOUNDS = (0, 660, 0, 600)
+ANCHOR_HEIGHT = 90
+
+
+def load_noise_profile(path=CALIBRATION_DATA_PATH):
+    """
+    Derive the range error of the UWB modules from the collected measurements.
+
+    Returns:
+        Tuple (true_distances, biases, spreads, outlier_rate): arrays of true
+        distance in cm with the mean error and standard deviation in cm at each,
+        plus the fraction of readings that are gross outliers
+    """
+    data = np.genfromtxt(path, delimiter=",", skip_header=1)
+    markers = data[:, 0] * 100
+    measured = data[:, 1]
+
+    # The same per-marker statistics the calibration model is fitted from
+    true_distances, mean_measured, inliers = marker_statistics(markers, measured)
+    groups = np.searchsorted(true_distances, markers)
+    kept = np.maximum(np.bincount(groups, weights=inliers, minlength=len(true_distances)), 1)
+    squares = np.bincount(groups, weights=np.where(inliers, (measured - mean_measured[groups])**2, 0.0),
+                          minlength=len(true_distances))
+    biases = mean_measured - true_distances
+    return true_distances, biases, np.sqrt(squares / kept), np.count_nonzero(~inliers) / len(measured)
+
+
+class NoiseModel:
+    """
+    Turns true distances into readings with the measured bias, spread and outliers.
+    """
+
+    def __init__(self, profile=None, seed=None):
+        self.true_distances, self.biases, self.spreads, self.outlier_rate = profile or load_noise_profile()
+        self.rng = np.random.default_rng(seed)
+
+    def measure(self, distances):
+        """
+        Args:
+            distances: Array of true distances in cm
+
+        Returns:
+            Array of simulated readings in whole cm
+        """
+        bias = np.interp(distances, self.true_distances, self.biases)
+        spread = np.interp(distances, self.true_distances, self.spreads)
+        readings = distances + bias + self.rng.normal(size=np.shape(distances)) * spread
+
+        # Gross errors look like a digit too many, as in the collected data
+        outliers = self.rng.random(np.shape(distances)) < self.outlier_rate
+        readings = np.where(outliers, readings * 10, readings)
+        return np.clip(np.rint(readings), 0, 65535)
+
+
+class TagFleet:
+    """
+    Configurable trajectories for many simulated tags.
+
+    Motions:
+        static: every tag stays at a random point
+        circle: every tag walks a circle around a random center
+        waypoint: every tag walks between random waypoints
+    """
+
+    MOTIONS = ("static", "circle", "waypoint")
+
+    def __init__(self, num_tags, motion="circle", speed=100.0, bounds=DEFAULT_BOUNDS, height=100.0, seed=None):
+        """
+        Args:
+            num_tags: Number of tags
+            motion: One of MOTIONS
+            speed: Walking speed in cm/s
+            bounds: Floor extent (x_min, x_max, y_min, y_max) in cm
+            height: Height the tags are carried at in cm
+            seed: Random seed
+        """
+        if motion not in self.MOTIONS:
+            raise ValueError(f"Unknown motion {motion!r}, expected one of {self.MOTIONS}")
+        self.num_tags = num_tags
+        self.motion = motion
+        self.speed = speed
+        self.bounds = bounds
+        self.height = height
+        self.addresses = (DEFAULT_TAG_ADDRESS + np.arange(num_tags)) % 65536
+        self.rng = np.random.default_rng(seed)
+
+        x_min, x_max, y_min, y_max = bounds
+        self.low = np.array([x_min, y_min], dtype=float)
+        self.high = np.array([x_max, y_max], dtype=float)
+        self.origin = self._random_points(num_tags)
+        self.radius = self.rng.uniform(0.05, 0.25, num_tags) * (self.high - self.low).min()
+        self.phase = self.rng.uniform(0, 2 * np.pi, num_tags)
+        self.target = self._random_points(num_tags)
+        self.current = self.origin.copy()
+        self.last_time = None
+
+    def _random_points(self, count):
+        return self.rng.uniform(self.low, self.high, (count, 2))
+
+    def positions(self, t):
+        """
+        Args:
+            t: Time in seconds
+
+        Returns:
+            Array of shape (num_tags, 3) with the tag positions in cm
+        """
+        if self.motion == "static":
+            xy = self.origin
+        elif self.motion == "circle":
+            angle = self.phase + self.speed * t / np.maximum(self.radius, 1.0)
+            xy = self.origin + self.radius[:, None] * np.column_stack((np.cos(angle), np.sin(angle)))
+            xy = np.clip(xy, self.low, self.high)
+        else:
+            dt = 0.0 if self.last_time is None else max(t - self.last_time, 0.0)
+            self.last_time = t
+            offset = self.target - self.current
+            remaining = np.linalg.norm(offset, axis=1)
+            step = np.minimum(self.speed * dt, remaining)
+            self.current += offset * (step / np.maximum(remaining, 1e-9))[:, None]
+            arrived = remaining - step < 1.0
+            self.target[arrived] = self._random_points(np.count_nonzero(arrived))
+            xy = self.current
+
+        return np.column_stack((xy, np.full(self.num_tags, self.height)))
+
+
+def default_anchor_layout(num_anchors, bounds=DEFAULT_BOUNDS, height=ANCHOR_HEIGHT):
+    """
+    Spread anchors evenly around the edge of the floor.
+
+    Returns:
+        Array of shape (num_anchors, 3) with anchor positions in cm
+    """
+    x_min, x_max, y_min, y_max = bounds
+    width, depth = x_max - x_min, y_max - y_min
+    perimeter = 2 * (width + depth)
+    s = (np.arange(num_anchors) + 0.5) * perimeter / num_anchors
+
+    positions = np.empty((num_anchors, 3))
+    for i, along in enumerate(s):
+        if along < width:
+            positions[i, :2] = (x_min + along, y_min)
+        elif along < width + depth:
+            positions[i, :2] = (x_max, y_min + along - width)
+        elif along < 2 * width + depth:
+            positions[i, :2] = (x_max - (along - width - depth), y_max)
+        else:
+            positions[i, :2] = (x_min, y_max - (along - 2 * width - depth))
+    positions[:, 2] = height
+    return positions
+
+
+class SimulatedAnchor(asyncio.DatagramProtocol):
+    """
+    One simulated anchor: ranges every tag once per polling period and sends
+    the readings to the client, and obeys polling_period messages like Anchor.ino.
+    """
+
+    def __init__(self, address, position, fleet, noise, client_addr, binary=False, start_time=0.0):
+        self.address = address
+        self.position = np.asarray(position, dtype=float)
+        self.fleet = fleet
+        self.noise = noise
+        self.client_addr = client_addr
+        self.binary = binary
+        self.start_time = start_time
+        self.polling_period_ms = DEFAULT_POLLING_PERIOD_MS
+        self.sequence = 0
+        self.transport = None
+        self.packets_sent = 0
+        self.readings_sent = 0
+        self.polling_updates = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            message = json.loads(data.decode("utf-8"))
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            return
+        polling_period = message.get("polling_period") if isinstance(message, dict) else None
+        if isinstance(polling_period, int) and MIN_POLLING_PERIOD_MS <= polling_period <= MAX_POLLING_PERIOD_MS:
+            self.polling_period_ms = polling_period
+            self.polling_updates += 1
+
+    def send_round(self, now):
+        """
+        Range every tag once and send the readings.
+        """
+        tags = self.fleet.positions(now - self.start_time)
+        distances = self.noise.measure(np.linalg.norm(tags - self.position, axis=1))
+
+        if self.binary:
+            # Timestamp is the shared monotonic clock in ms so receivers can measure latency
+            timestamp = int(now * 1000) & 0xFFFFFFFF
+            for start in range(0, len(distances), MAX_READINGS_PER_PACKET):
+                end = start + MAX_READINGS_PER_PACKET
+                count = len(distances[start:end])
+                packet = encode_readings(
+                    np.full(count, self.address), self.fleet.addresses[start:end], distances[start:end],
+                    np.full(count, self.sequence), np.full(count, timestamp),
+                )
+                self.transport.sendto(packet, self.client_addr)
+                self.packets_sent += 1
+        else:
+            for tag_address, distance in zip(self.fleet.addresses, distances):
+                message = {"device_address": str(self.address), "distance": f"{distance:.0f} cm"}
+                if tag_address != DEFAULT_TAG_ADDRESS:
+                    message["tag_address"] = str(tag_address)
+                self.transport.sendto(json.dumps(message).encode("utf-8"), self.client_addr)
+                self.packets_sent += 1
+
+        self.readings_sent += len(distances)
+        self.sequence = (self.sequence + 1) & 0xFFFF
+
+    async def run(self, stop_time):
+        """
+        Send a round every polling period until stop_time (time.monotonic()).
+        """
+        # Anchors run on independent timers, so start at a random phase
+        next_round = time.monotonic() + self.noise.rng.uniform(0, self.polling_period_ms / 1000)
+        while True:
+            await asyncio.sleep(max(next_round - time.monotonic(), 0))
+            now = time.monotonic()
+            if now >= stop_time:
+                break
+            self.send_round(now)
+            next_round = max(next_round + self.polling_period_ms / 1000, now)
+
+
+class AnchorFleetSimulator:
+    """
+    A set of simulated anchors, each with its own UDP socket on the loopback interface.
+    """
+
+    def __init__(
+        self,
+        client_addr,
+        num_anchors=3,
+        num_tags=1,
+        polling_period_ms=DEFAULT_POLLING_PERIOD_MS,
+        motion="circle",
+        binary=False,
+        anchor_positions=None,
+        first_anchor_address=10,
+        seed=None,
+    ):
+        """
+        Args:
+            client_addr: (ip, port) the anchors send their readings to
+            num_anchors: Number of anchors
+            num_tags: Number of tags every anchor ranges
+            polling_period_ms: Initial polling period
+            motion: Tag motion, see TagFleet
+            binary: Send binary packets instead of JSON
+            anchor_positions: Anchor coordinates, defaults to default_anchor_layout
+            first_anchor_address: UWB address of the first anchor, the rest count up
+            seed: Random seed
+        """
+        self.client_addr = client_addr
+        self.anchor_positions = (
+            default_anchor_layout(num_anchors) if anchor_positions is None
+            else np.asarray(anchor_positions, dtype=float)
+        )
+        self.anchor_addresses = list(range(first_anchor_address, first_anchor_address + num_anchors))
+        self.fleet = TagFleet(num_tags, motion, seed=seed)
+        self.noise = NoiseModel(seed=seed)
+        self.polling_period_ms = polling_period_ms
+        self.binary = binary
+        self.anchors = []
+
+    def anchor_ips(self):
+        """
+        Returns:
+            List of (ip, port) of the simulated anchors, for the client's ANCHOR_IPS
+        """
+        return [anchor.transport.get_extra_info("sockname") for anchor in self.anchors]
+
+    async def start(self):
+        """
+        Open one UDP endpoint per anchor.
+        """
+        loop = asyncio.get_running_loop()
+        start_time = time.monotonic()
+        for address, position in zip(self.anchor_addresses, self.anchor_positions):
+            anchor = SimulatedAnchor(address, position, self.fleet, self.noise, self.client_addr, self.binary, start_time)
+            anchor.polling_period_ms = self.polling_period_ms
+            await loop.create_datagram_endpoint(lambda anchor=anchor: anchor, local_addr=("127.0.0.1", 0))
+            self.anchors.append(anchor)
+
+    async def run(self, duration):
+        """
+        Run all anchors for `duration` seconds (forever if None).
+        """
+        if not self.anchors:
+            await self.start()
+        stop_time = float("inf") if duration is None else time.monotonic() + duration
+        try:
+            await asyncio.gather(*(anchor.run(stop_time) for anchor in self.anchors))
+        finally:
+            for anchor in self.anchors:
+                anchor.transport.close()
+
+    def stats(self):
+        """
+        Returns:
+            Dict with the packets and readings sent by all anchors
+        """
+        return {
+            "packets_sent": sum(anchor.packets_sent for anchor in self.anchors),
+            "readings_sent": sum(anchor.readings_sent for anchor in self.anchors),
+            "polling_updates": sum(anchor.polling_updates for anchor in self.anchors),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate a fleet of UWB anchors over UDP")
+    parser.add_argument("--client", default="127.0.0.1:50000", help="client address as ip:port (default: 127.0.0.1:50000)")
+    parser.add_argument("--anchors", type=int, default=3, help="number of anchors (default: 3)")
+    parser.add_argument("--tags", type=int, default=1, help="number of tags (default: 1)")
+    parser.add_argument("--period", type=int, default=DEFAULT_POLLING_PERIOD_MS, help="initial polling period in ms")
+    parser.add_argument("--motion", choices=TagFleet.MOTIONS, default="circle", help="tag motion (default: circle)")
+    parser.add_argument("--binary", action="store_true", help="send binary packets instead of JSON")
+    parser.add_argument("--duration", type=float, default=None, help="seconds to run (default: until interrupted)")
+    args = parser.parse_args()
+
+    ip, port = args.client.rsplit(":", 1)
+    simulator = AnchorFleetSimulator(
+        (ip, int(port)), args.anchors, args.tags, args.period, args.motion, args.binary
+    )
+
+    async def run():
+        await simulator.start()
+        for address, position, addr in zip(simulator.anchor_addresses, simulator.anchor_positions, simulator.anchor_ips()):
+            print(f"Anchor {address} at {tuple(position)} sending from {addr[0]}:{addr[1]}")
+        await simulator.run(args.duration)
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    print(f"Simulator stopped: {simulator.stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+import argparse
+import json
+import time
+
+import numpy as np
+
+import trilateration
+from anchor_placement import load_anchor_config
+from calibration import CalibrationModel
+from gdop import DEFAULT_MARGIN, GdopMap
+from packet_log import REPLAY_BATCH_SIZE, PacketLog
+from position_history import PositionHistory
+from wire_format import PACKET_MAGIC, decode_binary_records
+
+# Records indexed and decoded per chunk. Memory stays bounded by one chunk
+# of readings and fixes, however long the capture is.
+CHUNK_RECORDS = 1 << 16
+
+
+def receive_batches(recv_times):
+    """
+    Split records into the batches replay_log hands to the client: records
+    received at the same time, at most REPLAY_BATCH_SIZE of them.
+
+    Returns:
+        Index of the first record of every batch
+    """
+    positions = np.arange(len(recv_times))
+    change = np.ones(len(recv_times), dtype=bool)
+    change[1:] = recv_times[1:] != recv_times[:-1]
+    run_start = np.maximum.accumulate(np.where(change, positions, 0))
+    return np.flatnonzero(change | ((positions - run_start) % REPLAY_BATCH_SIZE == 0))
+
+
+def parse_json_record(data):
+    """
+    Parse a JSON datagram the way trilateration.process_datagrams does.
+
+    Returns:
+        Tuple (tag_address, anchor_address, distance) or None if it's rejected
+    """
+    try:
+        return trilateration.parse_reading(json.loads(bytes(data).decode("utf-8")))
+    except Exception:
+        return None
+
+
+class CaptureSolver:
+    """
+    Solves captures written with trilateration.py --record in bounded memory.
+
+    Captures are indexed and decoded a chunk of records at a time: record
+    headers are scanned without touching the payloads, and the readings of
+    all binary packets of the chunk are decoded with one gather
+    (decode_binary_records). Only JSON packets are parsed one by one.
+
+    The readings are then fed to the client's own location engine
+    (trilateration.create_engine) batch by batch, with the same batches,
+    calls and receive times as trilateration.py --replay. Only the epochs
+    are solved per chunk instead of per batch (see _solve_calls), so the
+    fixes are the same as a replay's. They can differ from the live client's,
+    whose epochs are flushed by a timer at monotonic receive times.
+
+    Epoch grouping and filtering still run once per receive batch, so with
+    many tags per batch this is only as fast as a replay.
+    """
+
+    def __init__(self, engine, output=None):
+        """
+        Args:
+            engine: LocationEngine, usually trilateration.create_engine()
+            output: Optional PositionHistory the fixes are appended to
+        """
+        self.engine = engine
+        self.output = output
+        self.records = 0
+        self.readings = 0
+        self.fixes = 0
+
+    def solve(self, path, chunk_records=CHUNK_RECORDS):
+        """
+        Solve every reading of a capture file.
+
+        Returns:
+            Receive time of the last record, or None if the capture is empty
+        """
+        log = PacketLog(path)
+        try:
+            buffer = log.buffer()
+            offset = log.start
+            # Records of the last batch of a chunk, which may continue in the next one
+            carried = (np.empty(0), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+            last_time = None
+            while offset is not None:
+                recv_times, offsets, lengths, offset = log.scan(offset, chunk_records)
+                recv_times, offsets, lengths = (
+                    np.concatenate([old, new]) for old, new in zip(carried, (recv_times, offsets, lengths))
+                )
+                if not len(recv_times):
+                    break
+                starts = receive_batches(recv_times)
+                end = len(recv_times) if offset is None else starts[-1]
+                if end == 0:
+                    carried = (recv_times, offsets, lengths)
+                    continue
+                self._solve_chunk(buffer, recv_times[:end], offsets[:end], lengths[:end], starts[starts < end])
+                carried = (recv_times[end:], offsets[end:], lengths[end:])
+                last_time = recv_times[end - 1]
+            del buffer
+        finally:
+            log.close()
+
+        if last_time is not None:
+            # Close the epochs that were still open at the end of the capture, as the replay does
+            self._collect([self._quality(self.engine.flush(last_time + 2 * self.engine.synchronizer.windows.max()))])
+        return last_time
+
+    def _solve_chunk(self, buffer, recv_times, offsets, lengths, starts):
+        """
+        Decode a chunk of records and feed it to the engine batch by batch.
+        """
+        self.records += len(recv_times)
+        binary = (lengths >= len(PACKET_MAGIC)) & (buffer[offsets] == PACKET_MAGIC[0])
+        binary[binary] = buffer[offsets[binary] + 1] == PACKET_MAGIC[1]
+        readings, reading_records, _ = decode_binary_records(buffer, offsets[binary], lengths[binary])
+        reading_records = np.flatnonzero(binary)[reading_records]
+
+        json_records, json_readings = [], []
+        for record in np.flatnonzero(~binary):
+            reading = parse_json_record(buffer[offsets[record]:offsets[record] + lengths[record]])
+            if reading is not None:
+                json_records.append(record)
+                json_readings.append(reading)
+
+        # Readings in record order, like trilateration.process_datagrams concatenates them.
+        # Every batch is then a slice, since batches are in record order too.
+        records = np.concatenate([reading_records, np.array(json_records, dtype=np.int64)])
+        order = np.argsort(records, kind="stable")
+        json_tags, json_anchors, json_distances = zip(*json_readings) if json_readings else ((), (), ())
+        tag_addresses = np.concatenate([readings["tag"], np.array(json_tags, dtype=np.int64)])[order]
+        anchor_addresses = np.concatenate([readings["anchor"], np.array(json_anchors, dtype=np.int64)])[order]
+        distances = np.concatenate([readings["distance"], np.array(json_distances, dtype=float)])[order]
+        batch_of_record = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, len(recv_times))))
+        bounds = np.searchsorted(batch_of_record[records[order]], np.arange(len(starts) + 1))
+        self.readings += len(records)
+
+        engine = self.engine
+        # Epochs of every call a replay makes to the engine, in order, solved together below
+        calls = []
+        fixes = []
+        for batch, start in enumerate(starts):
+            recv_time = recv_times[start]
+            if bounds[batch] < bounds[batch + 1]:
+                rows = slice(bounds[batch], bounds[batch + 1])
+                calls.append(engine.add_readings(tag_addresses[rows], anchor_addresses[rows], distances[rows], recv_time))
+            calls.append(engine.synchronizer.flush(recv_time))
+
+            # The anchor selector is only updated after the epochs so far are
+            # solved, with the anchors that were online when the replay solved them
+            selector, engine.anchor_selector = engine.anchor_selector, None
+            engine.check_health(recv_time)
+            engine.anchor_selector = selector
+            if selector is not None and (selector.online != engine.health.healthy()).any():
+                fixes += self._solve_calls(calls)
+                calls = []
+                selector.set_online(engine.health.healthy())
+        fixes += self._solve_calls(calls)
+        self._collect(fixes)
+
+    def _solve_calls(self, calls):
+        """
+        Solve the epochs of many engine calls with as few solve_epochs calls as possible.
+
+        Pass k solves the k-th call of every tag, so each tag's epochs are
+        solved in the same groups and order as in a replay, which makes the
+        tracker updates and warm starts the same. Solves are independent
+        across tags, so the fixes are the replay's.
+
+        Args:
+            calls: List of (tag_indices, distances, epoch_times) returned by
+                LocationEngine.add_readings or EpochSynchronizer.flush, in call order
+
+        Returns:
+            List of fixes as returned by _quality, in the order a replay produces them
+        """
+        calls = [epochs for epochs in calls if len(epochs[0])]
+        if not calls:
+            return []
+        tag_indices, distances, epoch_times = (np.concatenate(column) for column in zip(*calls))
+        call_of_epoch = np.repeat(np.arange(len(calls)), [len(epochs[0]) for epochs in calls])
+
+        # Rank of every (tag, call) pair among the calls of its tag
+        pairs, pair_of_epoch = np.unique(tag_indices * len(calls) + call_of_epoch, return_inverse=True)
+        pair_tags = pairs // len(calls)
+        first_of_tag = np.flatnonzero(np.append(True, pair_tags[1:] != pair_tags[:-1]))
+        pair_ranks = np.arange(len(pairs)) - np.repeat(first_of_tag, np.diff(np.append(first_of_tag, len(pairs))))
+        rank_of_epoch = pair_ranks[pair_of_epoch.reshape(-1)]
+
+        order = np.argsort(rank_of_epoch, kind="stable")
+        bounds = np.searchsorted(rank_of_epoch[order], np.arange(rank_of_epoch.max() + 2))
+        fixes = []
+        for rank in range(len(bounds) - 1):
+            epochs = order[bounds[rank]:bounds[rank + 1]]
+            solved = self.engine.solve_epochs(tag_indices[epochs], distances[epochs], epoch_times[epochs])
+            fixes.append(self._quality(solved) + (epochs[solved[2]],))
+
+        # Back to the order of the epochs, as a replay appends them
+        tag_indices, positions, times, anchors, epochs = (np.concatenate(column) for column in zip(*fixes))
+        order = np.argsort(epochs, kind="stable")
+        return [(tag_indices[order], positions[order], times[order], anchors[order])]
+
+    def _quality(self, fixes):
+        """
+        Keep the valid fixes with the number of anchor ranges they were solved
+        from, like trilateration.record_history, while it is current.
+        """
+        tag_indices, positions, valid = fixes
+        tag_indices = tag_indices[valid]
+        measurements = self.engine.measurements
+        return (
+            tag_indices, positions[valid], measurements.position_timestamps[tag_indices],
+            measurements.position_anchors[tag_indices],
+        )
+
+    def _collect(self, fixes):
+        """
+        Append the fixes of a chunk to the output in one go.
+        """
+        if not fixes:
+            return
+        tag_indices, positions, times, anchors = (np.concatenate(column) for column in zip(*fixes))
+        self.fixes += len(tag_indices)
+        if self.output is not None and len(tag_indices):
+            self.output.append(self.engine.measurements.tag_addresses[tag_indices], positions, times, anchors)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Solve captures recorded with trilateration.py --record into a position history, "
+                    "with the same results as replaying them with --replay. Decoding is vectorized and the "
+                    "epochs of a chunk are solved together, but epochs are still grouped once per receive "
+                    "batch (roughly 1.6x as fast as --replay with up to 100 tags, as fast with 1000)."
+    )
+    parser.add_argument("captures", nargs="+", help="capture files, solved in order as one recording")
+    parser.add_argument("-o", "--output", required=True,
+                        help="position history directory to write the fixes to (query it with position_history.py)")
+    parser.add_argument("--chunk-records", type=int, default=CHUNK_RECORDS, help="records decoded per chunk")
+    parser.add_argument("--anchor-config", metavar="PATH", help="anchor positions, as for trilateration.py")
+    parser.add_argument("--calibration", metavar="PATH", help="range calibration model, as for trilateration.py")
+    parser.add_argument("--best-anchors", type=int, metavar="K", help="best anchor subsets, as for trilateration.py")
+    args = parser.parse_args()
+
+    engine = trilateration.create_engine()
+    try:
+        if args.anchor_config:
+            _, positions = load_anchor_config(args.anchor_config, trilateration.ANCHOR_ADDRESSES)
+            engine.set_anchor_positions(positions)
+        if args.best_anchors:
+            engine.anchor_selector = GdopMap.around(engine.anchor_positions, DEFAULT_MARGIN, subset_size=args.best_anchors)
+            engine.anchor_selector.set_online(engine.health.healthy())
+        if args.calibration:
+            engine.calibration = CalibrationModel.load(args.calibration).compile(trilateration.ANCHOR_ADDRESSES)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+
+    output = PositionHistory(args.output, block=True)
+    # Fixes carry the recorded Unix receive times
+    output.clock_offset = 0.0
+    solver = CaptureSolver(engine, output)
+    start = time.perf_counter()
+    try:
+        for path in args.captures:
+            try:
+                solver.solve(path, args.chunk_records)
+            except (OSError, ValueError) as e:
+                print(f"Could not solve {path}: {e}")
+    finally:
+        output.close()
+    elapsed = time.perf_counter() - start
+    print(f"Solved {solver.readings} readings from {solver.records} packets in {elapsed:.2f} s "
+          f"({solver.readings / max(elapsed, 1e-9):.0f} readings/s), wrote {solver.fixes} fixes to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
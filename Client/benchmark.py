@@ -0,0 +1,216 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import socket
+import time
+
+import numpy as np
+
+from anchor_simulator import AnchorFleetSimulator
+from ingest_server import IngestServer
+from measurement_table import DEFAULT_TAG_ADDRESS
+from sharded_solver import ShardedSolver
+from trilateration import create_engine
+from wire_format import decode_binary_packet, is_binary_packet
+
+DEFAULT_ANCHOR_COUNTS = [3, 8, 16, 64]
+DEFAULT_TAG_COUNTS = [1, 10, 100, 1000]
+DEFAULT_DURATION = 3.0
+DEFAULT_POLLING_PERIOD_MS = 100
+
+# Time given to the simulator process to open its sockets before measuring
+STARTUP_TIMEOUT = 10.0
+
+# Pause between the simulator reporting its addresses and sending its first readings
+SIMULATOR_SETTLE_TIME = 0.2
+
+
+def run_simulator(client_addr, num_anchors, num_tags, duration, binary, queue):
+    """
+    Simulator process: report the anchor addresses, run, then report what was sent.
+    """
+    simulator = AnchorFleetSimulator(
+        client_addr, num_anchors, num_tags, polling_period_ms=1000, binary=binary, seed=0
+    )
+
+    async def run():
+        await simulator.start()
+        queue.put(simulator.anchor_ips())
+        # Give the client a moment to send the polling period before the clock starts
+        await asyncio.sleep(SIMULATOR_SETTLE_TIME)
+        await simulator.run(duration)
+
+    asyncio.run(run())
+    queue.put(simulator.stats())
+
+
+class BenchmarkClient:
+    """
+    The client pipeline (decode, filter, epoch sync, solve, track) with throughput and latency counters.
+    """
+
+    def __init__(self, anchor_addresses, anchor_positions, num_workers=0):
+        # The engine of trilateration.py, for the simulated anchors
+        self.engine = create_engine(anchor_addresses=anchor_addresses, anchor_positions=anchor_positions)
+        # With workers the engine above is idle and the pool solves everything
+        self.sharded_solver = ShardedSolver(anchor_addresses, anchor_positions, num_workers) if num_workers else None
+        self.readings_received = 0
+        self.fixes = 0
+        self.latencies_ms = []
+        # Send time in ms of the newest reading of every tag row, on the shared monotonic clock
+        self.last_sent_ms = np.full(self.engine.measurements.capacity, -np.inf)
+
+    def handle_batch(self, datagrams):
+        now = time.monotonic()
+        binary = []
+        json_readings = []
+        for data, addr in datagrams:
+            try:
+                if is_binary_packet(data):
+                    binary.append(decode_binary_packet(data))
+                else:
+                    message = json.loads(data.decode("utf-8"))
+                    json_readings.append((
+                        int(message.get("tag_address", DEFAULT_TAG_ADDRESS)),
+                        int(message["device_address"]),
+                        float(message["distance"].replace(" cm", "")),
+                    ))
+            except (ValueError, KeyError):
+                continue
+
+        if binary:
+            readings = np.concatenate(binary)
+            tags, anchors, distances = readings["tag"], readings["anchor"], readings["distance"]
+            # Age of every reading from its send time on the shared monotonic clock
+            ages_ms = (int(now * 1000) - readings["timestamp"].astype(np.int64)) & 0xFFFFFFFF
+        elif json_readings:
+            tags, anchors, distances = (np.array(column) for column in zip(*json_readings))
+            ages_ms = np.zeros(len(tags))  # JSON carries no send time, measure from receive
+        else:
+            return
+
+        self.readings_received += len(tags)
+        if self.sharded_solver is not None:
+            self.sharded_solver.submit(tags, anchors, distances, now)
+            return
+        self.mark_sent(self.engine.measurements.tag_indices(tags), now * 1000 - ages_ms)
+        self.count_fixes(self.engine.process_readings(tags, anchors, distances, now))
+
+    def mark_sent(self, tag_indices, sent_ms):
+        """
+        Remember the send time of the newest reading of every tag.
+        """
+        capacity = self.engine.measurements.capacity
+        if len(self.last_sent_ms) < capacity:
+            self.last_sent_ms = np.append(self.last_sent_ms, np.full(capacity - len(self.last_sent_ms), -np.inf))
+        np.maximum.at(self.last_sent_ms, tag_indices, sent_ms)
+
+    def count_fixes(self, fixes):
+        """
+        Count the valid fixes of a process_readings or flush call, and record their latency:
+        the time since the newest reading of their tag was sent.
+        """
+        fix_tags, _, valid = fixes
+        done_ms = time.monotonic() * 1000
+        self.fixes += int(np.count_nonzero(valid))
+        if valid.any():
+            self.latencies_ms.append(done_ms - self.last_sent_ms[fix_tags[valid]])
+
+    async def flush_expired_epochs(self):
+        # The timer of trilateration.py, epochs completed by a window expiring are solved here
+        while self.sharded_solver is None:
+            await asyncio.sleep(self.engine.synchronizer.window)
+            self.count_fixes(self.engine.flush())
+            self.engine.check_health()
+
+
+def benchmark(num_anchors, num_tags, duration, polling_period_ms, binary=True, num_workers=0):
+    """
+    Run the simulator against the client pipeline and measure it.
+
+    With workers, readings are solved by a ShardedSolver and latency isn't measured.
+
+    Returns:
+        Dict with packets/s, readings/s, fixes/s, drop rate and latency percentiles
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    client_addr = sock.getsockname()
+
+    # The simulator uses the same anchor layout and addresses by construction
+    layout = AnchorFleetSimulator(client_addr, num_anchors, 1)
+    client = BenchmarkClient(layout.anchor_addresses, layout.anchor_positions, num_workers)
+    server = IngestServer(sock, client.handle_batch)
+
+    queue = multiprocessing.Queue()
+    simulator = multiprocessing.Process(
+        target=run_simulator, args=(client_addr, num_anchors, num_tags, duration, binary, queue), daemon=True
+    )
+
+    async def run():
+        flush_task = asyncio.create_task(client.flush_expired_epochs())
+        serve_task = asyncio.create_task(server.serve())
+        simulator.start()
+        loop = asyncio.get_running_loop()
+        anchor_ips = await loop.run_in_executor(None, queue.get, True, STARTUP_TIMEOUT)
+        server.send_polling_update(polling_period_ms, anchor_ips)
+
+        # The simulator starts sending SIMULATOR_SETTLE_TIME after reporting its addresses
+        start = time.monotonic() + SIMULATOR_SETTLE_TIME
+        stats = await loop.run_in_executor(None, queue.get, True, duration + STARTUP_TIMEOUT)
+        # Let the last packets in flight arrive
+        await asyncio.sleep(0.1)
+        elapsed = time.monotonic() - start
+        flush_task.cancel()
+        serve_task.cancel()
+        return stats, elapsed
+
+    stats, elapsed = asyncio.run(run())
+    simulator.join()
+    sock.close()
+    if client.sharded_solver is not None:
+        # Wait for the workers to drain their rings before counting fixes
+        while client.sharded_solver.stats()["readings_queued"]:
+            time.sleep(0.01)
+        client.fixes = client.sharded_solver.stats()["fixes_published"]
+        client.sharded_solver.close()
+
+    latencies = np.concatenate(client.latencies_ms) if client.latencies_ms else np.array([np.nan])
+    received = server.protocol.datagrams_received
+    return {
+        "anchors": num_anchors,
+        "tags": num_tags,
+        "packets_per_s": received / elapsed,
+        "readings_per_s": client.readings_received / elapsed,
+        "fixes_per_s": client.fixes / elapsed,
+        "drop_rate": 1 - received / max(stats["packets_sent"], 1),
+        "latency_p50_ms": float(np.percentile(latencies, 50)),
+        "latency_p99_ms": float(np.percentile(latencies, 99)),
+        "polling_updates": stats["polling_updates"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end throughput benchmark of the client against simulated anchors")
+    parser.add_argument("--anchors", type=int, nargs="+", default=DEFAULT_ANCHOR_COUNTS, help="anchor counts to test")
+    parser.add_argument("--tags", type=int, nargs="+", default=DEFAULT_TAG_COUNTS, help="tag counts to test")
+    parser.add_argument("--duration", type=float, default=DEFAULT_DURATION, help="seconds per configuration")
+    parser.add_argument("--period", type=int, default=DEFAULT_POLLING_PERIOD_MS, help="polling period in ms")
+    parser.add_argument("--json", action="store_true", help="simulate JSON packets instead of binary ones")
+    parser.add_argument("--workers", type=int, default=0, help="solve in this many sharded worker processes")
+    args = parser.parse_args()
+
+    print(f"{'anchors':>7} {'tags':>5} {'packets/s':>10} {'readings/s':>11} {'fixes/s':>9} {'drop':>7} {'p50 ms':>8} {'p99 ms':>8}")
+    for num_anchors in args.anchors:
+        for num_tags in args.tags:
+            result = benchmark(num_anchors, num_tags, args.duration, args.period, not args.json, args.workers)
+            print(
+                f"{result['anchors']:>7} {result['tags']:>5} {result['packets_per_s']:>10.0f} "
+                f"{result['readings_per_s']:>11.0f} {result['fixes_per_s']:>9.0f} {result['drop_rate']:>7.1%} "
+                f"{result['latency_p50_ms']:>8.1f} {result['latency_p99_ms']:>8.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
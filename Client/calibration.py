@@ -0,0 +1,282 @@
+import argparse
+import json
+import os
+
+import numpy as np
+
+# Range measurements collected with the real modules (see Data_Collection/Distance_Data_Plot.py)
+CALIBRATION_DATA_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "Data_Collection", "distance_measurements.csv"
+)
+
+# Readings further than this many cm from the median of their distance marker
+# are gross errors (e.g. 12215 at 11 m). They are left out of every fit.
+OUTLIER_THRESHOLD = 500
+
+# Distances are whole centimeters in a uint16 (see wire_format.py), so the
+# compiled lookup table has one entry per possible reading
+LUT_SIZE = 1 << 16
+
+# Key of the model used for anchors without a model of their own
+DEFAULT_MODEL = "default"
+
+MODEL_KINDS = ("piecewise", "polynomial")
+
+
+def load_calibration_data(path, anchor=None):
+    """
+    Read a calibration dataset.
+
+    The CSV has a header and the columns distance_m (true distance marker in m)
+    and measured_cm (reported range in cm), plus an optional anchor column with
+    the UWB address of the anchor that took the reading.
+
+    Args:
+        path: CSV file
+        anchor: Anchor address for every row when the file has no anchor column
+
+    Returns:
+        Tuple (anchors, true_distances, measured) of arrays, distances in cm.
+        Anchors are -1 for readings that apply to every anchor.
+    """
+    with open(path) as f:
+        columns = f.readline().strip().split(",")
+    data = np.genfromtxt(path, delimiter=",", skip_header=1, ndmin=2)
+    true_distances = data[:, columns.index("distance_m")] * 100
+    measured = data[:, columns.index("measured_cm")]
+    if "anchor" in columns:
+        anchors = data[:, columns.index("anchor")].astype(np.int64)
+    else:
+        anchors = np.full(len(data), -1 if anchor is None else anchor, dtype=np.int64)
+    return anchors, true_distances, measured
+
+
+def marker_statistics(true_distances, measured, outlier_threshold=OUTLIER_THRESHOLD):
+    """
+    Median-filtered mean reading at every distance marker, computed for all
+    markers at once from one sort instead of a loop over groups.
+
+    Returns:
+        Tuple (markers, mean_measured, inliers): the sorted unique true
+        distances, the mean reading at each after dropping gross outliers, and
+        a boolean mask of the readings that were kept
+    """
+    markers, groups = np.unique(true_distances, return_inverse=True)
+    counts = np.bincount(groups, minlength=len(markers))
+
+    # Sorting by (marker, value) puts every group's median in the middle of its run
+    order = np.lexsort((measured, groups))
+    sorted_values = measured[order]
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    medians = (sorted_values[starts + (counts - 1) // 2] + sorted_values[starts + counts // 2]) / 2
+
+    inliers = np.abs(measured - medians[groups]) < outlier_threshold
+    sums = np.bincount(groups, weights=np.where(inliers, measured, 0.0), minlength=len(markers))
+    kept = np.bincount(groups, weights=inliers, minlength=len(markers))
+    return markers, sums / np.maximum(kept, 1), inliers
+
+
+def fit_piecewise(true_distances, measured):
+    """
+    Piecewise-linear map from reading to true distance through the mean
+    reading of every marker.
+
+    Returns:
+        Model dict with the knots
+    """
+    markers, mean_measured, _ = marker_statistics(true_distances, measured)
+    # Keep the knots increasing so the map stays a function of the reading
+    order = np.argsort(mean_measured)
+    return {"kind": "piecewise", "measured": mean_measured[order].tolist(), "true": markers[order].tolist()}
+
+
+def fit_polynomial(true_distances, measured, degree=2):
+    """
+    Least-squares polynomial from reading to true distance over all inlier readings.
+
+    Returns:
+        Model dict with the coefficients, highest power first
+    """
+    _, _, inliers = marker_statistics(true_distances, measured)
+    coefficients = np.polyfit(measured[inliers], true_distances[inliers], degree)
+    return {"kind": "polynomial", "coefficients": coefficients.tolist()}
+
+
+def evaluate_model(model, measured):
+    """
+    Evaluate a model dict on an array of readings (used to build the lookup table).
+
+    Returns:
+        Array of corrected distances in cm
+    """
+    measured = np.asarray(measured, dtype=float)
+    if model["kind"] == "polynomial":
+        return np.polyval(model["coefficients"], measured)
+
+    knots_measured = np.asarray(model["measured"])
+    knots_true = np.asarray(model["true"])
+    if len(knots_measured) == 1:
+        # A single marker only tells the offset
+        return measured + (knots_true[0] - knots_measured[0])
+
+    corrected = np.interp(measured, knots_measured, knots_true)
+    # Extend the first and last segments beyond the measured range
+    low_slope = (knots_true[1] - knots_true[0]) / (knots_measured[1] - knots_measured[0])
+    high_slope = (knots_true[-1] - knots_true[-2]) / (knots_measured[-1] - knots_measured[-2])
+    below = measured < knots_measured[0]
+    above = measured > knots_measured[-1]
+    corrected[below] = knots_true[0] + (measured[below] - knots_measured[0]) * low_slope
+    corrected[above] = knots_true[-1] + (measured[above] - knots_measured[-1]) * high_slope
+    return corrected
+
+
+class CalibrationModel:
+    """
+    Per-anchor range bias models fitted from calibration datasets.
+
+    Each model maps a raw reading to the true distance, either piecewise
+    linearly through the mean reading at every distance marker or with a
+    polynomial. Readings without an anchor column are fitted into the default
+    model, which applies to every anchor without a model of its own.
+    """
+
+    def __init__(self, models):
+        """
+        Args:
+            models: Dict from anchor address (or DEFAULT_MODEL) to model dict
+        """
+        self.models = models
+
+    @classmethod
+    def fit(cls, anchors, true_distances, measured, kind="piecewise", degree=2):
+        """
+        Fit one model per anchor in the data.
+
+        Args:
+            anchors: Anchor address of every reading, -1 for the default model
+            true_distances: True distance of every reading in cm
+            measured: Reported range of every reading in cm
+            kind: "piecewise" or "polynomial"
+            degree: Degree of polynomial models
+        """
+        if kind not in MODEL_KINDS:
+            raise ValueError(f"Unknown calibration model {kind}, expected one of {MODEL_KINDS}")
+        anchors = np.asarray(anchors)
+        true_distances = np.asarray(true_distances, dtype=float)
+        measured = np.asarray(measured, dtype=float)
+
+        models = {}
+        for anchor in np.unique(anchors):
+            rows = anchors == anchor
+            key = DEFAULT_MODEL if anchor < 0 else int(anchor)
+            if kind == "piecewise":
+                models[key] = fit_piecewise(true_distances[rows], measured[rows])
+            else:
+                models[key] = fit_polynomial(true_distances[rows], measured[rows], degree)
+        return cls(models)
+
+    def model_for(self, anchor_address):
+        return self.models.get(anchor_address, self.models.get(DEFAULT_MODEL))
+
+    def correct(self, anchor_address, measured):
+        """
+        Evaluate the model of one anchor directly (no lookup table).
+        """
+        model = self.model_for(anchor_address)
+        return np.asarray(measured, dtype=float) if model is None else evaluate_model(model, measured)
+
+    def compile(self, anchor_addresses):
+        """
+        Precompute the corrected distance of every possible reading.
+
+        Args:
+            anchor_addresses: Anchor addresses in the column order of the measurement table
+
+        Returns:
+            CalibrationTable for those anchors
+        """
+        readings = np.arange(LUT_SIZE, dtype=float)
+        table = np.empty((len(anchor_addresses), LUT_SIZE), dtype=np.float32)
+        for i, anchor_address in enumerate(anchor_addresses):
+            table[i] = np.maximum(self.correct(int(anchor_address), readings), 0.0)
+        return CalibrationTable(table)
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump({"version": 1, "models": {str(key): model for key, model in self.models.items()}}, f, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Raises:
+            ValueError: If the file isn't a calibration model
+        """
+        with open(path) as f:
+            data = json.load(f)
+        if data.get("version") != 1 or "models" not in data:
+            raise ValueError(f"{path} is not a calibration model")
+        return cls({key if key == DEFAULT_MODEL else int(key): model for key, model in data["models"].items()})
+
+
+class CalibrationTable:
+    """
+    Compiled calibration: one row of corrected distances per anchor, indexed
+    by the whole-centimeter reading. Correcting a batch is a single fancy
+    index, with no curve evaluated per sample.
+    """
+
+    def __init__(self, table):
+        """
+        Args:
+            table: Array of shape (N, LUT_SIZE) with the corrected distance of every reading
+        """
+        self.table = table
+
+    def correct(self, anchor_indices, distances):
+        """
+        Args:
+            anchor_indices: Anchor columns of the readings
+            distances: Raw distances in cm
+
+        Returns:
+            Array of corrected distances in cm
+        """
+        distances = np.asarray(distances)
+        if distances.dtype.kind == "u" and distances.itemsize <= 2:
+            # Binary readings index the table as they are
+            readings = distances
+        else:
+            readings = np.clip(np.rint(distances), 0, LUT_SIZE - 1).astype(np.intp)
+        return self.table[anchor_indices, readings].astype(float)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fit a range calibration model from calibration datasets")
+    parser.add_argument("datasets", nargs="*", default=[CALIBRATION_DATA_PATH],
+                        help="CSV files with distance_m, measured_cm and optionally anchor columns")
+    parser.add_argument("--anchor", type=int, help="anchor address of datasets without an anchor column")
+    parser.add_argument("--kind", choices=MODEL_KINDS, default="piecewise", help="model type (default: piecewise)")
+    parser.add_argument("--degree", type=int, default=2, help="degree of polynomial models (default: 2)")
+    parser.add_argument("-o", "--output", default="calibration.json", help="model file to write")
+    args = parser.parse_args()
+
+    columns = [load_calibration_data(path, args.anchor) for path in args.datasets]
+    anchors, true_distances, measured = (np.concatenate(column) for column in zip(*columns))
+    model = CalibrationModel.fit(anchors, true_distances, measured, args.kind, args.degree)
+    model.save(args.output)
+
+    # Error before and after calibration over the inlier readings
+    _, _, inliers = marker_statistics(true_distances, measured)
+    corrected = np.empty(len(measured))
+    for anchor in np.unique(anchors):
+        rows = anchors == anchor
+        corrected[rows] = model.correct(DEFAULT_MODEL if anchor < 0 else int(anchor), measured[rows])
+    raw_error = measured[inliers] - true_distances[inliers]
+    error = corrected[inliers] - true_distances[inliers]
+    print(f"Fitted {len(model.models)} {args.kind} model(s) from {len(measured)} readings, wrote {args.output}")
+    print(f"Bias:  {raw_error.mean():7.1f} cm -> {error.mean():7.1f} cm")
+    print(f"RMS:   {np.sqrt(np.mean(raw_error**2)):7.1f} cm -> {np.sqrt(np.mean(error**2)):7.1f} cm")
+
+
+if __name__ == "__main__":
+    main()
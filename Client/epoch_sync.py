@@ -0,0 +1,224 @@
+import numpy as np
+
+from multilateration import MIN_ANCHORS
+
+# Default length of an epoch in seconds. Anchors poll on independent timers, so
+# one round of readings is spread over up to one polling period (100 ms default).
+# Tags whose anchors poll slower get longer windows, see set_windows.
+DEFAULT_EPOCH_WINDOW = 0.1
+
+
+class EpochSynchronizer:
+    """
+    Groups the readings of every tag into measurement epochs.
+
+    An epoch opens with the first reading of a tag and collects at most one
+    distance per anchor. It closes when every expected anchor has reported
+    (all of them unless set_expected left some out), when its window expires,
+    or when a reading arrives that belongs to a later epoch (an anchor
+    reporting twice, or a newer sequence number). Closed epochs
+    with at least `quorum` anchors are emitted as one row of distances, the
+    others are dropped and counted.
+
+    All state is kept in per-tag arrays indexed by the measurement table's
+    tag rows, and batches are processed one reading per tag at a time so
+    every step is vectorized across tags.
+    """
+
+    def __init__(self, num_anchors, window=DEFAULT_EPOCH_WINDOW, quorum=MIN_ANCHORS, tag_capacity=64):
+        """
+        Args:
+            num_anchors: Number of anchors (columns of the measurement table)
+            window: Maximum time in seconds between the first and last reading of
+                an epoch, for tags that set_windows didn't give a longer one
+            quorum: Minimum number of anchors needed to emit an epoch
+            tag_capacity: Number of tag rows to preallocate
+        """
+        self.num_anchors = num_anchors
+        self.window = window
+        self.quorum = min(quorum, num_anchors)
+        self.capacity = 0
+        self.expected = np.ones(num_anchors, dtype=bool)
+
+        # Counters
+        self.epochs_emitted = 0
+        self.epochs_incomplete = 0  # emitted with quorum, but not every anchor
+        self.epochs_dropped = 0     # closed below quorum
+        self.readings_dropped = 0   # readings in dropped epochs
+        self.readings_stale = 0     # readings older than the tag's open epoch
+        self.readings_replaced = 0  # repeated readings for an anchor within one epoch
+
+        self.ensure_capacity(max(1, tag_capacity))
+
+    def ensure_capacity(self, num_tags):
+        """
+        Grow the per-tag arrays so they hold at least `num_tags` tags.
+        """
+        if num_tags <= self.capacity:
+            return
+        capacity = max(num_tags, 2 * self.capacity)
+
+        def grow(name, shape, fill, dtype):
+            new = np.full(shape, fill, dtype=dtype)
+            old = getattr(self, name, None)
+            if old is not None:
+                new[:len(old)] = old
+            setattr(self, name, new)
+
+        grow("windows", capacity, self.window, float)
+        grow("epoch_start", capacity, np.nan, float)
+        grow("epoch_sequence", capacity, -1, np.int64)
+        grow("epoch_distances", (capacity, self.num_anchors), np.nan, float)
+        grow("epoch_received", (capacity, self.num_anchors), False, bool)
+        self.capacity = capacity
+
+    def set_expected(self, expected):
+        """
+        Set the anchors an epoch waits for before it closes, e.g. leaving out
+        anchors that went silent so epochs don't all wait for the window.
+
+        Args:
+            expected: Boolean mask of the anchors
+        """
+        self.expected = np.asarray(expected, dtype=bool)
+
+    def set_windows(self, tag_indices, windows):
+        """
+        Set the epoch window of some tags, e.g. the slowest polling period of
+        their anchors: with unsynchronized anchors a round of readings is
+        spread over a whole period. Windows are never shorter than `window`,
+        and NaN restores it.
+
+        Args:
+            tag_indices: Tag rows
+            windows: Window in seconds per tag (array or scalar)
+        """
+        tag_indices = np.asarray(tag_indices, dtype=np.int64)
+        if len(tag_indices):
+            self.ensure_capacity(int(tag_indices.max()) + 1)
+        self.windows[tag_indices] = np.fmax(windows, self.window)
+
+    def add(self, tag_indices, anchor_indices, distances, timestamps, sequences=None):
+        """
+        Add a batch of readings in arrival order.
+
+        Args:
+            tag_indices: Tag rows of the readings
+            anchor_indices: Anchor columns of the readings
+            distances: Distances in cm
+            timestamps: Receive times in seconds
+            sequences: Optional round numbers. When given, readings are grouped
+                by sequence number instead of by anchor repetition.
+
+        Returns:
+            Tuple (tag_indices, distances, epoch_times) of the epochs completed
+            by this batch, with NaN distances for anchors that didn't report
+        """
+        tag_indices = np.asarray(tag_indices, dtype=np.int64)
+        anchor_indices = np.asarray(anchor_indices, dtype=np.int64)
+        distances = np.broadcast_to(np.asarray(distances, dtype=float), tag_indices.shape)
+        timestamps = np.broadcast_to(np.asarray(timestamps, dtype=float), tag_indices.shape)
+        if sequences is not None:
+            sequences = np.asarray(sequences, dtype=np.int64)
+        if len(tag_indices):
+            self.ensure_capacity(int(tag_indices.max()) + 1)
+
+        emitted = []
+        remaining = np.arange(len(tag_indices))
+        while len(remaining):
+            # The first remaining reading of every tag is processed in this pass
+            _, first = np.unique(tag_indices[remaining], return_index=True)
+            current = remaining[first]
+            remaining = np.delete(remaining, first)
+            emitted.append(self._add_unique(
+                tag_indices[current],
+                anchor_indices[current],
+                distances[current],
+                timestamps[current],
+                None if sequences is None else sequences[current],
+            ))
+
+        return self._concatenate(emitted)
+
+    def _add_unique(self, tags, anchors, distances, timestamps, sequences):
+        """
+        Add readings that all belong to different tags.
+        """
+        is_open = ~np.isnan(self.epoch_start[tags])
+        expired = is_open & (timestamps - self.epoch_start[tags] > self.windows[tags])
+
+        if sequences is None:
+            stale = is_open & (timestamps < self.epoch_start[tags])
+            newer = is_open & ~stale & self.epoch_received[tags, anchors]
+        else:
+            stale = is_open & (sequences < self.epoch_sequence[tags])
+            newer = is_open & (sequences > self.epoch_sequence[tags])
+            self.readings_replaced += int(np.count_nonzero(
+                is_open & ~stale & ~newer & self.epoch_received[tags, anchors]
+            ))
+
+        # Stale readings are dropped, the epochs they would have closed stay open
+        self.readings_stale += int(np.count_nonzero(stale))
+        keep = ~stale
+        tags, anchors, distances, timestamps = tags[keep], anchors[keep], distances[keep], timestamps[keep]
+        if sequences is not None:
+            sequences = sequences[keep]
+        is_open, close = is_open[keep], (expired | newer)[keep]
+
+        # Close the epochs these readings don't belong to, then start new ones
+        emitted_before = self._close(tags[close])
+        start = ~is_open | close
+        self.epoch_start[tags[start]] = timestamps[start]
+        if sequences is not None:
+            self.epoch_sequence[tags[start]] = sequences[start]
+
+        self.epoch_distances[tags, anchors] = distances
+        self.epoch_received[tags, anchors] = True
+
+        # Emit the epochs every expected anchor has reported for
+        complete = tags[(self.epoch_received[tags] | ~self.expected).all(axis=1)]
+        return self._concatenate([emitted_before, self._close(complete)])
+
+    def flush(self, now):
+        """
+        Close every epoch whose window has expired.
+
+        Args:
+            now: Current time in seconds, on the same clock as the reading timestamps
+
+        Returns:
+            Tuple (tag_indices, distances, epoch_times) of the epochs emitted
+        """
+        expired = np.flatnonzero(now - self.epoch_start > self.windows)
+        return self._close(expired)
+
+    def _close(self, tags):
+        """
+        Close the open epochs of the given tags, emitting those with quorum.
+        """
+        counts = np.count_nonzero(self.epoch_received[tags], axis=1)
+        emit = counts >= self.quorum
+        dropped = ~emit & (counts > 0)
+
+        self.epochs_emitted += int(np.count_nonzero(emit))
+        self.epochs_incomplete += int(np.count_nonzero(emit & (counts < self.num_anchors)))
+        self.epochs_dropped += int(np.count_nonzero(dropped))
+        self.readings_dropped += int(counts[dropped].sum())
+
+        emitted_tags = tags[emit]
+        result = (emitted_tags, self.epoch_distances[emitted_tags].copy(), self.epoch_start[emitted_tags].copy())
+
+        self.epoch_start[tags] = np.nan
+        self.epoch_sequence[tags] = -1
+        self.epoch_distances[tags] = np.nan
+        self.epoch_received[tags] = False
+        return result
+
+    def _concatenate(self, epochs):
+        """
+        Join several (tag_indices, distances, epoch_times) tuples into one.
+        """
+        if not epochs:
+            return np.empty(0, dtype=np.int64), np.empty((0, self.num_anchors)), np.empty(0)
+        tags, distances, times = zip(*epochs)
+        return np.concatenate(tags), np.concatenate(distances), np.concatenate(times)
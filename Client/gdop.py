@@ -0,0 +1,279 @@
+from itertools import combinations
+
+import numpy as np
+
+from multilateration import DEFAULT_TAG_HEIGHT, MIN_ANCHORS, solve_symmetric3
+
+# Number of anchors a tag is solved with when more are available. One more
+# than the minimum keeps a redundant range to reject a bad one.
+DEFAULT_SUBSET_SIZE = MIN_ANCHORS + 1
+
+# Edge length of a map cell in cm
+DEFAULT_CELL_SIZE = 50.0
+
+# Floor around the anchors covered by GdopMap.around in cm. Tags beyond it use the nearest edge cell.
+DEFAULT_MARGIN = 300.0
+
+# Upper bound of stored GDOP values (subsets x cells, float32). Sites with many
+# anchor subsets get larger cells instead of more memory.
+MAX_TABLE_ENTRIES = 1 << 24
+
+# Subsets are evaluated this many at a time, bounding the temporary arrays
+SUBSET_BATCH = 64
+
+
+def evaluate_gdop(anchor_positions, points, dims=2):
+    """
+    GDOP of whole anchor layouts at a set of points, using every anchor.
+
+    Args:
+        anchor_positions: Array (..., N, 3) of anchor coordinates in cm, e.g.
+            (B, N, 3) to evaluate B candidate layouts at once
+        points: Array (P, 3) of tag positions in cm
+        dims: 2 for the horizontal dilution (x, y), 3 to include z
+
+    Returns:
+        Array (..., P) of GDOP values, inf where the anchors can't fix a position
+    """
+    points = np.asarray(points, dtype=float)
+    anchor_positions = np.asarray(anchor_positions, dtype=float)
+    # Offsets of shape (..., N, P), one coordinate at a time
+    dx, dy, dz = (points[:, i] - anchor_positions[..., i, None] for i in range(3))
+    if dims == 2:
+        dz = np.zeros_like(dx)
+    ranges = np.maximum(np.sqrt(dx * dx + dy * dy + dz * dz), 1e-6)
+    ux, uy, uz = dx / ranges, dy / ranges, dz / ranges
+    xx, yy, xy = (ux * ux).sum(axis=-2), (uy * uy).sum(axis=-2), (ux * uy).sum(axis=-2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if dims == 2:
+            trace = (xx + yy) / (xx * yy - xy * xy)
+        else:
+            zz, xz, yz = (uz * uz).sum(axis=-2), (ux * uz).sum(axis=-2), (uy * uz).sum(axis=-2)
+            zeros = np.zeros_like(xx)
+            _, (i_xx, i_yy, i_zz, _, _, _) = solve_symmetric3(xx, yy, zz, xy, xz, yz, zeros, zeros, zeros)
+            trace = i_xx + i_yy + i_zz
+        gdop = np.sqrt(trace)
+    return np.where(np.isfinite(gdop) & (trace > 0), gdop, np.inf)
+
+
+class GdopMap:
+    """
+    Precomputed geometric dilution of precision (GDOP) of every anchor subset
+    over the floor, and the best subset of every cell.
+
+    The floor is divided into square cells. For every cell and every subset
+    of `subset_size` anchors, the GDOP at the cell center is stored, so
+    picking the anchors for a tag is a cell lookup and one row of a boolean
+    table, however many anchors the site has.
+
+    The normal matrix of a subset is the sum of one matrix per anchor, so the
+    per-anchor terms are computed once and summed per subset. When anchors
+    move, only the subsets containing them are recomputed. When anchors go
+    offline or come back, the best subset is updated only in the cells whose
+    best subset contained them (or could now contain them), without
+    computing any GDOP.
+    """
+
+    def __init__(self, anchor_positions, xlim, ylim, subset_size=DEFAULT_SUBSET_SIZE,
+                 cell_size=DEFAULT_CELL_SIZE, tag_height=DEFAULT_TAG_HEIGHT, dims=2, max_range=None):
+        """
+        Args:
+            anchor_positions: Array of shape (N, 2) or (N, 3) with anchor coordinates in cm
+            xlim: (min, max) x of the floor in cm
+            ylim: (min, max) y of the floor in cm
+            subset_size: Anchors per subset, at most N
+            cell_size: Edge length of a cell in cm, enlarged if the table would
+                need more than MAX_TABLE_ENTRIES values
+            tag_height: Height in cm of the tags the GDOP is evaluated for
+            dims: 2 for the horizontal dilution (x, y), 3 to include z
+            max_range: Optional range in cm beyond which an anchor is never
+                selected, e.g. where its ranges get unreliable
+        """
+        self.anchor_positions = np.zeros((len(anchor_positions), 3))
+        positions = np.asarray(anchor_positions, dtype=float)
+        self.anchor_positions[:, :positions.shape[1]] = positions
+        self.num_anchors = len(self.anchor_positions)
+        self.subset_size = min(subset_size, self.num_anchors)
+        self.tag_height = tag_height
+        self.dims = dims
+        self.max_range = max_range
+
+        # Boolean (S, N) table of the anchors in every subset
+        subsets = list(combinations(range(self.num_anchors), self.subset_size))
+        self.subsets = np.zeros((len(subsets), self.num_anchors), dtype=bool)
+        for i, subset in enumerate(subsets):
+            self.subsets[i, list(subset)] = True
+        self.subset_indices = np.array(subsets, dtype=np.int64).reshape(len(subsets), self.subset_size)
+
+        self.origin = np.array([xlim[0], ylim[0]], dtype=float)
+        size = np.array([xlim[1] - xlim[0], ylim[1] - ylim[0]], dtype=float)
+        max_cells = max(1, MAX_TABLE_ENTRIES // len(subsets))
+        self.cell_size = max(float(cell_size), float(np.sqrt(size.prod() / max_cells)))
+        while True:
+            self.shape = tuple(int(n) for n in np.maximum(np.ceil(size / self.cell_size), 1)[::-1])  # (rows, columns)
+            rows, columns = self.shape
+            if rows * columns <= max_cells:
+                break
+            # Rounding up to whole cells overshot the budget
+            self.cell_size *= 1.05
+
+        y, x = np.mgrid[:rows, :columns]
+        self.centers = np.column_stack([
+            self.origin[0] + (x.reshape(-1) + 0.5) * self.cell_size,
+            self.origin[1] + (y.reshape(-1) + 0.5) * self.cell_size,
+            np.full(rows * columns, float(tag_height)),
+        ])
+
+        self.online = np.ones(self.num_anchors, dtype=bool)
+        self.gdop = np.empty((len(subsets), rows * columns), dtype=np.float32)
+        # Best subset of every cell (-1 if no subset of online anchors works) and its GDOP
+        self.best = np.zeros(rows * columns, dtype=np.int64)
+        self.best_gdop = np.full(rows * columns, np.inf, dtype=np.float32)
+        self._anchor_terms = np.empty((self.num_anchors, 6, rows * columns))
+        self._in_range = np.ones((self.num_anchors, rows * columns), dtype=bool)
+        self._update_anchor_terms(np.arange(self.num_anchors))
+        self._update_subsets(np.arange(len(subsets)))
+        self._select_best()
+
+    @classmethod
+    def around(cls, anchor_positions, margin, **kwargs):
+        """
+        Map covering the anchors plus a margin on every side.
+        """
+        points = np.asarray(anchor_positions, dtype=float)[:, :2]
+        low = points.min(axis=0) - margin
+        high = points.max(axis=0) + margin
+        return cls(anchor_positions, (low[0], high[0]), (low[1], high[1]), **kwargs)
+
+    def _update_anchor_terms(self, anchors):
+        """
+        Entries (xx, yy, zz, xy, xz, yz) of u u^T for the unit vectors u from
+        the given anchors to every cell center.
+        """
+        offsets = self.centers[None, :, :] - self.anchor_positions[anchors, None, :]
+        if self.dims == 2:
+            offsets[:, :, 2] = 0
+        ranges = np.maximum(np.linalg.norm(offsets, axis=2), 1e-6)
+        if self.max_range is not None:
+            self._in_range[anchors] = ranges <= self.max_range
+        ux, uy, uz = np.moveaxis(offsets / ranges[:, :, None], 2, 0)
+        self._anchor_terms[anchors] = np.stack([ux * ux, uy * uy, uz * uz, ux * uy, ux * uz, uy * uz], axis=1)
+
+    def _update_subsets(self, subsets):
+        """
+        Recompute the GDOP of the given subsets in every cell.
+        """
+        for start in range(0, len(subsets), SUBSET_BATCH):
+            batch = subsets[start:start + SUBSET_BATCH]
+            xx, yy, zz, xy, xz, yz = np.moveaxis(self._anchor_terms[self.subset_indices[batch]].sum(axis=1), 1, 0)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                if self.dims == 2:
+                    trace = (xx + yy) / (xx * yy - xy * xy)
+                else:
+                    zeros = np.zeros_like(xx)
+                    _, (i_xx, i_yy, i_zz, _, _, _) = solve_symmetric3(xx, yy, zz, xy, xz, yz, zeros, zeros, zeros)
+                    trace = i_xx + i_yy + i_zz
+                gdop = np.sqrt(trace)
+            # Collinear (or coplanar in 3D) subsets can't fix a position at all
+            usable = np.isfinite(gdop) & (trace > 0) & self._in_range[self.subset_indices[batch]].all(axis=1)
+            self.gdop[batch] = np.where(usable, gdop, np.inf)
+
+    def _select_best(self, cells=slice(None)):
+        """
+        Pick the subset of online anchors with the lowest GDOP in the given cells.
+        """
+        available = ~self.subsets[:, ~self.online].any(axis=1)
+        candidates = np.flatnonzero(available)
+        if not len(candidates):
+            self.best[cells] = -1
+            self.best_gdop[cells] = np.inf
+            return
+        gdop = self.gdop[candidates][:, cells]
+        choice = gdop.argmin(axis=0)
+        self.best[cells] = candidates[choice]
+        self.best_gdop[cells] = np.take_along_axis(gdop, choice[None], axis=0)[0]
+
+    def move_anchors(self, anchor_positions):
+        """
+        Update the anchor positions, recomputing only the subsets of anchors that moved.
+
+        Returns:
+            Column indices of the anchors that moved
+        """
+        positions = np.zeros_like(self.anchor_positions)
+        anchor_positions = np.asarray(anchor_positions, dtype=float)
+        positions[:, :anchor_positions.shape[1]] = anchor_positions
+        moved = np.flatnonzero((positions != self.anchor_positions).any(axis=1))
+        if len(moved):
+            self.anchor_positions = positions
+            self._update_anchor_terms(moved)
+            self._update_subsets(np.flatnonzero(self.subsets[:, moved].any(axis=1)))
+            self._select_best()
+        return moved
+
+    def set_online(self, online):
+        """
+        Mark anchors as online or offline (e.g. AnchorHealth.healthy()).
+        Subsets with an offline anchor are never selected.
+        """
+        online = np.asarray(online, dtype=bool)
+        went_offline = np.flatnonzero(self.online & ~online)
+        came_back = np.flatnonzero(~self.online & online)
+        self.online = online.copy()
+
+        # Cells that used an anchor that went offline need a new subset
+        if len(went_offline):
+            uses = (self.best < 0) | self.subsets[np.maximum(self.best, 0)][:, went_offline].any(axis=1)
+            affected = np.flatnonzero(uses)
+            if len(affected):
+                self._select_best(affected)
+
+        # Anchors that came back can only improve cells through the subsets they are in
+        if len(came_back):
+            available = ~self.subsets[:, ~online].any(axis=1)
+            candidates = np.flatnonzero(available & self.subsets[:, came_back].any(axis=1))
+            if len(candidates):
+                gdop = self.gdop[candidates]
+                choice = gdop.argmin(axis=0)
+                choice_gdop = np.take_along_axis(gdop, choice[None], axis=0)[0]
+                better = (choice_gdop < self.best_gdop) | (self.best < 0)
+                self.best[better] = candidates[choice[better]]
+                self.best_gdop[better] = choice_gdop[better]
+
+    def cells(self, positions):
+        """
+        Returns:
+            Flat cell index of every position, positions off the map use the nearest edge cell
+        """
+        xy = (np.asarray(positions, dtype=float)[:, :2] - self.origin) / self.cell_size
+        rows, columns = self.shape
+        column = np.clip(np.nan_to_num(xy[:, 0]).astype(np.int64), 0, columns - 1)
+        row = np.clip(np.nan_to_num(xy[:, 1]).astype(np.int64), 0, rows - 1)
+        return row * columns + column
+
+    def best_anchors(self, positions):
+        """
+        Look up the best subset of online anchors near every position.
+
+        Args:
+            positions: Array (M, 2) or (M, 3) of (approximate) tag positions in cm
+
+        Returns:
+            Tuple (anchors, gdop): boolean array (M, N) with the anchors to use
+            and the GDOP they give. Rows are all False (and GDOP inf) where
+            no subset of online anchors can fix a position.
+        """
+        cells = self.cells(positions)
+        best = self.best[cells]
+        anchors = self.subsets[np.maximum(best, 0)]
+        gdop = self.best_gdop[cells].astype(float)
+        usable = (best >= 0) & np.isfinite(gdop)
+        anchors[~usable] = False
+        return anchors, np.where(usable, gdop, np.inf)
+
+    def gdop_grid(self):
+        """
+        Returns:
+            Array (rows, columns) with the GDOP of the best subset of every cell, row 0 at ymin
+        """
+        return self.best_gdop.reshape(self.shape).astype(float)
@@ -0,0 +1,164 @@
+import asyncio
+import json
+import socket
+import threading
+import time
+
+# Largest datagram the anchors send (matches the recvfrom buffer the client always used)
+RECV_BUFFER_SIZE = 1024
+
+# Maximum number of datagrams drained from the socket per event-loop wakeup
+MAX_BURST = 256
+
+# Kernel receive buffer requested for the socket so bursts aren't dropped between wakeups
+SOCKET_RECV_BUFFER_BYTES = 4 * 1024 * 1024
+
+
+def bind_socket(host, port):
+    """
+    Create and bind the UDP socket the anchors send to. The client scripts
+    call this from main(), so importing them doesn't take the port.
+
+    Returns:
+        The bound socket
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((host, port))
+    print(f"Listening for UDP packets on {host}:{port}...")
+    return sock
+
+
+class IngestProtocol(asyncio.DatagramProtocol):
+    """
+    Datagram protocol that drains bursts of packets and hands them over in batches.
+
+    asyncio delivers one datagram per wakeup. When it does, the protocol keeps
+    reading from the (non-blocking) socket until it is empty or MAX_BURST
+    datagrams were collected, then passes the whole burst to `handle_batch`
+    in a single call.
+    """
+
+    def __init__(self, sock, handle_batch, max_burst=MAX_BURST, recorder=None, metrics=None):
+        """
+        Args:
+            sock: The bound UDP socket the endpoint was created with
+            handle_batch: Called with a list of (data, addr) tuples for every burst
+            max_burst: Maximum number of datagrams per batch
+            recorder: Optional PacketRecorder that every burst is appended to
+            metrics: Optional ClientMetrics counting datagrams, burst sizes and batch latency
+        """
+        self.sock = sock
+        self.handle_batch = handle_batch
+        self.max_burst = max_burst
+        self.recorder = recorder
+        self.metrics = metrics
+        self.transport = None
+        self.datagrams_received = 0
+        self.batches_handled = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        batch = [(data, addr)]
+        while len(batch) < self.max_burst:
+            try:
+                batch.append(self.sock.recvfrom(RECV_BUFFER_SIZE))
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                print(f"Error receiving UDP packet: {e}")
+                break
+
+        self.datagrams_received += len(batch)
+        self.batches_handled += 1
+        if self.metrics is not None:
+            self.metrics.datagrams_received.inc(len(batch))
+            self.metrics.queue_depth.observe(len(batch))
+        if self.recorder is not None:
+            try:
+                self.recorder.record_batch(batch)
+            except OSError as e:
+                print(f"Error recording UDP batch: {e}")
+        start = time.perf_counter()
+        try:
+            self.handle_batch(batch)
+        except Exception as e:
+            print(f"Error processing UDP batch: {e}")
+        if self.metrics is not None:
+            self.metrics.batch_latency.observe(time.perf_counter() - start)
+
+    def error_received(self, exc):
+        print(f"UDP error received: {exc}")
+
+
+class IngestServer:
+    """
+    Runs the ingest protocol on an asyncio event loop.
+
+    The loop either runs in the calling thread (serve) or in a daemon thread
+    (start_in_thread) so a GUI can keep the main thread. Polling updates are
+    sent through the same transport and may be requested from any thread.
+    """
+
+    def __init__(self, sock, handle_batch, max_burst=MAX_BURST, recorder=None, metrics=None):
+        """
+        Args:
+            sock: Bound UDP socket to read from and send polling updates on
+            handle_batch: Called with a list of (data, addr) tuples for every burst
+            max_burst: Maximum number of datagrams per batch
+            recorder: Optional PacketRecorder that every burst is appended to
+            metrics: Optional ClientMetrics the protocol reports to
+        """
+        self.sock = sock
+        self.protocol = IngestProtocol(sock, handle_batch, max_burst, recorder, metrics)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_RECV_BUFFER_BYTES)
+        except OSError as e:
+            print(f"Could not enlarge UDP receive buffer: {e}")
+        self.loop = None
+        self._ready = threading.Event()
+
+    async def serve(self):
+        """
+        Serve until the task is cancelled.
+        """
+        self.loop = asyncio.get_running_loop()
+        transport, _ = await self.loop.create_datagram_endpoint(lambda: self.protocol, sock=self.sock)
+        self._ready.set()
+        try:
+            await asyncio.Future()
+        finally:
+            transport.close()
+
+    def start_in_thread(self):
+        """
+        Start serving on a new event loop in a daemon thread.
+
+        Returns:
+            The thread running the event loop
+        """
+        thread = threading.Thread(target=asyncio.run, args=(self.serve(),), daemon=True)
+        thread.start()
+        self._ready.wait()
+        return thread
+
+    def send_polling_update(self, polling_period_ms, anchor_ips):
+        """
+        Send a polling period update to all anchors. Safe to call from any thread.
+
+        Args:
+            polling_period_ms: Polling period in milliseconds
+            anchor_ips: List of (ip, port) tuples of the anchors
+        """
+        polling_message = json.dumps({"polling_period": polling_period_ms}).encode('utf-8')
+
+        def send():
+            for anchor_ip, anchor_port in anchor_ips:
+                self.protocol.transport.sendto(polling_message, (anchor_ip, anchor_port))
+
+        if self.protocol.transport is None:
+            for anchor_ip, anchor_port in anchor_ips:
+                self.sock.sendto(polling_message, (anchor_ip, anchor_port))
+        else:
+            self.loop.call_soon_threadsafe(send)
@@ -0,0 +1,256 @@
+import time
+
+import numpy as np
+
+from epoch_sync import DEFAULT_EPOCH_WINDOW, EpochSynchronizer
+from measurement_table import MeasurementTable
+from multilateration import MIN_ANCHORS, AnchorGeometry
+
+
+def select_readings(mask, tags, anchor_indices, distances, timestamps, sequences):
+    """
+    Keep the readings selected by `mask`. Timestamps may be a single time for
+    the whole batch and sequences may be None.
+    """
+    tags = np.asarray(tags)[mask]
+    anchor_indices = anchor_indices[mask]
+    distances = np.asarray(distances)[mask]
+    if np.ndim(timestamps):
+        timestamps = np.asarray(timestamps)[mask]
+    if sequences is not None:
+        sequences = np.asarray(sequences)[mask]
+    return tags, anchor_indices, distances, timestamps, sequences
+
+
+class LocationEngine:
+    """
+    Turns batches of decoded range readings into position fixes.
+
+    Readings are stored in the measurement table (latest distance per tag and
+    anchor) and grouped into epochs by the synchronizer. Each emitted epoch is
+    solved exactly once, so a tag gets one fix per polling round instead of
+    one per packet.
+
+    With a tracker, solved fixes are smoothed by its Kalman filter before they
+    are stored, and epochs with too few anchors for a fix (quorum below three)
+    update the tracker directly from their ranges.
+    """
+
+    def __init__(
+        self,
+        anchor_addresses,
+        anchor_positions,
+        epoch_window=DEFAULT_EPOCH_WINDOW,
+        quorum=MIN_ANCHORS,
+        tracker=None,
+        metrics=None,
+        calibration=None,
+        range_filter=None,
+        scheduler=None,
+        health=None,
+        refine=False,
+        anchor_selector=None,
+    ):
+        """
+        Args:
+            anchor_addresses: UWB addresses of the anchors
+            anchor_positions: Anchor coordinates (x, y, z) in cm, in the same order
+            epoch_window: Maximum spread in seconds of the readings of one epoch
+            quorum: Minimum number of anchors for an epoch to be used
+            tracker: Optional TagTracker smoothing the fixes
+            metrics: Optional ClientMetrics counting readings, solves and their latency
+            calibration: Optional CalibrationTable compiled for anchor_addresses,
+                correcting every distance before it is stored
+            range_filter: Optional HampelFilter rejecting outlying distances before they are stored
+            scheduler: Optional PollingScheduler that is told when anchors report and how fast tags move.
+                Epoch windows follow the polling periods it sends.
+            health: Optional AnchorHealth. Epochs stop waiting for anchors it marks degraded.
+            refine: Solve full 3D fixes with Gauss-Newton (see refine_positions),
+                warm-started from every tag's previous fix, instead of the closed form
+            anchor_selector: Optional GdopMap. Tags with a previous fix are solved
+                with the best anchor subset around it, when all of its anchors reported.
+        """
+        self.measurements = MeasurementTable(anchor_addresses)
+        self.synchronizer = EpochSynchronizer(len(anchor_addresses), epoch_window, quorum)
+        self.geometry = AnchorGeometry(anchor_positions)
+        self.anchor_positions = self.geometry.positions
+        self.tracker = tracker
+        self.metrics = metrics
+        self.calibration = calibration
+        self.range_filter = range_filter
+        self.scheduler = scheduler
+        self.health = health
+        self.refine = refine
+        self.anchor_selector = anchor_selector
+
+    def set_anchor_positions(self, anchor_positions):
+        """
+        Move the anchors (e.g. after a config reload). The cached solver
+        factorizations are rebuilt lazily for the new geometry.
+        """
+        self.geometry.set_positions(anchor_positions)
+        self.anchor_positions = self.geometry.positions
+        if self.anchor_selector is not None:
+            self.anchor_selector.move_anchors(self.anchor_positions)
+
+    def process_readings(self, tag_addresses, anchor_addresses, distances, timestamps=None, sequences=None):
+        """
+        Ingest a batch of readings and solve every epoch they complete.
+
+        Args:
+            tag_addresses: Array of tag addresses
+            anchor_addresses: Array of anchor addresses
+            distances: Array of distances in cm
+            timestamps: Receive times in seconds (array or scalar), defaults to time.monotonic()
+            sequences: Optional round numbers used to group readings into epochs
+
+        Returns:
+            Tuple (tag_indices, positions, valid) of the fixes produced
+        """
+        return self.solve_epochs(*self.add_readings(tag_addresses, anchor_addresses, distances, timestamps, sequences))
+
+    def add_readings(self, tag_addresses, anchor_addresses, distances, timestamps=None, sequences=None):
+        """
+        Filter and store a batch of readings (same arguments as process_readings)
+        and group them into epochs, without solving them. Earlier solves only
+        reach this through the polling periods sent in between
+        (PollingScheduler.due_updates), so when none are sent, as in a replay,
+        the epochs of many batches can be collected and solved later (see
+        batch_positions.py).
+
+        Returns:
+            Tuple (tag_indices, distances, epoch_times) of the epochs completed, see EpochSynchronizer.add
+        """
+        if timestamps is None:
+            timestamps = time.monotonic()
+        if self.metrics is not None and len(anchor_addresses):
+            self.metrics.readings_received.inc_many(anchor_addresses)
+        anchor_indices = self.measurements.anchor_indices(anchor_addresses)
+        known = anchor_indices >= 0
+        if not known.all():
+            tag_addresses, anchor_indices, distances, timestamps, sequences = select_readings(
+                known, tag_addresses, anchor_indices, distances, timestamps, sequences
+            )
+
+        if self.calibration is not None:
+            distances = self.calibration.correct(anchor_indices, distances)
+
+        tag_indices = self.measurements.tag_indices(tag_addresses)
+        # Outliers still show that the anchor is alive
+        if self.scheduler is not None:
+            self.scheduler.observe_readings(tag_indices, anchor_indices, timestamps)
+            # Epochs of tags whose anchors poll slowly span the whole polling period
+            self.synchronizer.set_windows(tag_indices, self.scheduler.epoch_windows(tag_indices, timestamps))
+        if self.health is not None:
+            self.health.observe(anchor_indices, timestamps, distances, self.measurements.distances[tag_indices, anchor_indices])
+            self.synchronizer.set_expected(self.health.healthy())
+        if self.range_filter is not None:
+            accepted = self.range_filter.update(tag_indices, anchor_indices, distances)
+            if not accepted.all():
+                if self.metrics is not None:
+                    self.metrics.range_outliers.inc_many(self.measurements.anchor_addresses[anchor_indices[~accepted]])
+                tag_indices, anchor_indices, distances, timestamps, sequences = select_readings(
+                    accepted, tag_indices, anchor_indices, distances, timestamps, sequences
+                )
+
+        if self.scheduler is not None:
+            self.scheduler.observe_ranges(tag_indices, anchor_indices, distances, timestamps)
+        self.measurements.store(tag_indices, anchor_indices, distances, timestamps)
+        return self.synchronizer.add(tag_indices, anchor_indices, distances, timestamps, sequences)
+
+    def flush(self, now=None):
+        """
+        Solve the epochs whose window expired without every anchor reporting.
+
+        Returns:
+            Tuple (tag_indices, positions, valid) of the fixes produced
+        """
+        return self.solve_epochs(*self.synchronizer.flush(time.monotonic() if now is None else now))
+
+    def check_health(self, now=None):
+        """
+        Mark anchors that went silent as degraded, so epochs stop waiting for them.
+
+        Returns:
+            Tuple (degraded, recovered) of anchor columns whose state changed, see AnchorHealth.check
+        """
+        empty = np.empty(0, dtype=np.int64)
+        if self.health is None:
+            return empty, empty
+        changes = self.health.check(time.monotonic() if now is None else now)
+        self.synchronizer.set_expected(self.health.healthy())
+        if self.anchor_selector is not None:
+            self.anchor_selector.set_online(self.health.healthy())
+        return changes
+
+    def select_anchors(self, tag_indices, distances):
+        """
+        Keep only the ranges of the best anchor subset near each tag's previous
+        fix, see GdopMap. Tags without a previous fix, or whose best subset
+        didn't fully report in this epoch, keep all their ranges.
+
+        Returns:
+            Distances with the ranges of the anchors that weren't selected set to NaN
+        """
+        tracked = np.flatnonzero(self.measurements.position_valid[tag_indices])
+        if not len(tracked):
+            return distances
+        selected, _ = self.anchor_selector.best_anchors(self.measurements.positions[tag_indices[tracked]])
+        reported = ~np.isnan(distances[tracked])
+        usable = selected.any(axis=1) & ~(selected & ~reported).any(axis=1)
+        rows = tracked[usable]
+        distances = distances.copy()
+        distances[rows] = np.where(selected[usable], distances[rows], np.nan)
+        return distances
+
+    def solve_epochs(self, tag_indices, distances, epoch_times):
+        """
+        Solve a set of epochs and record the valid fixes in the measurement table,
+        along with the number of anchor ranges each was solved from after anchor
+        selection (MeasurementTable.position_anchors).
+
+        Returns:
+            Tuple (tag_indices, positions, valid), with filtered positions when tracking
+        """
+        if self.anchor_selector is not None and len(tag_indices):
+            distances = self.select_anchors(tag_indices, distances)
+        anchors = np.count_nonzero(~np.isnan(distances), axis=1)
+        solvable = anchors >= MIN_ANCHORS
+        positions = np.full((len(tag_indices), 3), np.nan)
+        valid = np.zeros(len(tag_indices), dtype=bool)
+        covariances = residuals = None
+        start = time.perf_counter()
+        if self.refine:
+            rows = tag_indices[solvable]
+            initial = self.measurements.positions[rows]
+            initial[~self.measurements.position_valid[rows]] = np.nan
+            covariances = np.full((len(tag_indices), 3, 3), np.nan)
+            residuals = np.full(distances.shape, np.nan)
+            positions[solvable], valid[solvable], residuals[solvable], covariances[solvable] = self.geometry.refine(
+                distances[solvable], initial
+            )
+        else:
+            positions[solvable], valid[solvable] = self.geometry.solve(distances[solvable])
+        if self.metrics is not None and solvable.any():
+            self.metrics.solve_latency.observe(time.perf_counter() - start)
+            self.metrics.solves.inc(int(np.count_nonzero(solvable)))
+            self.metrics.degenerate_geometry.inc(int(np.count_nonzero(solvable & ~valid)))
+
+        if self.tracker is not None:
+            positions[valid] = self.tracker.update_positions(tag_indices[valid], positions[valid], epoch_times[valid])
+
+            # Epochs without a fix still refine tags that are already tracked
+            unsolved = np.flatnonzero(~valid)
+            updated, tracked_positions = self.tracker.update_ranges(
+                tag_indices[unsolved], distances[unsolved], self.anchor_positions, epoch_times[unsolved]
+            )
+            positions[unsolved[updated]] = tracked_positions[updated]
+            valid[unsolved[updated]] = True
+
+        if self.metrics is not None:
+            self.metrics.fixes.inc(int(np.count_nonzero(valid)))
+        if self.scheduler is not None and valid.any():
+            velocities = self.tracker.velocities(tag_indices[valid]) if self.tracker is not None else None
+            self.scheduler.observe_fixes(tag_indices[valid], positions[valid], epoch_times[valid], velocities)
+        self.measurements.store_positions(tag_indices, positions, valid, epoch_times, covariances, residuals, anchors)
+        return tag_indices, positions, valid
@@ -1,45 +1,87 @@
-import socket
+import argparse
+import asyncio
 import json
 import math
-import tkinter as tk
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-import matplotlib.patches as patches 
-import matplotlib.pyplot as plt
+import threading
+import time
+
+from ingest_server import IngestServer, bind_socket
+from measurement_table import DEFAULT_TAG_ADDRESS, MeasurementTable
+from anchor_health import AnchorHealth
+from metrics import DEFAULT_METRICS_PORT, ClientMetrics, MetricsServer, RateLimitedPrinter
+from polling_scheduler import PollingScheduler
+from tag_renderer import TagRenderer
 
 # default anchor positions
 anchor_1_position = (0, 0)
 anchor_2_position = (723, 0)
 
+# UWB addresses of the two anchors, in the same order as the anchor positions
+ANCHOR_ADDRESSES = [7, 8]
+
 # Server configuration
 UDP_IP = "0.0.0.0"  # Listen on all available interfaces
 UDP_PORT = 50000  # Match the port number used in the ESP32 code
 
-# Anchor addresses (example IPs and ports)
+# Anchor addresses (example IPs and ports), in the same order as ANCHOR_ADDRESSES
 ANCHOR_IPS = [("192.168.1.170", 50000), ("192.168.1.171", 50000), ("192.168.1.173", 50000)]
 
-# Create a UDP socket
-sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-sock.bind((UDP_IP, UDP_PORT))
+# Polling period the slider starts at, in milliseconds
+DEFAULT_POLLING_PERIOD_MS = 100
+
+# Seconds between two rounds of polling updates and anchor health checks
+UPDATE_INTERVAL = 0.1
+
+# UDP socket the anchors send to, bound by main() so importing this module has no side effects
+sock = None
+
+# Ingest server receiving on sock, created by main(). Polling updates are sent through it from either thread.
+ingest_server = None
+
+# GUI and plotting libraries, imported by load_gui() so --headless starts without them
+tk = None
+patches = None
+plt = None
+FigureCanvasTkAgg = None
+
+# Latest distance from every tag to every anchor, and the latest position of every tag
+measurements = MeasurementTable(ANCHOR_ADDRESSES)
+
+# Last seen time, report rate, jitter and range variance of every anchor. Anchors that went silent are left out of solves.
+health = AnchorHealth(ANCHOR_ADDRESSES)
 
-print(f"Listening for UDP packets on {UDP_IP}:{UDP_PORT}...")
+# Sends the polling period of the slider once it settles, and again to anchors that didn't apply it
+scheduler = PollingScheduler(len(ANCHOR_ADDRESSES))
 
-# Variables to store the latest distances
-distance_7 = None
-distance_8 = None
-latest_tag_position = None  # Variable to store the latest calculated tag position
+# Guards the state above, which the ingest thread updates while the Tk thread
+# draws it and runs the polling and health timers
+state_lock = threading.Lock()
 
+# Counters and histograms of the client, served in the Prometheus format on --metrics-port
+metrics = ClientMetrics()
 
-def calculate_tag_position(anchor1, anchor2, distance1, distance2):
+# Per-packet console output is off unless --verbose is given, and both are rate-limited
+packet_output = RateLimitedPrinter(enabled=False)
+error_output = RateLimitedPrinter()
+
+
+def calculate_tag_position(anchor1, anchor2, distance1, distance2, previous=None):
     """
     Calculate the position of a tag given two anchor points and distances.
+
+    Two ranges leave two solutions mirrored across the line through the
+    anchors. The one nearer the tag's previous fix is returned, since the
+    tag can't have crossed to the other side between two fixes.
+
     :param anchor1: Tuple (x, y) of the first anchor's position
     :param anchor2: Tuple (x, y) of the second anchor's position
     :param distance1: Distance from anchor1 to the tag
     :param distance2: Distance from anchor2 to the tag
+    :param previous: Optional (x, y) of the tag's previous fix
     :return: Tuple (x, y) of the tag's position, or None if no solution exists
     """
-    x1, y1 = anchor1
-    x2, y2 = anchor2
+    x1, y1 = anchor1[:2]
+    x2, y2 = anchor2[:2]
 
     try:
         # Calculate the x-coordinate
@@ -50,9 +92,10 @@ def calculate_tag_position(anchor1, anchor2, distance1, distance2):
         y1_candidate = y1 + y_term
         y2_candidate = y1 - y_term
 
-        # Choose the candidate that makes the most sense geometrically
-        mid_y = (y1_candidate + y2_candidate) / 2
-        y = y1_candidate if abs(y1_candidate - mid_y) < abs(y2_candidate - mid_y) else y2_candidate
+        # Stay on the side of the previous fix, tags without one start on the -y side
+        y = y2_candidate
+        if previous is not None and abs(y1_candidate - previous[1]) < abs(y2_candidate - previous[1]):
+            y = y1_candidate
 
         return x, y
     except ValueError:
@@ -61,38 +104,108 @@ def calculate_tag_position(anchor1, anchor2, distance1, distance2):
 
 
 def process_incoming_data(json_data, ui):
-    global distance_7, distance_8, latest_tag_position
-
     try:
         device_address = json_data.get("device_address")
         distance_str = json_data.get("distance")
         # Remove 'cm' from the string and convert it to float
         distance_value = float(distance_str.replace(" cm", "").strip())
+        tag_address = int(json_data.get("tag_address", DEFAULT_TAG_ADDRESS))
+
+        # Update the distance of the reporting anchor
+        anchor_index = measurements.anchor_index(int(device_address))
+        metrics.readings_received.inc(1, int(device_address))
+        if anchor_index < 0:
+            metrics.parse_failures.inc(1, "unknown_anchor")
+            return
+        with state_lock:
+            now = time.monotonic()
+            tag_index = measurements.tag_index(tag_address)
+            health.observe([anchor_index], now, [distance_value], [measurements.distances[tag_index, anchor_index]])
+            measurements.store([tag_index], [anchor_index], [distance_value], now)
+            scheduler.observe_readings([tag_index], [anchor_index], now)
+            packet_output(f"Anchor {device_address} distance updated to: {distance_value} cm")
+
+            # Attempt to calculate tag position if both distances are available. While an
+            # anchor is silent its last distance is stale, so no position is calculated.
+            distance_1, distance_2 = measurements.distances[tag_index]
+            if not math.isnan(distance_1) and not math.isnan(distance_2) and health.healthy().all():
+                # Without a UI (--headless) the anchors stay at their default positions
+                anchor1, anchor2 = (anchor_1_position, anchor_2_position) if ui is None else (
+                    ui.anchor_1_position, ui.anchor_2_position)
+                start = time.perf_counter()
+                tag_position = calculate_tag_position(
+                    anchor1, anchor2, distance_1, distance_2, measurements.latest_position(tag_address)
+                )
+                metrics.solve_latency.observe(time.perf_counter() - start)
+                metrics.solves.inc()
+
+                if tag_position:
+                    packet_output(f"Tag position calculated at: {tag_position}")
+                    metrics.fixes.inc()
+                    measurements.store_positions([tag_index], [(*tag_position, 0)], [True])
+                else:
+                    metrics.degenerate_geometry.inc()
+                    packet_output("No valid solution found for tag position.")
+    except Exception as e:
+        metrics.parse_failures.inc(1, "reading")
+        error_output(f"Error processing incoming JSON data: {e}")
+
 
-        # Update respective distances
-        if device_address == "7":
-            distance_7 = distance_value
-            print(f"Anchor 7 distance updated to: {distance_7} cm")
-        elif device_address == "8":
-            distance_8 = distance_value
-            print(f"Anchor 8 distance updated to: {distance_8} cm")
+def load_gui():
+    """
+    Import tkinter and matplotlib into the module globals the UI uses.
+    """
+    global tk, patches, plt, FigureCanvasTkAgg
+    import tkinter as tk
+    import matplotlib.patches as patches
+    import matplotlib.pyplot as plt
+    from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 
-        # Attempt to calculate tag position if both distances are available
-        if distance_7 is not None and distance_8 is not None:
-            # Define anchor positions (you can adjust these coordinates)
 
+def check_anchor_health():
+    """
+    Mark anchors that went silent as degraded and print the anchors that went down or came back.
+
+    Returns:
+        True if an anchor changed health
+    """
+    now = time.monotonic()
+    with state_lock:
+        degraded, recovered = health.check(now)
+        descriptions = [health.describe(anchor, now) for anchor in list(degraded) + list(recovered)]
+    for description in descriptions:
+        print(description)
+    return bool(len(degraded) or len(recovered))
 
-            tag_position = calculate_tag_position(
-                ui.anchor_1_position, ui.anchor_2_position, distance_7, distance_8
-            )
 
-            if tag_position:
-                print(f"Tag position calculated at: {tag_position}")
-                latest_tag_position = tag_position
-            else:
-                print("No valid solution found for tag position.")
-    except Exception as e:
-        print(f"Error processing incoming JSON data: {e}")
+def send_polling_updates():
+    """
+    Send the polling updates that are due, including resends to anchors that didn't apply one yet.
+    """
+    with state_lock:
+        updates = list(scheduler.due_updates(time.monotonic()))
+    for anchor_indices, polling_period in updates:
+        # The ingest server sends from its event loop, so this is safe from the Tk thread
+        ingest_server.send_polling_update(polling_period, [ANCHOR_IPS[anchor_index] for anchor_index in anchor_indices])
+        polling_message = json.dumps({"polling_period": polling_period})
+        print(f"Sent polling period update to {len(anchor_indices)} anchors: {polling_message}")
+
+
+async def run_headless(ingest_server):
+    """
+    Serve the ingest server with the polling and health timers of the UI, but without a UI.
+    """
+    async def run_timers():
+        while True:
+            await asyncio.sleep(UPDATE_INTERVAL)
+            send_polling_updates()
+            check_anchor_health()
+
+    timers = asyncio.create_task(run_timers())
+    try:
+        await ingest_server.serve()
+    finally:
+        timers.cancel()
 
 
 # Set up the UI with matplotlib integration
@@ -101,7 +214,7 @@ class TagPositionUI:
         self.master = master
         self.master.title("Tag Position UI Grid")
         self.latest_position = None
-        self.polling_period = 100  # Default polling period in milliseconds
+        self.polling_period = DEFAULT_POLLING_PERIOD_MS
 
         # Default anchor positions
         self.anchor_1_position = list(anchor_1_position)  # Use a mutable list
@@ -128,9 +241,8 @@ class TagPositionUI:
         # Create polling period slider
         self.create_polling_slider()
 
-        # References for dynamically plotted elements
-        self.current_tag_point = None
-        self.current_annotation = None
+        # Tags are blitted over the cached background instead of redrawing the whole figure
+        self.tag_renderer = TagRenderer(self.canvas, self.ax, metrics=metrics)
 
         # Call the update function periodically
         self.master.after(100, self.update_plot)
@@ -180,25 +292,29 @@ class TagPositionUI:
                 float(self.anchor_2_y_entry.get()),
             ]
 
-            # Redraw the background and anchors
-            self.ax.clear()
-            self.ax.set_xlim(-800, 800)
-            self.ax.set_ylim(-500, 2000)
-            self.ax.set_xlabel("X Coordinate")
-            self.ax.set_ylabel("Y Coordinate")
-            self.ax.grid()
-            self.draw_background_squares()
-
+            self.redraw_background()
             print(f"Anchor positions updated to: {self.anchor_1_position}, {self.anchor_2_position}")
-
-            # Redraw tag position if available
-            if latest_tag_position:
-                self.update_tag_position(latest_tag_position)
-
-            self.canvas.draw()
         except ValueError:
             print("Invalid input for anchor positions. Please enter numeric values.")
 
+    def redraw_background(self):
+        """
+        Redraw the background and anchors, e.g. after the anchors moved or one changed health.
+        """
+        self.ax.clear()
+        self.ax.set_xlim(-800, 800)
+        self.ax.set_ylim(-500, 2000)
+        self.ax.set_xlabel("X Coordinate")
+        self.ax.set_ylabel("Y Coordinate")
+        self.ax.grid()
+        self.draw_background_squares()
+
+        # Clearing the axes removed the tag artists, the full draw caches the new background
+        self.tag_renderer.reset()
+        self.canvas.draw()
+        with state_lock:
+            self.tag_renderer.update(measurements)
+
     def draw_background_squares(self):
         """
         Draw background squares that remain constant and act as a permanent background.
@@ -213,8 +329,10 @@ class TagPositionUI:
         # self.ax.add_patch(patches.Rectangle((100, 700), 275, 500, linewidth=0, edgecolor='brown', facecolor='brown', alpha=0.3))
         # self.ax.add_patch(patches.Rectangle((-200, 650), 200, 550, linewidth=0, edgecolor='orange', facecolor='orange', alpha=0.3))
 
-        # Redraw anchors
-        self.ax.plot(self.anchor_1_position[0], self.anchor_1_position[1], 'rs', markersize=10)
+        # Redraw anchors, degraded ones in black
+        with state_lock:
+            healthy = health.healthy()
+        self.ax.plot(self.anchor_1_position[0], self.anchor_1_position[1], 'rs' if healthy[0] else 'ks', markersize=10)
         self.ax.annotate(
             "Anchor 1",
             (self.anchor_1_position[0], self.anchor_1_position[1]),
@@ -222,7 +340,7 @@ class TagPositionUI:
             xytext=(5, -15),
             ha="center",
         )
-        self.ax.plot(self.anchor_2_position[0], self.anchor_2_position[1], 'rs', markersize=10)
+        self.ax.plot(self.anchor_2_position[0], self.anchor_2_position[1], 'rs' if healthy[1] else 'ks', markersize=10)
         self.ax.annotate(
             "Anchor 2",
             (self.anchor_2_position[0], self.anchor_2_position[1]),
@@ -248,83 +366,82 @@ class TagPositionUI:
         self.polling_slider.pack(fill=tk.X, expand=True)
 
     def update_polling_period(self, value):
+        # Dragging the slider calls this for every step, the scheduler only
+        # sends the value it settles on (see send_polling_updates)
         self.polling_period = int(value)
-        print(f"Polling period updated to: {self.polling_period} ms")
-
-        # Send the updated polling period to the anchors
-        polling_message = json.dumps({"polling_period": self.polling_period})
-        for anchor_ip, anchor_port in ANCHOR_IPS:
-            sock.sendto(polling_message.encode('utf-8'), (anchor_ip, anchor_port))
-        print(f"Sent polling period update to anchors: {polling_message}")
-
-    def update_tag_position(self, position):
-        """
-        Updates the red dot and its annotation for the tag position dynamically.
-        Clears the previous red dot and annotation if they exist.
-        """
-        # Remove the previous red dot and annotation if they exist
-        if self.current_tag_point:
-            self.current_tag_point.remove()
-            self.current_tag_point = None
-        if self.current_annotation:
-            self.current_annotation.remove()
-            self.current_annotation = None
-
-        # Plot new red dot
-        self.current_tag_point = self.ax.plot(position[0], -position[1], 'ro')[0]
-        # Add new annotation
-        self.current_annotation = self.ax.annotate(
-            f"Tag ({position[0]:.2f}, {position[1]:.2f})",
-            (position[0], -position[1]),
-            textcoords="offset points",
-            xytext=(5, 5),
-            ha="center",
-        )
+        with state_lock:
+            scheduler.set_fixed_period(self.polling_period)
 
     def update_plot(self):
         """
-        Periodically called to check for updates in the latest tag position and redraw the dynamic plot.
+        Periodically called to draw the latest tag positions. Only the tags are
+        blitted over the cached background, and only when a new fix arrived.
+        Polling updates that are due and anchor health checks run on the same timer.
         """
-        # Avoid clearing the permanent background - only draw dynamic elements
-        self.ax.set_xlim(-800, 800)
-        self.ax.set_ylim(-500, 2000)
-
-        # Redraw the tag position if available
-        if latest_tag_position:
-            self.update_tag_position(latest_tag_position)
-
-        # Redraw only the dynamic parts
-        self.canvas.draw()
-        self.master.after(100, self.update_plot)  # Reschedule this function
+        with state_lock:
+            self.tag_renderer.update(measurements)
+        send_polling_updates()
+        # Redraw the anchors when one went down or came back
+        if check_anchor_health():
+            self.redraw_background()
+        self.master.after(int(1000 * UPDATE_INTERVAL), self.update_plot)  # Reschedule this function
 
 
 # Main loop for receiving UDP packets and starting UI
 def main():
-    # Start Tkinter UI
-    root = tk.Tk()
-    ui = TagPositionUI(root)
-
-    # Thread or main loop for UDP listening
-    def udp_listener():
-        while True:
-            # Receive data from the ESP32
-            data, addr = sock.recvfrom(1024)  # Buffer size is 1024 bytes
-            ip, port = addr
+    parser = argparse.ArgumentParser(description="UWB tag position UI")
+    parser.add_argument("--verbose", action="store_true", help="print every packet and fix (rate-limited)")
+    parser.add_argument("--metrics-port", type=int, default=DEFAULT_METRICS_PORT,
+                        help=f"serve Prometheus metrics on this local port, 0 to disable (default: {DEFAULT_METRICS_PORT})")
+    parser.add_argument("--headless", action="store_true",
+                        help="receive and solve without the UI, tkinter and matplotlib aren't loaded")
+    args = parser.parse_args()
+    packet_output.enabled = args.verbose
+    if args.metrics_port:
+        try:
+            MetricsServer(metrics.registry, args.metrics_port).start()
+            print(f"Serving metrics on http://127.0.0.1:{args.metrics_port}/metrics")
+        except OSError as e:
+            print(f"Could not serve metrics on port {args.metrics_port}: {e}")
+
+    global sock, ingest_server
+    sock = bind_socket(UDP_IP, UDP_PORT)
+
+    ui = None
+    if not args.headless:
+        load_gui()
+        root = tk.Tk()
+        ui = TagPositionUI(root)
+
+    # Event loop for UDP listening, bursts of packets are handed over together
+    def handle_batch(datagrams):
+        for data, (ip, port) in datagrams:
             try:
                 # Decode and parse the JSON data
                 json_data = json.loads(data.decode('utf-8'))
-                print(f"Received from {ip}:{port}:\n{json.dumps(json_data, indent=4)}")
+                if packet_output.enabled:
+                    packet_output(f"Received from {ip}:{port}:\n{json.dumps(json_data, indent=4)}")
                 
                 # Process the data
                 process_incoming_data(json_data, ui)
 
-            except json.JSONDecodeError:
-                print("Invalid JSON received:")
-                print(data.decode('utf-8'))
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                metrics.parse_failures.inc(1, "json")
+                error_output(f"Invalid JSON received:\n{data.decode('utf-8', errors='replace')}")
 
-    import threading
-    listener_thread = threading.Thread(target=udp_listener, daemon=True)
-    listener_thread.start()
+    ingest_server = IngestServer(sock, handle_batch, metrics=metrics)
+    if args.headless:
+        # Anchors poll at the period the slider would start at
+        scheduler.set_fixed_period(DEFAULT_POLLING_PERIOD_MS)
+        try:
+            asyncio.run(run_headless(ingest_server))
+        except KeyboardInterrupt:
+            print("\nShutting down...")
+        finally:
+            sock.close()
+        return
+
+    ingest_server.start_in_thread()
 
     # Start the Tkinter mainloop
     root.mainloop()
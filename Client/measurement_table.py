@@ -0,0 +1,268 @@
+import time
+
+import numpy as np
+
+from multilateration import MIN_ANCHORS, refine_positions, solve_positions
+
+# UWB module addresses are 16-bit, so address -> index lookups are flat arrays
+ADDRESS_SPACE = 1 << 16
+
+# Address of the tag the anchors range against (AT+ANCHOR_SEND=9,... in Anchor.ino).
+# Anchor packets that don't name a tag are attributed to it.
+DEFAULT_TAG_ADDRESS = 9
+
+
+class MeasurementTable:
+    """
+    Array-backed table of the latest distance from every tag to every anchor.
+
+    Rows are tags and columns are anchors. Addresses are mapped to row/column
+    indices through flat lookup arrays, so single readings and whole batches
+    are stored without any per-packet dictionaries. Storage is preallocated
+    and doubles in size when more tags show up than it has room for.
+    """
+
+    def __init__(self, anchor_addresses, tag_capacity=64):
+        """
+        Args:
+            anchor_addresses: UWB addresses of the anchors, in column order
+            tag_capacity: Number of tag rows to preallocate
+        """
+        self.anchor_addresses = np.asarray(anchor_addresses, dtype=np.int64)
+        self.num_anchors = len(self.anchor_addresses)
+
+        self._anchor_lookup = np.full(ADDRESS_SPACE, -1, dtype=np.int32)
+        self._anchor_lookup[self.anchor_addresses] = np.arange(self.num_anchors, dtype=np.int32)
+        self._tag_lookup = np.full(ADDRESS_SPACE, -1, dtype=np.int32)
+
+        self.num_tags = 0
+        # Incremented whenever a fix is stored, so readers can tell nothing changed in O(1)
+        self.position_updates = 0
+        self._allocate(max(1, tag_capacity))
+
+    def _allocate(self, capacity):
+        """
+        Allocate (or grow) the per-tag arrays to hold `capacity` tags.
+        """
+        def grow(name, shape, fill, dtype):
+            new = np.full(shape, fill, dtype=dtype)
+            old = getattr(self, name, None)
+            if old is not None:
+                new[:self.num_tags] = old[:self.num_tags]
+            setattr(self, name, new)
+
+        self.capacity = capacity
+        grow("tag_addresses", capacity, -1, np.int64)
+        grow("distances", (capacity, self.num_anchors), np.nan, float)
+        grow("timestamps", (capacity, self.num_anchors), np.nan, float)
+        grow("positions", (capacity, 3), np.nan, float)
+        grow("position_valid", capacity, False, bool)
+        grow("position_timestamps", capacity, np.nan, float)
+        grow("position_covariances", (capacity, 3, 3), np.nan, float)
+        grow("position_residuals", (capacity, self.num_anchors), np.nan, float)
+        grow("position_anchors", capacity, 0, np.int64)
+
+    def anchor_index(self, anchor_address):
+        """
+        Returns:
+            Column index of the anchor, or -1 if it isn't part of the table
+        """
+        return int(self._anchor_lookup[anchor_address])
+
+    def tag_index(self, tag_address, create=True):
+        """
+        Look up the row of a tag, registering the tag if it is new.
+
+        Args:
+            tag_address: UWB address of the tag
+            create: Register unknown tags instead of returning -1
+
+        Returns:
+            Row index of the tag, or -1 if it is unknown and create is False
+        """
+        index = int(self._tag_lookup[tag_address])
+        if index < 0 and create:
+            index = self._register_tags(np.array([tag_address]))[0]
+        return index
+
+    def tag_indices(self, tag_addresses, create=True):
+        """
+        Vectorized version of tag_index for an array of tag addresses.
+        """
+        tag_addresses = np.asarray(tag_addresses, dtype=np.int64)
+        indices = self._tag_lookup[tag_addresses]
+        if create:
+            unknown = indices < 0
+            if unknown.any():
+                self._register_tags(np.unique(tag_addresses[unknown]))
+                indices = self._tag_lookup[tag_addresses]
+        return indices
+
+    def _register_tags(self, tag_addresses):
+        """
+        Assign rows to new tag addresses, growing the storage if needed.
+        """
+        needed = self.num_tags + len(tag_addresses)
+        if needed > self.capacity:
+            capacity = self.capacity
+            while capacity < needed:
+                capacity *= 2
+            self._allocate(capacity)
+
+        indices = np.arange(self.num_tags, needed, dtype=np.int32)
+        self.tag_addresses[indices] = tag_addresses
+        self._tag_lookup[tag_addresses] = indices
+        self.num_tags = needed
+        return indices
+
+    def update(self, tag_address, anchor_address, distance, timestamp=None):
+        """
+        Store a single distance reading.
+
+        Args:
+            tag_address: UWB address of the tag
+            anchor_address: UWB address of the anchor that measured the distance
+            distance: Distance in cm
+            timestamp: Receive time in seconds, defaults to time.monotonic()
+
+        Returns:
+            Row index of the tag, or -1 if the anchor is unknown
+        """
+        anchor = self._anchor_lookup[anchor_address]
+        if anchor < 0:
+            return -1
+
+        tag = self.tag_index(tag_address)
+        self.distances[tag, anchor] = distance
+        self.timestamps[tag, anchor] = time.monotonic() if timestamp is None else timestamp
+        return tag
+
+    def update_many(self, tag_addresses, anchor_addresses, distances, timestamps=None):
+        """
+        Store a batch of distance readings in one vectorized scatter.
+
+        When the same (tag, anchor) pair appears more than once, the last
+        reading in the batch wins, just like calling update() in order.
+
+        Args:
+            tag_addresses: Array of tag addresses
+            anchor_addresses: Array of anchor addresses
+            distances: Array of distances in cm
+            timestamps: Array of receive times in seconds, or a single time for the whole batch
+
+        Returns:
+            Array with the row index of every tag that received a reading
+        """
+        anchors = self.anchor_indices(anchor_addresses)
+        known = anchors >= 0
+        if not known.all():
+            anchors = anchors[known]
+            tag_addresses = np.asarray(tag_addresses)[known]
+            distances = np.asarray(distances)[known]
+            if timestamps is not None and np.ndim(timestamps):
+                timestamps = np.asarray(timestamps)[known]
+
+        tags = self.tag_indices(tag_addresses)
+        self.store(tags, anchors, distances, timestamps)
+        return np.unique(tags)
+
+    def anchor_indices(self, anchor_addresses):
+        """
+        Vectorized version of anchor_index for an array of anchor addresses.
+        """
+        return self._anchor_lookup[np.asarray(anchor_addresses, dtype=np.int64)]
+
+    def store(self, tag_indices, anchor_indices, distances, timestamps=None):
+        """
+        Store readings whose addresses were already mapped to rows and columns.
+        """
+        self.distances[tag_indices, anchor_indices] = distances
+        self.timestamps[tag_indices, anchor_indices] = time.monotonic() if timestamps is None else timestamps
+
+    def complete_tags(self, min_anchors=MIN_ANCHORS, anchors=None):
+        """
+        Args:
+            anchors: Optional boolean mask of the anchors to count, e.g. AnchorHealth.healthy()
+
+        Returns:
+            Row indices of the tags with a distance from at least `min_anchors` anchors
+        """
+        present = ~np.isnan(self.distances[:self.num_tags])
+        if anchors is not None:
+            present &= anchors
+        counts = np.count_nonzero(present, axis=1)
+        return np.flatnonzero(counts >= min_anchors)
+
+    def store_positions(self, tag_indices, positions, valid, timestamp=None, covariances=None, residuals=None,
+                        anchors=None):
+        """
+        Record solved positions for a set of tag rows.
+
+        Invalid fixes are dropped so every tag keeps its last valid position.
+
+        Args:
+            timestamp: Time of the fixes in seconds (array or scalar), defaults to time.monotonic()
+            covariances: Optional (K, 3, 3) covariances of the fixes, see refine_positions
+            residuals: Optional (K, N) range residuals of the fixes
+            anchors: Optional (K,) number of anchor ranges each fix was solved from
+        """
+        solved = np.asarray(tag_indices)[valid]
+        if np.ndim(timestamp):
+            timestamp = np.asarray(timestamp)[valid]
+        self.positions[solved] = np.asarray(positions)[valid]
+        if covariances is not None:
+            self.position_covariances[solved] = np.asarray(covariances)[valid]
+        if residuals is not None:
+            self.position_residuals[solved] = np.asarray(residuals)[valid]
+        if anchors is not None:
+            self.position_anchors[solved] = np.asarray(anchors)[valid]
+        self.position_valid[solved] = True
+        self.position_timestamps[solved] = time.monotonic() if timestamp is None else timestamp
+        self.position_updates += len(solved)
+
+    def solve(self, anchor_positions, tag_indices=None, anchors=None, refine=False):
+        """
+        Solve the positions of a set of tags from their latest distances.
+
+        Args:
+            anchor_positions: Array of shape (N, 2) or (N, 3) in the table's anchor order,
+                or an AnchorGeometry with cached factorizations
+            tag_indices: Rows to solve, defaults to every tag with enough anchors
+            anchors: Optional boolean mask of the anchors to use, the distances
+                of the others are ignored (e.g. anchors that went silent)
+            refine: Solve full 3D positions with refine_positions, starting
+                every tag from its last valid fix
+
+        Returns:
+            Tuple (tag_indices, positions, valid) for the rows that were solved
+        """
+        if tag_indices is None:
+            tag_indices = self.complete_tags(anchors=anchors)
+        tag_indices = np.asarray(tag_indices, dtype=np.int64)
+
+        distances = self.distances[tag_indices]
+        if anchors is not None:
+            distances[:, ~np.asarray(anchors, dtype=bool)] = np.nan
+        counts = np.count_nonzero(~np.isnan(distances), axis=1)
+        if refine:
+            initial = self.positions[tag_indices]
+            initial[~self.position_valid[tag_indices]] = np.nan
+            positions, valid, residuals, covariances = refine_positions(distances, anchor_positions, initial)
+            self.store_positions(tag_indices, positions, valid, covariances=covariances, residuals=residuals,
+                                 anchors=counts)
+            return tag_indices, positions, valid
+
+        positions, valid = solve_positions(distances, anchor_positions)
+        self.store_positions(tag_indices, positions, valid, anchors=counts)
+        return tag_indices, positions, valid
+
+    def latest_position(self, tag_address):
+        """
+        Returns:
+            Tuple (x, y, z) of the last valid fix of the tag, or None if it has none
+        """
+        tag = self._tag_lookup[tag_address]
+        if tag < 0 or not self.position_valid[tag]:
+            return None
+        x, y, z = self.positions[tag]
+        return x, y, z
@@ -0,0 +1,397 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+# Default port of the metrics endpoint (http://127.0.0.1:9108/metrics)
+DEFAULT_METRICS_PORT = 9108
+
+# Latency buckets in seconds, from 50 us to 1 s
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+# Buckets for counts of datagrams or epochs waiting to be processed
+QUEUE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+# Maximum number of per-packet console lines printed per second
+DEFAULT_PRINT_RATE = 10
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == np.inf:
+        return "+Inf"
+    if value == -np.inf:
+        return "-Inf"
+    if value != value:
+        return "NaN"
+    return repr(float(value))
+
+
+class Counter:
+    """
+    Monotonically increasing count, optionally split by one or more labels.
+
+    Updates take a lock, since main.py and ui_test.py update metrics from
+    both their ingest thread and the Tk thread. Scrapes don't, and can at
+    worst see a value that is one update behind.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {} if labelnames else {(): 0}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, *labelvalues):
+        """
+        Add `amount` to the count of the given label values.
+        """
+        with self.lock:
+            self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def inc_many(self, labelvalues, amounts=None):
+        """
+        Add to the counts of an array of values of the (single) label at once.
+
+        Args:
+            labelvalues: Array with one label value per event
+            amounts: Optional array with the amount of every event, defaults to 1
+        """
+        values, inverse = np.unique(labelvalues, return_inverse=True)
+        totals = np.bincount(inverse, weights=amounts, minlength=len(values))
+        for value, total in zip(values.tolist(), totals.tolist()):
+            self.inc(int(total) if amounts is None else total, value)
+
+    def get(self, *labelvalues):
+        return self.values.get(labelvalues, 0)
+
+    def samples(self):
+        for labelvalues, value in list(self.values.items()):
+            yield self.name + "_total", _format_labels(self.labelnames, labelvalues), value
+
+    def snapshot(self):
+        if not self.labelnames:
+            return self.values[()]
+        return {labelvalues if len(labelvalues) > 1 else labelvalues[0]: value for labelvalues, value in list(self.values.items())}
+
+
+class Gauge:
+    """
+    Value that can go up and down. A gauge can also read its value from a
+    function at scrape time, which costs nothing on the hot path. A gauge
+    with a label reads all its values at once from a function returning a
+    dict from label value to value.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, function=None, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        self.labelnames = tuple(labelnames)
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        return self.function() if self.function is not None else self.value
+
+    def samples(self):
+        if not self.labelnames:
+            yield self.name, "", self.get()
+            return
+        for labelvalue, value in self.get().items():
+            yield self.name, _format_labels(self.labelnames, (labelvalue,)), value
+
+    def snapshot(self):
+        return self.get()
+
+
+class Histogram:
+    """
+    Distribution of observed values over fixed buckets.
+
+    Bucket counts are a numpy array, so a whole array of observations is
+    added with one searchsorted and one bincount. Like counters, updates
+    take a lock.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = np.asarray(sorted(buckets), dtype=float)
+        # The last slot counts observations above the largest bucket
+        self.counts = np.zeros(len(self.buckets) + 1, dtype=np.int64)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        bucket = np.searchsorted(self.buckets, value)
+        with self.lock:
+            self.counts[bucket] += 1
+            self.sum += value
+
+    def observe_many(self, values):
+        values = np.asarray(values, dtype=float).ravel()
+        if len(values):
+            counts = np.bincount(np.searchsorted(self.buckets, values), minlength=len(self.counts))
+            with self.lock:
+                self.counts += counts
+                self.sum += float(values.sum())
+
+    def time(self):
+        """
+        Context manager observing the time spent in its block, in seconds.
+        """
+        return _Timer(self)
+
+    @property
+    def count(self):
+        return int(self.counts.sum())
+
+    def quantile(self, q):
+        """
+        Returns:
+            Upper bound of the bucket holding the q-quantile, or NaN without observations
+        """
+        counts = self.counts.copy()
+        total = counts.sum()
+        if total == 0:
+            return np.nan
+        index = int(np.searchsorted(np.cumsum(counts), q * total))
+        return float(self.buckets[index]) if index < len(self.buckets) else np.inf
+
+    def samples(self):
+        counts = self.counts.copy()
+        cumulative = np.cumsum(counts)
+        bounds = list(self.buckets) + [np.inf]
+        for bound, count in zip(bounds, cumulative.tolist()):
+            yield self.name + "_bucket", _format_labels((), (), [("le", _format_value(bound))]), count
+        yield self.name + "_sum", "", self.sum
+        yield self.name + "_count", "", int(cumulative[-1])
+
+    def snapshot(self):
+        return {"count": self.count, "sum": self.sum, "p50": self.quantile(0.5), "p99": self.quantile(0.99)}
+
+
+class _Timer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class MetricsRegistry:
+    """
+    Set of named metrics, readable as a dict or in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+
+    def _register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, function=None, labelnames=()):
+        return self._register(Gauge(name, documentation, function, labelnames))
+
+    def histogram(self, name, documentation, buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, documentation, buckets))
+
+    def snapshot(self):
+        """
+        Returns:
+            Dict from metric name to its current value (a number, a dict of
+            label values to numbers, or a histogram summary)
+        """
+        return {name: metric.snapshot() for name, metric in list(self.metrics.items())}
+
+    def render(self):
+        """
+        Returns:
+            All metrics in the Prometheus text exposition format
+        """
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class ClientMetrics:
+    """
+    The metrics of the location client, on a registry of their own.
+
+    Components take an optional ClientMetrics and skip all instrumentation
+    when they don't get one.
+    """
+
+    def __init__(self, registry=None):
+        self.registry = MetricsRegistry() if registry is None else registry
+        r = self.registry
+        self.datagrams_received = r.counter("uwb_datagrams_received", "UDP datagrams received")
+        self.readings_received = r.counter("uwb_readings_received", "Range readings received per anchor", ["anchor"])
+        self.parse_failures = r.counter("uwb_parse_failures", "Datagrams or readings that could not be parsed", ["reason"])
+        self.range_outliers = r.counter("uwb_range_outliers", "Ranges rejected by the outlier filter per anchor", ["anchor"])
+        self.solves = r.counter("uwb_solves", "Epochs handed to the position solver")
+        self.fixes = r.counter("uwb_fixes", "Valid position fixes produced")
+        self.degenerate_geometry = r.counter("uwb_degenerate_geometry", "Solves rejected for collinear or rank-deficient anchors")
+        self.polling_updates = r.counter("uwb_polling_updates", "Polling period updates sent per anchor", ["anchor"])
+        self.fixes_published = r.counter("uwb_published_fixes", "Fixes sent to subscribers, after coalescing per tag")
+        self.subscribers_dropped = r.counter("uwb_subscribers_dropped", "Subscribers disconnected for falling behind")
+        self.zone_events = r.counter("uwb_zone_events", "Zone enter, exit and dwell events", ["kind"])
+        self.solve_latency = r.histogram("uwb_solve_latency_seconds", "Time to solve one batch of epochs")
+        self.batch_latency = r.histogram("uwb_batch_latency_seconds", "Time to process one burst of datagrams")
+        self.queue_depth = r.histogram("uwb_ingest_queue_depth", "Datagrams waiting in the socket per wakeup", QUEUE_BUCKETS)
+        self.ui_frame_time = r.histogram("uwb_ui_frame_seconds", "Time to render one UI frame with new fixes")
+
+    def bind_engine(self, engine):
+        """
+        Expose the synchronizer counters and open epoch count of a LocationEngine as gauges.
+        """
+        synchronizer = engine.synchronizer
+        r = self.registry
+        r.gauge("uwb_open_epochs", "Epochs waiting for more anchors",
+                lambda: int(np.count_nonzero(~np.isnan(synchronizer.epoch_start))))
+        r.gauge("uwb_tags", "Tags seen", lambda: engine.measurements.num_tags)
+        for name in ("epochs_emitted", "epochs_incomplete", "epochs_dropped", "readings_dropped", "readings_stale", "readings_replaced"):
+            r.gauge(f"uwb_{name}", f"Epoch synchronizer {name.replace('_', ' ')}",
+                    lambda name=name: getattr(synchronizer, name))
+
+    def bind_publisher(self, publisher):
+        """
+        Expose the subscriber count of a PositionPublisher as a gauge.
+        """
+        self.registry.gauge("uwb_subscribers", "Connected position subscribers", lambda: len(publisher.subscribers))
+
+    def bind_history(self, history):
+        """
+        Expose the row counters of a PositionHistory as gauges.
+        """
+        for name in ("rows_written", "rows_dropped"):
+            self.registry.gauge(f"uwb_history_{name}", f"Position history {name.replace('_', ' ')}",
+                                lambda name=name: getattr(history, name))
+
+    def bind_health(self, health):
+        """
+        Expose the liveness and signal statistics of an AnchorHealth as gauges per anchor.
+        """
+        r = self.registry
+        addresses = health.anchor_addresses.tolist()
+
+        def per_anchor(values):
+            return lambda: dict(zip(addresses, values().tolist()))
+
+        r.gauge("uwb_anchor_healthy", "1 while the anchor reports, 0 once it is degraded",
+                per_anchor(lambda: health.healthy().astype(int)), ["anchor"])
+        r.gauge("uwb_anchor_last_seen_seconds", "Seconds since the anchor last reported",
+                per_anchor(lambda: time.monotonic() - health.last_seen), ["anchor"])
+        r.gauge("uwb_anchor_reading_rate", "Smoothed readings per second of the anchor",
+                per_anchor(lambda: health.reading_rate), ["anchor"])
+        r.gauge("uwb_anchor_jitter_seconds", "Standard deviation of the time between the anchor's reports",
+                per_anchor(lambda: np.sqrt(health.interval_var)), ["anchor"])
+        r.gauge("uwb_anchor_range_variance", "Variance of the anchor's ranges in cm^2",
+                per_anchor(lambda: health.range_variance), ["anchor"])
+        r.gauge("uwb_anchor_degradations", "Times the anchor went silent",
+                per_anchor(lambda: health.degradations), ["anchor"])
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = None
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes would otherwise print a line each
+        pass
+
+
+class MetricsServer:
+    """
+    Serves a registry at http://host:port/metrics from a daemon thread.
+    """
+
+    def __init__(self, registry, port=DEFAULT_METRICS_PORT, host="127.0.0.1"):
+        handler = type("MetricsHandler", (_MetricsHandler,), {"registry": registry})
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def address(self):
+        return self.httpd.server_address
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class RateLimitedPrinter:
+    """
+    Console output for per-packet messages that can be switched off and is
+    capped at a number of lines per second. Dropped lines are counted and
+    reported with the next line that gets through.
+    """
+
+    def __init__(self, enabled=True, max_per_second=DEFAULT_PRINT_RATE):
+        self.enabled = enabled
+        self.max_per_second = max_per_second
+        self.window_start = 0.0
+        self.printed = 0
+        self.suppressed = 0
+
+    def __call__(self, message):
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        if now - self.window_start >= 1.0:
+            self.window_start = now
+            self.printed = 0
+        if self.printed >= self.max_per_second:
+            self.suppressed += 1
+            return
+        if self.suppressed:
+            print(f"({self.suppressed} messages suppressed)")
+            self.suppressed = 0
+        self.printed += 1
+        print(message)
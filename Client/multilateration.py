@@ -0,0 +1,373 @@
+import numpy as np
+
+# Minimum number of anchors needed for a planar (x, y) fix
+MIN_ANCHORS = 3
+
+# Smallest allowed ratio between the smallest and largest singular value of the
+# anchor matrix. Below this the anchors are (nearly) collinear and the fix is
+# meaningless, so the affected rows are reported as degenerate.
+DEGENERATE_RCOND = 1e-9
+
+# Height in cm refinement starts from for tags without a previous fix. With all
+# anchors at about the same height, the side of the anchor plane a tag starts
+# on is the side it ends up on.
+DEFAULT_TAG_HEIGHT = 100.0
+
+# Gauss-Newton iterations per refinement, and the step in cm below which a tag has converged
+MAX_ITERATIONS = 10
+CONVERGENCE_TOLERANCE = 0.1
+
+# Initial Levenberg-Marquardt damping, relative to the diagonal of J^T J
+INITIAL_DAMPING = 1e-3
+
+# Range noise in cm assumed for the covariance of fixes without redundant ranges
+DEFAULT_RANGE_STD = 10.0
+
+# Added to the diagonal of J^T J before inverting it, so unobservable directions
+# (e.g. z in the plane of coplanar anchors) get a huge variance instead of a singular matrix
+COVARIANCE_RIDGE = 1e-9
+
+
+def build_anchor_matrix(anchor_positions):
+    """
+    Build the anchor-only part of the linearized range equations.
+
+    Every range equation |p - a_i|^2 = d_i^2 is rewritten as
+        -2*a_ix*x - 2*a_iy*y + (x^2 + y^2) = d_i^2 - a_ix^2 - a_iy^2
+    which is linear in the unknowns (x, y, x^2 + y^2).
+
+    Args:
+        anchor_positions: Array of shape (N, 2) or (N, 3) with anchor coordinates in cm
+
+    Returns:
+        Tuple (A, anchor_norms) where A has shape (N, 3) and anchor_norms holds
+        a_ix^2 + a_iy^2 for every anchor
+    """
+    anchors = np.asarray(anchor_positions, dtype=float)
+    A = np.empty((anchors.shape[0], 3))
+    A[:, 0] = -2 * anchors[:, 0]
+    A[:, 1] = -2 * anchors[:, 1]
+    A[:, 2] = 1.0
+    anchor_norms = anchors[:, 0]**2 + anchors[:, 1]**2
+    return A, anchor_norms
+
+
+class AnchorGeometry:
+    """
+    Anchor positions with the anchor-only part of the least-squares system cached.
+
+    For every subset of anchors that reported, the pseudo-inverse of the
+    subset's anchor matrix is computed once (by SVD, which also tells whether
+    the subset is degenerate) and reused, so solving a group of tags is a
+    single (3, k) x (k, M) product. The cache is dropped only when the anchors
+    move (set_positions).
+    """
+
+    def __init__(self, anchor_positions):
+        """
+        Args:
+            anchor_positions: Array of shape (N, 2) or (N, 3) with anchor coordinates in cm
+        """
+        self.set_positions(anchor_positions)
+
+    def set_positions(self, anchor_positions):
+        """
+        Replace the anchor positions and invalidate every cached factorization.
+        """
+        self.positions = np.asarray(anchor_positions, dtype=float)
+        self.num_anchors = self.positions.shape[0]
+        self.A, self.anchor_norms = build_anchor_matrix(self.positions)
+        self.anchor_z = self.positions[:, 2] if self.positions.shape[1] > 2 else np.zeros(self.num_anchors)
+        self._subsets = {}
+
+    def subset_solver(self, subset):
+        """
+        Factorization of the anchor matrix of a subset of anchors.
+
+        Args:
+            subset: Boolean mask of the anchors that reported
+
+        Returns:
+            Tuple (pseudo_inverse, z) with the (3, k) pseudo-inverse and the mean
+            anchor height of the subset, or None if the subset can't give a fix
+        """
+        key = subset.tobytes()
+        try:
+            return self._subsets[key]
+        except KeyError:
+            pass
+
+        solver = None
+        if np.count_nonzero(subset) >= MIN_ANCHORS:
+            U, singular_values, Vt = np.linalg.svd(self.A[subset], full_matrices=False)
+            if singular_values[-1] >= DEGENERATE_RCOND * singular_values[0]:
+                solver = (Vt.T @ (U.T / singular_values[:, None]), self.anchor_z[subset].mean())
+        self._subsets[key] = solver
+        return solver
+
+    def solve(self, distances):
+        """
+        Solve the positions of many tags at once, see solve_positions.
+        """
+        distances = np.atleast_2d(np.asarray(distances, dtype=float))
+        num_tags, num_anchors = distances.shape
+        if num_anchors != self.num_anchors:
+            raise ValueError(f"Expected {self.num_anchors} anchor distances, got {num_anchors}")
+
+        positions = np.full((num_tags, 3), np.nan)
+        valid = np.zeros(num_tags, dtype=bool)
+        if num_tags == 0:
+            return positions, valid
+
+        for subset, rows in subset_groups(~np.isnan(distances)):
+            solver = self.subset_solver(subset)
+            if solver is None:
+                continue
+            pseudo_inverse, z = solver
+
+            # Right-hand side for every tag in the group, one column per tag
+            B = distances[rows][:, subset].T**2 - self.anchor_norms[subset, None]
+            # Summed one anchor at a time rather than by BLAS, which rounds a
+            # product with one tag differently than one with many. A tag's fix
+            # then doesn't depend on the tags it is solved with.
+            solution = pseudo_inverse[:, :1] * B[:1]
+            for i in range(1, len(B)):
+                solution += pseudo_inverse[:, i:i + 1] * B[i:i + 1]
+
+            positions[rows, 0] = solution[0]
+            positions[rows, 1] = solution[1]
+            positions[rows, 2] = z
+            valid[rows] = np.isfinite(solution[:2]).all(axis=0)
+
+        positions[~valid] = np.nan
+        return positions, valid
+
+    def refine(self, distances, initial=None, tag_height=DEFAULT_TAG_HEIGHT):
+        """
+        Solve full (x, y, z) positions by minimizing the range residuals, see refine_positions.
+        """
+        distances = np.atleast_2d(np.asarray(distances, dtype=float))
+        num_tags = len(distances)
+        present = ~np.isnan(distances)
+
+        # Anchor subsets without a closed-form fix (too few or collinear anchors) don't get one here either
+        solvable = np.zeros(num_tags, dtype=bool)
+        for subset, rows in subset_groups(present):
+            solvable[rows] = self.subset_solver(subset) is not None
+
+        # Tags without a previous fix start from the closed form at tag_height
+        positions = np.full((num_tags, 3), np.nan) if initial is None else np.array(initial, dtype=float)
+        cold = solvable & np.isnan(positions).any(axis=1)
+        if cold.any():
+            positions[cold], _ = self.solve(distances[cold])
+            positions[cold, 2] = tag_height
+
+        anchors = np.zeros((self.num_anchors, 3))
+        anchors[:, :self.positions.shape[1]] = self.positions
+        rows = np.flatnonzero(solvable & np.isfinite(positions).all(axis=1))
+        residuals = np.full(distances.shape, np.nan)
+        covariances = np.full((num_tags, 3, 3), np.nan)
+        if len(rows):
+            positions[rows], residuals[rows], covariances[rows] = gauss_newton(
+                distances[rows], present[rows], anchors, positions[rows]
+            )
+
+        valid = np.zeros(num_tags, dtype=bool)
+        valid[rows] = np.isfinite(positions[rows]).all(axis=1)
+        positions[~valid] = np.nan
+        return positions, valid, residuals, covariances
+
+
+def subset_groups(present):
+    """
+    Group rows by which anchors reported, so each group shares one anchor subset.
+
+    Args:
+        present: Boolean array (M, N), True where a tag has a distance to an anchor
+
+    Returns:
+        List of (subset, rows) with the boolean anchor mask and the rows using it
+    """
+    if present.all():
+        return [(present[0], slice(None))] if len(present) else []
+    subsets, subset_of_row = np.unique(present, axis=0, return_inverse=True)
+    subset_of_row = subset_of_row.reshape(-1)
+    return [(subset, np.flatnonzero(subset_of_row == i)) for i, subset in enumerate(subsets)]
+
+
+def solve_symmetric3(xx, yy, zz, xy, xz, yz, bx, by, bz):
+    """
+    Solve many symmetric 3x3 systems [[xx, xy, xz], [xy, yy, yz], [xz, yz, zz]] p = b
+    by cofactors, elementwise on arrays of equal shape.
+
+    Returns:
+        Tuple (px, py, pz) and the six entries of the inverses in the same order as the matrix
+    """
+    c_xx = yy * zz - yz * yz
+    c_yy = xx * zz - xz * xz
+    c_zz = xx * yy - xy * xy
+    c_xy = xz * yz - xy * zz
+    c_xz = xy * yz - xz * yy
+    c_yz = xy * xz - xx * yz
+    det = xx * c_xx + xy * c_xy + xz * c_xz
+    with np.errstate(divide="ignore", invalid="ignore"):
+        inverse = tuple(c / det for c in (c_xx, c_yy, c_zz, c_xy, c_xz, c_yz))
+    i_xx, i_yy, i_zz, i_xy, i_xz, i_yz = inverse
+    solution = (
+        i_xx * bx + i_xy * by + i_xz * bz,
+        i_xy * bx + i_yy * by + i_yz * bz,
+        i_xz * bx + i_yz * by + i_zz * bz,
+    )
+    return solution, inverse
+
+
+def gauss_newton(distances, present, anchors, positions):
+    """
+    Batched Levenberg-Marquardt on the range equations |p - a_i| = d_i.
+
+    The normal equations are only 3x3, so they are accumulated and solved by
+    cofactors one coordinate at a time, instead of as stacks of small
+    matrices. Per-anchor arrays are kept as (N, K), so every sum over the
+    anchors is N - 1 vector additions over all tags. Every tag has its own
+    damping, and tags leave the working set once their step is below
+    CONVERGENCE_TOLERANCE, so a warm start near the answer costs one or two passes.
+
+    Args:
+        distances: Array (M, N) of ranges in cm
+        present: Boolean array (M, N), False where a range is missing
+        anchors: Array (N, 3) of anchor positions in cm
+        positions: Array (M, 3) of starting positions
+
+    Returns:
+        Tuple (positions, residuals, covariances): the refined positions,
+        the range residuals (measured minus predicted, NaN where missing) and
+        the (M, 3, 3) covariance of every position
+    """
+    ax, ay, az = anchors.T[:, :, None]
+    num_tags = len(positions)
+    result = positions.copy()
+    residuals = np.zeros((len(anchors), num_tags))
+    normal = np.zeros((6, num_tags))
+    cost = np.zeros(num_tags)
+
+    def linearize(x, y, z, d, w):
+        # Residuals and the unit vectors from the anchors, which are the Jacobian rows
+        dx = x - ax
+        dy = y - ay
+        dz = z - az
+        ranges = np.maximum(np.sqrt(dx * dx + dy * dy + dz * dz), 1e-6)
+        scale = w / ranges
+        r = (d - ranges) * w
+        return r, dx * scale, dy * scale, dz * scale, (r * r).sum(axis=0)
+
+    # Working set: the tags that haven't converged, compacted as tags finish
+    rows = np.arange(num_tags)
+    w = present.T.astype(float)
+    d = np.where(present, distances, 0.0).T
+    x, y, z = (positions[:, i].copy() for i in range(3))
+    r, ux, uy, uz, c = linearize(x, y, z, d, w)
+    damping = np.full(num_tags, INITIAL_DAMPING)
+
+    for iteration in range(MAX_ITERATIONS):
+        xx, yy, zz = (ux * ux).sum(axis=0), (uy * uy).sum(axis=0), (uz * uz).sum(axis=0)
+        xy, xz, yz = (ux * uy).sum(axis=0), (ux * uz).sum(axis=0), (uy * uz).sum(axis=0)
+        (sx, sy, sz), _ = solve_symmetric3(
+            xx + damping * np.maximum(xx, 1.0), yy + damping * np.maximum(yy, 1.0),
+            zz + damping * np.maximum(zz, 1.0), xy, xz, yz,
+            (ux * r).sum(axis=0), (uy * r).sum(axis=0), (uz * r).sum(axis=0),
+        )
+
+        # Keep a step only if it lowers the squared residuals, otherwise retry with more damping
+        cr, cux, cuy, cuz, cc = linearize(x + sx, y + sy, z + sz, d, w)
+        improved = cc <= c
+        x, y, z = np.where(improved, x + sx, x), np.where(improved, y + sy, y), np.where(improved, z + sz, z)
+        r, ux, uy, uz = (np.where(improved, new, old) for new, old in ((cr, r), (cux, ux), (cuy, uy), (cuz, uz)))
+        c = np.where(improved, cc, c)
+        damping = np.where(improved, damping * 0.3, damping * 10)
+
+        done = sx * sx + sy * sy + sz * sz < CONVERGENCE_TOLERANCE**2
+        if iteration == MAX_ITERATIONS - 1:
+            done[:] = True
+        if done.any():
+            finished = rows[done]
+            result[finished] = np.stack([x[done], y[done], z[done]], axis=1)
+            residuals[:, finished] = r[:, done]
+            normal[:, finished] = np.stack([xx, yy, zz, xy, xz, yz])[:, done]
+            cost[finished] = c[done]
+            keep = ~done
+            if not keep.any():
+                break
+            rows, x, y, z, c, damping = rows[keep], x[keep], y[keep], z[keep], c[keep], damping[keep]
+            r, ux, uy, uz, d, w = r[:, keep], ux[:, keep], uy[:, keep], uz[:, keep], d[:, keep], w[:, keep]
+
+    # Range variance from the residuals where there are more ranges than unknowns
+    counts = present.sum(axis=1)
+    redundant = counts > 3
+    variance = np.full(num_tags, DEFAULT_RANGE_STD**2)
+    variance[redundant] = cost[redundant] / (counts[redundant] - 3)
+
+    xx, yy, zz, xy, xz, yz = normal
+    zeros = np.zeros(num_tags)
+    _, (i_xx, i_yy, i_zz, i_xy, i_xz, i_yz) = solve_symmetric3(
+        xx + COVARIANCE_RIDGE, yy + COVARIANCE_RIDGE, zz + COVARIANCE_RIDGE, xy, xz, yz, zeros, zeros, zeros
+    )
+    covariances = np.stack([
+        np.stack([i_xx, i_xy, i_xz], axis=1),
+        np.stack([i_xy, i_yy, i_yz], axis=1),
+        np.stack([i_xz, i_yz, i_zz], axis=1),
+    ], axis=1) * variance[:, None, None]
+    return result, np.where(present, residuals.T, np.nan), covariances
+
+
+def solve_positions(distances, anchor_positions):
+    """
+    Calculate the positions of many tags at once with linear least squares.
+
+    Missing measurements are marked with NaN. Tags that see the same set of
+    anchors are solved together with one matrix product, so with a full
+    distance matrix the whole batch is one product regardless of the tag count.
+
+    Args:
+        distances: Array of shape (M, N), distance in cm from each of the M tags to each of the N anchors
+        anchor_positions: Array of shape (N, 2) or (N, 3) with anchor coordinates in cm, or
+            an AnchorGeometry to reuse its cached factorizations across calls
+
+    Returns:
+        Tuple (positions, valid) where positions has shape (M, 3) and valid is a
+        boolean array of shape (M,). Rows with fewer than three anchors or with
+        degenerate anchor geometry are NaN and marked invalid. The z coordinate
+        is the mean height of the anchors used, as in calculate_position.
+    """
+    if not isinstance(anchor_positions, AnchorGeometry):
+        anchor_positions = AnchorGeometry(anchor_positions)
+    return anchor_positions.solve(distances)
+
+
+def refine_positions(distances, anchor_positions, initial=None, tag_height=DEFAULT_TAG_HEIGHT):
+    """
+    Calculate full 3D positions of many tags at once with Gauss-Newton.
+
+    Unlike solve_positions, which puts every tag at the mean anchor height,
+    this minimizes the range residuals in (x, y, z). Each tag starts from its
+    previous fix when given (usually converging in one or two iterations),
+    otherwise from the closed form at `tag_height`.
+
+    When all anchors are at the same height, a tag above the anchor plane
+    and its mirror image below it have the same ranges. The starting point
+    decides which one is returned, and the covariance shows the uncertainty in
+    z, which grows as the tag approaches the plane.
+
+    Args:
+        distances: Array of shape (M, N), distance in cm from each of the M tags to each of the N anchors
+        anchor_positions: Array of shape (N, 3) with anchor coordinates in cm, or an AnchorGeometry
+        initial: Optional array (M, 3) of starting positions, NaN rows for tags without a previous fix
+        tag_height: Starting height in cm of tags without a previous fix
+
+    Returns:
+        Tuple (positions, valid, residuals, covariances): positions (M, 3) and
+        valid (M,) as in solve_positions, range residuals (M, N) in cm
+        (measured minus predicted, NaN where missing) and covariances (M, 3, 3) in cm^2
+    """
+    if not isinstance(anchor_positions, AnchorGeometry):
+        anchor_positions = AnchorGeometry(anchor_positions)
+    return anchor_positions.refine(distances, initial, tag_height)
@@ -0,0 +1,194 @@
+import numpy as np
+
+from tracking import unique_passes
+
+# Edge length of a heatmap cell in cm
+DEFAULT_CELL_SIZE = 25.0
+
+# Upper bound of cells per axis, larger floors get larger cells
+MAX_GRID_CELLS = 512
+
+# Longest gap between two fixes of a tag that still counts as dwell time.
+# Longer gaps are outages, they only count this much.
+MAX_DWELL_GAP = 2.0
+
+# Decay exponents (in half-lives) the stored values may grow to before they are rescaled
+MAX_DECAY_EXPONENT = 256
+
+
+class OccupancyGrid:
+    """
+    Dwell and traffic heatmaps of a rectangular floor.
+
+    The floor is divided into square cells. Every fix adds the time since the
+    previous fix of its tag (capped at MAX_DWELL_GAP) to the dwell time of
+    the cell the tag was in, and counts a visit in its own cell when the tag
+    arrived there from another one. A batch of fixes is binned and added with
+    one np.add.at per map, and memory is the two grids plus the last cell and
+    time of every tag, however many fixes are accumulated.
+
+    With a half-life, older fixes fade out exponentially. Rather than scaling
+    both grids on every batch, new fixes are added with a weight that grows
+    with their time, and snapshots scale by the current time once. The grids
+    are rescaled before the weights get too large for floating point.
+    """
+
+    def __init__(self, xlim, ylim, cell_size=DEFAULT_CELL_SIZE, half_life=None, tag_capacity=64):
+        """
+        Args:
+            xlim: (min, max) x of the floor in cm
+            ylim: (min, max) y of the floor in cm
+            cell_size: Edge length of a cell in cm, enlarged if the floor would
+                need more than MAX_GRID_CELLS cells per axis
+            half_life: Seconds after which a fix counts half, None to never decay
+            tag_capacity: Number of tag rows to preallocate
+        """
+        self.origin = np.array([xlim[0], ylim[0]], dtype=float)
+        size = np.array([xlim[1] - xlim[0], ylim[1] - ylim[0]], dtype=float)
+        self.cell_size = max(float(cell_size), float(size.max()) / MAX_GRID_CELLS)
+        self.shape = tuple(int(n) for n in np.maximum(np.ceil(size / self.cell_size), 1)[::-1])  # (rows, columns)
+        self.half_life = half_life
+
+        self.dwell = np.zeros(self.shape)
+        self.traffic = np.zeros(self.shape)
+        self.fixes_added = 0
+        # Time the stored values are relative to, see _weights
+        self.reference_time = None
+        self.latest_time = np.nan
+
+        self.capacity = 0
+        self.ensure_capacity(max(1, tag_capacity))
+
+    @classmethod
+    def around(cls, points, margin, **kwargs):
+        """
+        Grid covering a set of points (e.g. the anchors) plus a margin on every side.
+        """
+        points = np.asarray(points, dtype=float)[:, :2]
+        low = points.min(axis=0) - margin
+        high = points.max(axis=0) + margin
+        return cls((low[0], high[0]), (low[1], high[1]), **kwargs)
+
+    @property
+    def extent(self):
+        """
+        (xmin, xmax, ymin, ymax) of the grid in cm, as imshow takes it
+        """
+        rows, columns = self.shape
+        x, y = self.origin
+        return x, x + columns * self.cell_size, y, y + rows * self.cell_size
+
+    def ensure_capacity(self, num_tags):
+        """
+        Grow the per-tag arrays so they hold at least `num_tags` tags.
+        """
+        if num_tags <= self.capacity:
+            return
+        capacity = max(num_tags, 2 * self.capacity)
+
+        def grow(name, shape, fill, dtype):
+            new = np.full(shape, fill, dtype=dtype)
+            old = getattr(self, name, None)
+            if old is not None:
+                new[:len(old)] = old
+            setattr(self, name, new)
+
+        grow("last_cell", capacity, -1, np.int64)
+        grow("last_time", capacity, np.nan, float)
+        self.capacity = capacity
+
+    def cells(self, positions):
+        """
+        Returns:
+            Flat cell index of every position, -1 outside the grid
+        """
+        xy = (np.asarray(positions, dtype=float)[:, :2] - self.origin) / self.cell_size
+        rows, columns = self.shape
+        inside = (xy[:, 0] >= 0) & (xy[:, 0] < columns) & (xy[:, 1] >= 0) & (xy[:, 1] < rows)
+        cells = np.full(len(xy), -1, dtype=np.int64)
+        cells[inside] = xy[inside, 1].astype(np.int64) * columns + xy[inside, 0].astype(np.int64)
+        return cells
+
+    def add(self, tag_indices, positions, times):
+        """
+        Accumulate a batch of fixes. A tag may appear more than once, its
+        fixes are applied in order.
+
+        Args:
+            tag_indices: Tag rows of the fixes
+            positions: Array of shape (K, 2) or (K, 3) in cm
+            times: Time of every fix in seconds, or one time for all of them
+        """
+        tag_indices = np.asarray(tag_indices, dtype=np.int64)
+        if len(tag_indices) == 0:
+            return
+        positions = np.asarray(positions, dtype=float)
+        times = np.broadcast_to(np.asarray(times, dtype=float), tag_indices.shape)
+        self.ensure_capacity(int(tag_indices.max()) + 1)
+
+        cells = self.cells(positions)
+        for rows in unique_passes(tag_indices):
+            self._add(tag_indices[rows], cells[rows], times[rows])
+        self.fixes_added += len(tag_indices)
+        self.latest_time = np.fmax(self.latest_time, times.max())
+
+    def _add(self, tag_indices, cells, times):
+        """
+        Add fixes of tags that each appear once.
+        """
+        weights = self._weights(times)
+        last_cell = self.last_cell[tag_indices]
+
+        # Dwell goes to the cell the tag spent the time in
+        stayed = np.clip(times - self.last_time[tag_indices], 0, MAX_DWELL_GAP)
+        timed = (last_cell >= 0) & ~np.isnan(stayed)
+        np.add.at(self.dwell.reshape(-1), last_cell[timed], stayed[timed] * weights[timed])
+
+        arrived = (cells >= 0) & (cells != last_cell)
+        np.add.at(self.traffic.reshape(-1), cells[arrived], weights[arrived])
+
+        self.last_cell[tag_indices] = cells
+        self.last_time[tag_indices] = times
+
+    def _weights(self, times):
+        """
+        Decay weights of fixes at `times`, relative to reference_time.
+        """
+        if self.half_life is None:
+            return np.ones(len(times))
+        if self.reference_time is None:
+            self.reference_time = float(times.min())
+        exponent = (times.max() - self.reference_time) / self.half_life
+        if exponent > MAX_DECAY_EXPONENT:
+            self._rescale(float(times.max()))
+        return np.exp2((times - self.reference_time) / self.half_life)
+
+    def _rescale(self, reference_time):
+        scale = np.exp2(-(reference_time - self.reference_time) / self.half_life)
+        self.dwell *= scale
+        self.traffic *= scale
+        self.reference_time = reference_time
+
+    def snapshot(self, now=None):
+        """
+        Read the heatmaps.
+
+        Args:
+            now: Time to decay to, defaults to the time of the latest fix
+
+        Returns:
+            Tuple (dwell, traffic) of arrays (rows, columns), row 0 at ymin:
+            seconds spent in every cell and arrivals into every cell
+        """
+        if self.half_life is None or self.reference_time is None:
+            return self.dwell.copy(), self.traffic.copy()
+        now = self.latest_time if now is None else now
+        scale = np.exp2(-(now - self.reference_time) / self.half_life)
+        return self.dwell * scale, self.traffic * scale
+
+    def save(self, path, now=None):
+        """
+        Export a snapshot to a .npz file with the arrays dwell, traffic and extent.
+        """
+        dwell, traffic = self.snapshot(now)
+        np.savez(path, dwell=dwell, traffic=traffic, extent=np.array(self.extent), cell_size=self.cell_size)
@@ -0,0 +1,201 @@
+import mmap
+import socket
+import struct
+import time
+
+import numpy as np
+
+# Every capture file starts with this magic
+LOG_MAGIC = b"UWBLOG1\n"
+
+# Record header: receive time (time.time()), payload length, sender IPv4 address and port
+RECORD_HEADER = struct.Struct("<dI4sH")
+
+# Maximum number of records handed to the handler at once when replaying
+REPLAY_BATCH_SIZE = 256
+
+
+class PacketRecorder:
+    """
+    Appends received datagrams to a capture file.
+
+    Each record is a fixed header (receive time, payload length, sender)
+    followed by the raw payload, so the file can be replayed byte for byte.
+    Writes go through a buffered file and are flushed after every batch.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path: Capture file to append to, created with a header if it doesn't exist
+        """
+        self.path = path
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(LOG_MAGIC)
+        self.records_written = 0
+
+    def record_batch(self, datagrams, recv_time=None):
+        """
+        Append a batch of datagrams that were received together.
+
+        Args:
+            datagrams: List of (data, (ip, port)) tuples
+            recv_time: Receive time in seconds since the epoch, defaults to time.time()
+        """
+        if recv_time is None:
+            recv_time = time.time()
+        for data, addr in datagrams:
+            try:
+                packed_ip = socket.inet_aton(addr[0])
+            except OSError:
+                packed_ip = bytes(4)
+            self.file.write(RECORD_HEADER.pack(recv_time, len(data), packed_ip, addr[1]))
+            self.file.write(data)
+        self.file.flush()
+        self.records_written += len(datagrams)
+
+    def close(self):
+        self.file.close()
+
+
+class PacketLog:
+    """
+    Memory-mapped reader for capture files written by PacketRecorder.
+
+    Payloads are returned as memoryview slices of the mapping, so iterating a
+    capture doesn't copy the packets.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path: Capture file to read
+
+        Raises:
+            ValueError: If the file isn't a capture file
+        """
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(LOG_MAGIC)] != LOG_MAGIC:
+            self._mmap.close()
+            raise ValueError(f"{path} is not a UWB packet capture")
+
+    def __iter__(self):
+        """
+        Yields:
+            Tuple (recv_time, data, (ip, port)) for every record in the file
+        """
+        view = memoryview(self._mmap)
+        offset = len(LOG_MAGIC)
+        end = len(view)
+        while offset + RECORD_HEADER.size <= end:
+            recv_time, length, packed_ip, port = RECORD_HEADER.unpack_from(view, offset)
+            offset += RECORD_HEADER.size
+            if offset + length > end:
+                print(f"Truncated record at the end of {self.path}")
+                break
+            yield recv_time, view[offset:offset + length], (socket.inet_ntoa(packed_ip), port)
+            offset += length
+
+    @property
+    def start(self):
+        """
+        Offset of the first record
+        """
+        return len(LOG_MAGIC)
+
+    def buffer(self):
+        """
+        Returns:
+            The whole mapped file as a uint8 array, without copying it
+        """
+        return np.frombuffer(self._mmap, dtype=np.uint8)
+
+    def scan(self, offset, max_records):
+        """
+        Index the records from `offset` on without touching their payloads.
+
+        Args:
+            offset: Offset of a record, self.start for the first one
+            max_records: Most records to index
+
+        Returns:
+            Tuple (recv_times, payload_offsets, payload_lengths, next_offset)
+            with arrays for the indexed records and the offset of the record
+            after them, or None at the end of the file
+        """
+        view = self._mmap
+        end = len(view)
+        recv_times, offsets, lengths = [], [], []
+        unpack = RECORD_HEADER.unpack_from
+        while len(offsets) < max_records and offset + RECORD_HEADER.size <= end:
+            recv_time, length, _, _ = unpack(view, offset)
+            offset += RECORD_HEADER.size
+            if offset + length > end:
+                print(f"Truncated record at the end of {self.path}")
+                offset = end
+                break
+            recv_times.append(recv_time)
+            offsets.append(offset)
+            lengths.append(length)
+            offset += length
+        next_offset = offset if offset + RECORD_HEADER.size <= end else None
+        return (np.array(recv_times, dtype=float), np.array(offsets, dtype=np.int64),
+                np.array(lengths, dtype=np.int64), next_offset)
+
+    def close(self):
+        try:
+            self._mmap.close()
+        except BufferError:
+            # Payload views handed out are still alive, the mapping closes with them
+            pass
+
+
+def replay_log(path, handle_batch, speed=1.0, batch_size=REPLAY_BATCH_SIZE):
+    """
+    Feed a capture file back through a datagram handler.
+
+    Args:
+        path: Capture file written by PacketRecorder
+        handle_batch: Called as handle_batch(datagrams, recv_time) like the live ingest loop
+        speed: Replay speed relative to real time (2.0 is twice as fast), or
+            None to replay as fast as possible
+        batch_size: Maximum number of datagrams per batch
+
+    Returns:
+        Tuple (number of datagrams replayed, receive time of the last one)
+    """
+    log = PacketLog(path)
+    batch = []
+    batch_time = None
+    replayed = 0
+    first_time = None
+    start = time.monotonic()
+    try:
+        for recv_time, data, addr in log:
+            if first_time is None:
+                first_time = recv_time
+
+            # Only datagrams received together share a batch, as they did live
+            if batch and (len(batch) >= batch_size or recv_time != batch_time):
+                handle_batch(batch, batch_time)
+                replayed += len(batch)
+                batch = []
+
+            if speed is not None and not batch:
+                delay = (recv_time - first_time) / speed - (time.monotonic() - start)
+                if delay > 0:
+                    time.sleep(delay)
+
+            batch.append((data, addr))
+            batch_time = recv_time
+
+        if batch:
+            handle_batch(batch, batch_time)
+            replayed += len(batch)
+    finally:
+        log.close()
+
+    return replayed, batch_time
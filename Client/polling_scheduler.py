@@ -0,0 +1,367 @@
+import numpy as np
+
+from range_filter import window_medians
+from tracking import unique_passes
+
+# Polling periods the scheduler picks from, in ms. Snapping to a few steps
+# keeps small speed changes from producing an update every tick.
+PERIOD_STEPS_MS = (20, 50, 100, 200, 500, 1000, 2000)
+
+# Polling period of tags whose speed isn't known yet, in ms
+DEFAULT_PERIOD_MS = 100
+
+# Distance in cm a tag may move between two rounds. This is the fix-quality
+# budget: about the spread of a single range (see range_filter.DEFAULT_MIN_SCALE).
+DEFAULT_STEP_BUDGET = 20.0
+
+# Weight of the newest sample in the smoothed speeds and report intervals
+SMOOTHING = 0.3
+
+# Seconds a faster (slower) period must stay wanted before it is sent. Speeding
+# up is quick so a tag that starts moving is sampled, slowing down waits so a
+# tag pausing for a moment doesn't make the anchors flap.
+SPEED_UP_DELAY = 0.2
+SLOW_DOWN_DELAY = 5.0
+
+# Seconds a period set by hand (the UI slider) must stay unchanged before it is sent
+MANUAL_DELAY = 0.3
+
+# Shortest time between two updates to the same anchor, in seconds
+MIN_SEND_INTERVAL = 0.25
+
+# Seconds before an update the anchor didn't apply is sent again. The wait
+# doubles with every retry up to MAX_RESEND_INTERVAL, and is at least
+# RESEND_ROUNDS rounds at the slower of the old and new period.
+RESEND_INTERVAL = 1.0
+MAX_RESEND_INTERVAL = 30.0
+RESEND_ROUNDS = 4
+
+# An update counts as applied once the anchor's report interval, measured
+# over CONFIRM_INTERVALS rounds after the update, is within this fraction of it
+RATE_TOLERANCE = 0.25
+CONFIRM_INTERVALS = 2
+
+# Shortest time in seconds over which the speed is taken from consecutive
+# fixes, so range noise between two fast rounds doesn't read as motion
+SPEED_BASELINE = 1.0
+
+# Tags an anchor hasn't ranged for this many seconds no longer set its period
+TAG_TIMEOUT = 5.0
+
+# Change in cm of a range over SPEED_BASELINE that is put down to noise rather
+# than motion, about three times the spread of a single range
+RANGE_NOISE_ALLOWANCE = 60.0
+
+
+def snap_periods(periods_ms, min_period_ms, max_period_ms):
+    """
+    Round periods down to the nearest step, so a tag is never sampled slower
+    than it asked for, and clip them to [min_period_ms, max_period_ms].
+    """
+    steps = np.asarray(PERIOD_STEPS_MS, dtype=float)
+    index = np.searchsorted(steps, periods_ms, side="right") - 1
+    snapped = steps[np.clip(index, 0, len(steps) - 1)]
+    return np.clip(snapped, min_period_ms, max_period_ms)
+
+
+class PollingScheduler:
+    """
+    Picks the polling period of every anchor from the motion of the tags it ranges.
+
+    Each tag wants a period short enough that it moves at most `step_budget`
+    cm between two rounds at its (smoothed) speed, so a stationary tag drops to
+    the slowest step while a fast one is polled at the fastest. An anchor ranges
+    all its tags in one round, so it is polled at the period of its fastest
+    recently seen tag.
+
+    Speeds come from fixes, and are raised from the ranges themselves when
+    those change faster than the speed explains: a tag that starts moving
+    while its anchors poll slowly may get no fix until they speed up.
+
+    The scheduler only decides; the client sends the updates returned by
+    due_updates, which are debounced (a period must stay wanted for a while
+    before it is sent), coalesced (at most one update per anchor every
+    MIN_SEND_INTERVAL, anchors getting the same period share one message) and
+    sent again until the anchor applies them. The firmware doesn't acknowledge
+    polling updates, so an update counts as applied once the interval between
+    the anchor's reports matches it.
+
+    All state lives in (T,) per-tag, (T, N) per-stream and (N,) per-anchor
+    arrays, indexed by the rows and columns of the measurement table.
+    """
+
+    def __init__(self, num_anchors, min_period_ms=PERIOD_STEPS_MS[0], max_period_ms=PERIOD_STEPS_MS[-1],
+                 step_budget=DEFAULT_STEP_BUDGET, tag_capacity=64):
+        """
+        Args:
+            num_anchors: Number of anchors (columns of the measurement table)
+            min_period_ms: Shortest polling period used, in ms
+            max_period_ms: Longest polling period used, in ms
+            step_budget: Distance in cm a tag may move between two rounds
+            tag_capacity: Number of tag rows to preallocate
+        """
+        self.num_anchors = num_anchors
+        self.min_period_ms = min_period_ms
+        self.max_period_ms = max_period_ms
+        self.step_budget = step_budget
+        self.fixed_period_ms = None
+        self.capacity = 0
+
+        # Per anchor: period wanted and since when, period last sent and whether it was applied
+        self.wanted = np.full(num_anchors, np.nan)
+        self.wanted_since = np.zeros(num_anchors)
+        self.requested = np.full(num_anchors, np.nan)
+        self.previous = np.full(num_anchors, np.nan)
+        self.applied = np.zeros(num_anchors, dtype=bool)
+        self.last_sent = np.full(num_anchors, -np.inf)
+        self.resend_interval = np.full(num_anchors, RESEND_INTERVAL)
+
+        # Counters
+        self.updates_sent = np.zeros(num_anchors, dtype=np.int64)
+        self.updates_resent = np.zeros(num_anchors, dtype=np.int64)
+
+        self.ensure_capacity(max(1, tag_capacity))
+
+    def ensure_capacity(self, num_tags):
+        """
+        Grow the per-tag arrays so they hold at least `num_tags` tags.
+        """
+        if num_tags <= self.capacity:
+            return
+        capacity = max(num_tags, 2 * self.capacity)
+
+        def grow(name, shape, fill, dtype):
+            new = np.full(shape, fill, dtype=dtype)
+            old = getattr(self, name, None)
+            if old is not None:
+                new[:len(old)] = old
+            setattr(self, name, new)
+
+        grow("speeds", capacity, np.nan, float)
+        grow("last_positions", (capacity, 3), np.nan, float)
+        grow("last_fix_times", capacity, np.nan, float)
+        grow("last_reading", (capacity, self.num_anchors), np.nan, float)
+        grow("last_ranges", (capacity, self.num_anchors), np.nan, float)
+        grow("last_range_times", (capacity, self.num_anchors), np.nan, float)
+        grow("report_intervals", (capacity, self.num_anchors), np.nan, float)
+        grow("interval_counts", (capacity, self.num_anchors), 0, np.int64)
+        self.capacity = capacity
+
+    def set_fixed_period(self, period_ms):
+        """
+        Poll every anchor at `period_ms` (e.g. from the UI slider), or adapt
+        to the tags again with None. Moving the slider only records the value;
+        it is sent by due_updates once it stops changing.
+        """
+        self.fixed_period_ms = None if period_ms is None else int(period_ms)
+
+    def observe_readings(self, tag_indices, anchor_indices, times):
+        """
+        Record when every (tag, anchor) stream reported to measure the report interval of the anchors.
+
+        Args:
+            tag_indices: Tag rows of the readings
+            anchor_indices: Anchor columns of the readings
+            times: Receive times in seconds (array or scalar)
+        """
+        tag_indices = np.asarray(tag_indices, dtype=np.int64)
+        anchor_indices = np.asarray(anchor_indices, dtype=np.int64)
+        times = np.broadcast_to(np.asarray(times, dtype=float), tag_indices.shape)
+        if not len(tag_indices):
+            return
+        self.ensure_capacity(int(tag_indices.max()) + 1)
+
+        for rows in unique_passes(tag_indices * self.num_anchors + anchor_indices):
+            tags, anchors, now = tag_indices[rows], anchor_indices[rows], times[rows]
+            last = self.last_reading[tags, anchors]
+            # Only intervals that started after the anchor's last update measure the new period
+            measured = (last >= self.last_sent[anchors]) & (now > last)
+            tags, anchors, intervals = tags[measured], anchors[measured], (now - last)[measured]
+            smoothed = self.report_intervals[tags, anchors]
+            self.report_intervals[tags, anchors] = np.where(
+                np.isnan(smoothed), intervals, smoothed + SMOOTHING * (intervals - smoothed)
+            )
+            self.interval_counts[tags, anchors] += 1
+            self.last_reading[tag_indices[rows], anchor_indices[rows]] = now
+
+    def observe_ranges(self, tag_indices, anchor_indices, distances, times):
+        """
+        Raise the speed of tags whose ranges change faster than it. A range
+        changes at most as fast as the tag moves, so the change over at least
+        SPEED_BASELINE, less RANGE_NOISE_ALLOWANCE, bounds the speed from below.
+
+        Args:
+            tag_indices: Tag rows of the readings
+            anchor_indices: Anchor columns of the readings
+            distances: Distances in cm
+            times: Receive times in seconds (array or scalar)
+        """
+        tag_indices = np.asarray(tag_indices, dtype=np.int64)
+        anchor_indices = np.asarray(anchor_indices, dtype=np.int64)
+        distances = np.broadcast_to(np.asarray(distances, dtype=float), tag_indices.shape)
+        times = np.broadcast_to(np.asarray(times, dtype=float), tag_indices.shape)
+        if not len(tag_indices):
+            return
+        self.ensure_capacity(int(tag_indices.max()) + 1)
+
+        for rows in unique_passes(tag_indices * self.num_anchors + anchor_indices):
+            tags, anchors = tag_indices[rows], anchor_indices[rows]
+            elapsed = times[rows] - self.last_range_times[tags, anchors]
+            # Keep the reference range until the baseline is long enough
+            update = ~(elapsed < SPEED_BASELINE)
+            change = np.abs(distances[rows] - self.last_ranges[tags, anchors]) - RANGE_NOISE_ALLOWANCE
+            with np.errstate(divide="ignore", invalid="ignore"):
+                rates = np.maximum(change, 0.0) / elapsed
+            # Tags without a known speed already poll at the default period
+            faster = update & (rates > self.speeds[tags])
+            np.maximum.at(self.speeds, tags[faster], rates[faster])
+            self.last_ranges[tags[update], anchors[update]] = distances[rows][update]
+            self.last_range_times[tags[update], anchors[update]] = times[rows][update]
+
+    def observe_fixes(self, tag_indices, positions, times, velocities=None):
+        """
+        Update the smoothed speed of tags from their fixes.
+
+        Args:
+            tag_indices: Tag rows of the fixes
+            positions: Array (K, 3) of positions in cm
+            times: Times of the fixes in seconds (array or scalar)
+            velocities: Optional array (K, D) of velocities in cm/s (from a
+                tracker), otherwise the speed is taken from consecutive fixes
+        """
+        tag_indices = np.asarray(tag_indices, dtype=np.int64)
+        positions = np.asarray(positions, dtype=float)
+        times = np.broadcast_to(np.asarray(times, dtype=float), tag_indices.shape)
+        if not len(tag_indices):
+            return
+        self.ensure_capacity(int(tag_indices.max()) + 1)
+
+        for rows in unique_passes(tag_indices):
+            if velocities is not None:
+                speeds = np.linalg.norm(np.asarray(velocities, dtype=float)[rows], axis=1)
+            else:
+                elapsed = times[rows] - self.last_fix_times[tag_indices[rows]]
+                # Keep the reference fix until the baseline is long enough
+                rows = rows[~(elapsed < SPEED_BASELINE)]
+                elapsed = times[rows] - self.last_fix_times[tag_indices[rows]]
+                moved = np.linalg.norm(positions[rows, :2] - self.last_positions[tag_indices[rows], :2], axis=1)
+                speeds = moved / elapsed
+
+            tags = tag_indices[rows]
+            smoothed = self.speeds[tags]
+            self.speeds[tags] = np.where(
+                np.isnan(smoothed), speeds,
+                np.where(np.isnan(speeds), smoothed, smoothed + SMOOTHING * (speeds - smoothed)),
+            )
+            self.last_positions[tags] = positions[rows]
+            self.last_fix_times[tags] = times[rows]
+
+    def tag_periods(self, tag_indices=None):
+        """
+        Returns:
+            Polling period in ms every tag wants (all tags by default)
+        """
+        speeds = self.speeds if tag_indices is None else self.speeds[np.asarray(tag_indices, dtype=np.int64)]
+        with np.errstate(divide="ignore"):
+            periods = np.where(np.isnan(speeds), DEFAULT_PERIOD_MS, 1000 * self.step_budget / speeds)
+        return snap_periods(periods, self.min_period_ms, self.max_period_ms)
+
+    def anchor_periods(self, now):
+        """
+        Returns:
+            Polling period in ms every anchor should run at: the fixed period,
+            or the shortest period of the tags it ranged within TAG_TIMEOUT
+        """
+        if self.fixed_period_ms is not None:
+            return np.full(self.num_anchors, float(self.fixed_period_ms))
+        active = self.last_reading >= now - TAG_TIMEOUT
+        periods = np.where(active, self.tag_periods()[:, None], np.inf).min(axis=0)
+        # Anchors without tags poll slowly until one shows up
+        periods[np.isinf(periods)] = self.max_period_ms
+        return periods
+
+    def epoch_windows(self, tag_indices, now):
+        """
+        Epoch window of every given tag: the slowest period its anchors were
+        told to run at, or still run at until they apply an update. Anchors
+        poll on unsynchronized timers, so one round of a tag's readings is
+        spread over that whole period.
+
+        Args:
+            tag_indices: Tag rows
+            now: Current time in seconds (array or scalar)
+
+        Returns:
+            Window in seconds per tag, NaN for tags no anchor ranged recently
+            or whose anchors were never sent a period
+        """
+        tag_indices = np.asarray(tag_indices, dtype=np.int64)
+        now = np.broadcast_to(np.asarray(now, dtype=float), tag_indices.shape)
+        periods = np.where(self.applied, self.requested, np.fmax(self.requested, self.previous))
+        active = self.last_reading[tag_indices] >= (now - TAG_TIMEOUT)[:, None]
+        with np.errstate(invalid="ignore"):
+            return np.fmax.reduce(np.where(active, periods, np.nan), axis=1, initial=np.nan) / 1000
+
+    def report_periods(self, now):
+        """
+        Returns:
+            Measured report interval in ms of every anchor (median over its
+            recently seen tags since its last update), NaN if not measured yet
+        """
+        active = (self.last_reading >= now - TAG_TIMEOUT) & (self.interval_counts > 0)
+        intervals = np.where(active, self.report_intervals, np.nan).T
+        return 1000 * window_medians(intervals, np.count_nonzero(active, axis=0))
+
+    def due_updates(self, now):
+        """
+        Decide which anchors to send a polling update to now, and mark them as sent.
+
+        Call this regularly (every 100 ms or so), it does nothing when all
+        anchors run at their wanted period.
+
+        Args:
+            now: Current time in seconds, on the clock of the reading times
+
+        Returns:
+            List of (anchor_indices, period_ms) pairs, one message each
+        """
+        wanted = self.anchor_periods(now)
+        changed = wanted != self.wanted
+        self.wanted_since[changed] = now
+        self.wanted = wanted
+
+        # An update is applied while the anchor reports at the requested period,
+        # so an anchor that rebooted to its default period gets it again
+        measured = self.report_periods(now)
+        counts = np.where(self.last_reading >= now - TAG_TIMEOUT, self.interval_counts, 0).max(axis=0)
+        self.applied = (counts >= CONFIRM_INTERVALS) & \
+            (np.abs(measured - self.requested) <= RATE_TOLERANCE * self.requested)
+
+        if self.fixed_period_ms is not None:
+            delay = MANUAL_DELAY
+        else:
+            delay = np.where(np.isnan(self.requested) | (wanted < self.requested), SPEED_UP_DELAY, SLOW_DOWN_DELAY)
+        new = (wanted != self.requested) & (now - self.wanted_since >= delay)
+        resend = (wanted == self.requested) & ~self.applied & (now - self.last_sent >= self.resend_interval)
+        due = np.flatnonzero((new | resend) & (now - self.last_sent >= MIN_SEND_INTERVAL))
+        if not len(due):
+            return []
+
+        resent = due[resend[due]]
+        self.updates_resent[resent] += 1
+        self.resend_interval[resent] = np.minimum(2 * self.resend_interval[resent], MAX_RESEND_INTERVAL)
+        fresh = due[new[due]]
+        self.previous[fresh] = np.where(np.isnan(measured[fresh]), self.requested[fresh], measured[fresh])
+        self.requested[fresh] = wanted[fresh]
+        self.resend_interval[fresh] = np.maximum(
+            RESEND_INTERVAL, RESEND_ROUNDS * np.fmax(self.previous[fresh], wanted[fresh]) / 1000
+        )
+
+        self.last_sent[due] = now
+        self.updates_sent[due] += 1
+        # Intervals measured from here on belong to the new period
+        self.report_intervals[:, due] = np.nan
+        self.interval_counts[:, due] = 0
+
+        periods = self.requested[due]
+        return [(due[periods == period], int(period)) for period in np.unique(periods)]
@@ -0,0 +1,369 @@
+import argparse
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+# Columns of the history, one .npy file per column and chunk:
+#   time     Unix time of the fix in seconds
+#   tag      UWB address of the tag
+#   x, y, z  position in cm
+#   quality  fix quality, the number of anchors the fix was solved from (NaN if unknown)
+HISTORY_DTYPE = np.dtype([
+    ("time", "<f8"),
+    ("tag", "<u2"),
+    ("x", "<f4"),
+    ("y", "<f4"),
+    ("z", "<f4"),
+    ("quality", "<f4"),
+])
+
+# Rows per chunk. A full chunk is 104 MB on disk, about 7 minutes of 100 tags at 100 Hz.
+CHUNK_ROWS = 1 << 22
+
+# Rows per block of the time index inside a chunk. Queries read only the blocks
+# whose time range overlaps theirs.
+BLOCK_ROWS = 4096
+
+# Rows collected in memory before they are handed to the writer thread
+BUFFER_ROWS = 8192
+
+# Seconds after which a partly filled buffer is handed to the writer anyway
+FLUSH_INTERVAL = 1.0
+
+# Buffers waiting for the writer. While the queue is full new fixes are dropped
+# instead of piling up in memory.
+MAX_PENDING_BUFFERS = 64
+
+# Per chunk: rows written and the time range they cover
+INDEX_DTYPE = np.dtype([
+    ("rows", "<i8"),
+    ("time_min", "<f8"),
+    ("time_max", "<f8"),
+])
+
+INDEX_FILE = "index.npy"
+BLOCKS_FILE = "blocks.npy"
+
+
+class PositionHistory:
+    """
+    Append-only store of position fixes in chunked, columnar files.
+
+    The history is a directory of chunks. Every chunk holds CHUNK_ROWS rows as
+    one memory-mapped .npy file per column, plus a time index with the range
+    of every BLOCK_ROWS rows. index.npy records the row count and time range
+    of every chunk, so a query only maps the chunks, and within them only the
+    blocks, that overlap its time range. Nothing but the chunk index is kept in
+    memory, pages of the mapped files belong to the page cache.
+
+    append() only copies the fixes into a small buffer. Full buffers, and
+    buffers older than FLUSH_INTERVAL, go to a writer thread that copies them
+    into the open chunk and updates the indexes, so disk I/O never runs on the
+    ingest path. Fixes become visible to queries once they are written.
+    """
+
+    def __init__(self, path, chunk_rows=CHUNK_ROWS, buffer_rows=BUFFER_ROWS, flush_interval=FLUSH_INTERVAL,
+                 block=False):
+        """
+        Args:
+            path: Directory of the history, created if it doesn't exist. An
+                existing history is appended to.
+            chunk_rows: Rows per chunk of a new history, a multiple of BLOCK_ROWS
+            buffer_rows: Rows buffered before they are handed to the writer
+            flush_interval: Seconds after which a partly filled buffer is handed over
+            block: Wait for the writer when it falls behind instead of dropping
+                rows, for offline writers that must keep every fix
+        """
+        self.path = path
+        self.buffer_rows = buffer_rows
+        self.flush_interval = flush_interval
+        self.block = block
+        os.makedirs(path, exist_ok=True)
+
+        index_path = os.path.join(path, INDEX_FILE)
+        if os.path.exists(index_path):
+            self.index = np.load(index_path)
+            self.chunk_rows = len(np.load(self._chunk_file(0, BLOCKS_FILE), mmap_mode="r")) * BLOCK_ROWS
+        else:
+            self.index = np.zeros(0, dtype=INDEX_DTYPE)
+            self.chunk_rows = chunk_rows
+        self._lock = threading.Lock()
+        self._chunk = None
+
+        # Published times are Unix times, fixes carry monotonic ones
+        self.clock_offset = time.time() - time.monotonic()
+        self._buffer = np.empty(buffer_rows, dtype=HISTORY_DTYPE)
+        self._buffered = 0
+        self._buffer_started = None
+        self._queue = queue.Queue(MAX_PENDING_BUFFERS)
+        self._writer = threading.Thread(target=self._write_buffers, daemon=True)
+        self._writer.start()
+
+        # Counters
+        self.rows_appended = 0
+        self.rows_written = 0
+        self.rows_dropped = 0
+
+    def _chunk_file(self, chunk, name):
+        return os.path.join(self.path, f"{chunk:06d}", name)
+
+    def append(self, tag_addresses, positions, times, quality=None):
+        """
+        Queue fixes for writing.
+
+        Args:
+            tag_addresses: Array of tag addresses
+            positions: Array (K, 3) of positions in cm
+            times: Monotonic times of the fixes in seconds (array or scalar)
+            quality: Optional number of anchors of every fix (array or scalar)
+        """
+        tags = np.asarray(tag_addresses)
+        positions = np.asarray(positions, dtype=float)
+        times = np.broadcast_to(np.asarray(times, dtype=float) + self.clock_offset, tags.shape)
+        quality = np.broadcast_to(np.nan if quality is None else np.asarray(quality, dtype=float), tags.shape)
+        self.rows_appended += len(tags)
+
+        start = 0
+        while start < len(tags):
+            if not self._buffered:
+                self._buffer_started = time.monotonic()
+            count = min(len(tags) - start, self.buffer_rows - self._buffered)
+            rows = self._buffer[self._buffered:self._buffered + count]
+            end = start + count
+            rows["time"] = times[start:end]
+            rows["tag"] = tags[start:end]
+            rows["x"] = positions[start:end, 0]
+            rows["y"] = positions[start:end, 1]
+            rows["z"] = positions[start:end, 2]
+            rows["quality"] = quality[start:end]
+            self._buffered += count
+            start = end
+            if self._buffered == self.buffer_rows:
+                self.flush()
+
+        if self._buffered and time.monotonic() - self._buffer_started > self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Hand the buffered fixes to the writer thread.
+        """
+        if not self._buffered:
+            return
+        try:
+            self._queue.put(self._buffer[:self._buffered], block=self.block)
+        except queue.Full:
+            # The disk can't keep up, losing history beats growing without bound
+            self.rows_dropped += self._buffered
+        self._buffer = np.empty(self.buffer_rows, dtype=HISTORY_DTYPE)
+        self._buffered = 0
+        self._buffer_started = None
+
+    def _write_buffers(self):
+        while True:
+            rows = self._queue.get()
+            try:
+                if rows is None:
+                    return
+                self._write(rows)
+            except Exception as e:
+                print(f"Error writing position history to {self.path}: {e}")
+            finally:
+                self._queue.task_done()
+
+    def _open_chunk(self, chunk):
+        """
+        Map the column files and block index of a chunk, creating them for a new chunk.
+        """
+        os.makedirs(os.path.join(self.path, f"{chunk:06d}"), exist_ok=True)
+        mode = "r+" if chunk < len(self.index) else "w+"
+        columns = {
+            name: np.lib.format.open_memmap(
+                self._chunk_file(chunk, f"{name}.npy"), mode, HISTORY_DTYPE[name], (self.chunk_rows,)
+            )
+            for name in HISTORY_DTYPE.names
+        }
+        blocks = np.lib.format.open_memmap(
+            self._chunk_file(chunk, BLOCKS_FILE), mode, np.float64, (self.chunk_rows // BLOCK_ROWS, 2)
+        )
+        if mode == "w+":
+            blocks[:] = np.nan
+            with self._lock:
+                self.index = np.append(self.index, np.array([(0, np.nan, np.nan)], dtype=INDEX_DTYPE))
+        return chunk, columns, blocks
+
+    def _close_chunk(self):
+        _, columns, blocks = self._chunk
+        for column in columns.values():
+            column.flush()
+        blocks.flush()
+        self._chunk = None
+
+    def _write(self, rows):
+        """
+        Copy rows into the open chunk, starting new chunks as they fill up.
+        """
+        while len(rows):
+            if self._chunk is None:
+                last = len(self.index) - 1
+                if last >= 0 and self.index["rows"][last] < self.chunk_rows:
+                    self._chunk = self._open_chunk(last)
+                else:
+                    self._chunk = self._open_chunk(last + 1)
+            chunk, columns, blocks = self._chunk
+
+            start = int(self.index["rows"][chunk])
+            count = min(len(rows), self.chunk_rows - start)
+            end = start + count
+            for name, column in columns.items():
+                column[start:end] = rows[name][:count]
+
+            # Widen the time range of every block the rows landed in
+            written = columns["time"]
+            for block in range(start // BLOCK_ROWS, (end - 1) // BLOCK_ROWS + 1):
+                times = written[max(start, block * BLOCK_ROWS):min(end, (block + 1) * BLOCK_ROWS)]
+                blocks[block, 0] = np.fmin(blocks[block, 0], times.min())
+                blocks[block, 1] = np.fmax(blocks[block, 1], times.max())
+
+            # The rows are in place before the index counts them, so queries never see unwritten rows
+            times = rows["time"][:count]
+            with self._lock:
+                self.index["rows"][chunk] = end
+                self.index["time_min"][chunk] = np.fmin(self.index["time_min"][chunk], times.min())
+                self.index["time_max"][chunk] = np.fmax(self.index["time_max"][chunk], times.max())
+                index = self.index.copy()
+            self.rows_written += count
+            rows = rows[count:]
+            if end == self.chunk_rows:
+                self._close_chunk()
+
+        self._save_index(index)
+
+    def _save_index(self, index):
+        path = os.path.join(self.path, INDEX_FILE)
+        temporary = path + ".tmp.npy"
+        np.save(temporary, index)
+        os.replace(temporary, path)
+
+    def query(self, start=None, end=None, tags=None):
+        """
+        Read the fixes in a time range.
+
+        Args:
+            start: Unix time of the first fix, inclusive (None for the beginning)
+            end: Unix time after the last fix, exclusive (None for the end)
+            tags: Optional tag address or array of tag addresses to return
+
+        Returns:
+            Structured array of HISTORY_DTYPE sorted by time
+        """
+        start = -np.inf if start is None else start
+        end = np.inf if end is None else end
+        with self._lock:
+            index = self.index.copy()
+
+        chunks = np.flatnonzero((index["rows"] > 0) & (index["time_max"] >= start) & (index["time_min"] < end))
+        parts = []
+        for chunk in chunks:
+            rows = index["rows"][chunk]
+            blocks = np.load(self._chunk_file(chunk, BLOCKS_FILE), mmap_mode="r")
+            used = np.flatnonzero((blocks[:, 1] >= start) & (blocks[:, 0] < end))
+            used = used[used * BLOCK_ROWS < rows]
+            if not len(used):
+                continue
+
+            # Only the overlapping blocks are read, first the time and tag columns
+            row_ranges = [np.arange(block * BLOCK_ROWS, min((block + 1) * BLOCK_ROWS, rows)) for block in used]
+            candidates = np.concatenate(row_ranges)
+            columns = {name: np.load(self._chunk_file(chunk, f"{name}.npy"), mmap_mode="r")
+                       for name in HISTORY_DTYPE.names}
+            times = columns["time"][candidates]
+            selected = (times >= start) & (times < end)
+            if tags is not None:
+                selected &= np.isin(columns["tag"][candidates], tags)
+            selected = candidates[selected]
+
+            part = np.empty(len(selected), dtype=HISTORY_DTYPE)
+            for name, column in columns.items():
+                part[name] = column[selected]
+            parts.append(part)
+
+        fixes = np.concatenate(parts) if parts else np.zeros(0, dtype=HISTORY_DTYPE)
+        return fixes[np.argsort(fixes["time"], kind="stable")]
+
+    def time_range(self):
+        """
+        Returns:
+            Tuple (first, last) Unix time of the written fixes, NaN while there are none
+        """
+        with self._lock:
+            written = self.index[self.index["rows"] > 0]
+        if not len(written):
+            return np.nan, np.nan
+        return float(written["time_min"].min()), float(written["time_max"].max())
+
+    def close(self):
+        """
+        Write the buffered fixes and stop the writer thread.
+        """
+        self.flush()
+        self._queue.put(None)
+        self._writer.join()
+        if self._chunk is not None:
+            self._close_chunk()
+
+
+def parse_time(value):
+    """
+    Parse a query bound: Unix seconds, or an ISO 8601 local date and time.
+    A time without a date means today.
+    """
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        pass
+    clock = datetime.strptime(value, "%H:%M:%S" if value.count(":") == 2 else "%H:%M").time()
+    return datetime.combine(datetime.now().date(), clock).timestamp()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query a position history recorded with trilateration.py --history")
+    parser.add_argument("path", help="history directory")
+    parser.add_argument("--tag", type=int, action="append", help="only this tag address (repeatable)")
+    parser.add_argument("--start", type=parse_time, help="first time, Unix seconds or e.g. 10:00 or 2024-05-01T10:00")
+    parser.add_argument("--end", type=parse_time, help="end time, same formats as --start")
+    parser.add_argument("--csv", metavar="PATH", help="write the fixes to a CSV file instead of printing them")
+    args = parser.parse_args()
+
+    history = PositionHistory(args.path)
+    try:
+        first, last = history.time_range()
+        if np.isnan(first):
+            print(f"{args.path} holds no fixes")
+            return
+        print(f"{args.path} holds {int(history.index['rows'].sum())} fixes from "
+              f"{datetime.fromtimestamp(first)} to {datetime.fromtimestamp(last)}")
+
+        fixes = history.query(args.start, args.end, args.tag)
+        if args.csv:
+            np.savetxt(args.csv, fixes, fmt=["%.3f", "%d", "%.1f", "%.1f", "%.1f", "%g"],
+                       delimiter=",", header=",".join(HISTORY_DTYPE.names), comments="")
+            print(f"Wrote {len(fixes)} fixes to {args.csv}")
+            return
+        for fix in fixes:
+            print(f"{datetime.fromtimestamp(fix['time']).isoformat(timespec='milliseconds')} tag {fix['tag']} at "
+                  f"({fix['x']:.1f}, {fix['y']:.1f}, {fix['z']:.1f}) cm, {fix['quality']:g} anchors")
+    finally:
+        history.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,321 @@
+import argparse
+import asyncio
+import socket
+import struct
+import time
+
+import numpy as np
+
+from measurement_table import ADDRESS_SPACE
+from wire_format import FIX_DTYPE, FIX_HEADER, MAX_FIXES_PER_DATAGRAM, decode_fixes, encode_fixes
+
+# Local TCP port subscribers connect to for the stream of fixes
+DEFAULT_PUBLISH_HOST = "127.0.0.1"
+DEFAULT_PUBLISH_PORT = 50001
+
+# Multicast group fixes are sent to with --multicast. TTL 1 keeps them on the local network.
+DEFAULT_MULTICAST_GROUP = "239.255.42.1"
+DEFAULT_MULTICAST_PORT = 50002
+MULTICAST_TTL = 1
+
+# Seconds between two published frames. Fixes of a tag within one interval
+# are coalesced into its latest fix.
+PUBLISH_INTERVAL = 0.02
+
+# Bytes a subscriber may have waiting in its send buffer before it counts as
+# slow. Slow subscribers only get the latest fix of every tag once they catch up.
+MAX_BACKLOG_BYTES = 256 * 1024
+
+# Seconds a subscriber may stay slow before it is disconnected
+SLOW_SUBSCRIBER_TIMEOUT = 2.0
+
+
+class Subscriber(asyncio.Protocol):
+    """
+    One TCP subscriber. The stream is a sequence of fix frames (see
+    wire_format.encode_fixes), anything the subscriber sends is ignored.
+    """
+
+    def __init__(self, publisher):
+        self.publisher = publisher
+        self.transport = None
+        self.peer = None
+        # Tags whose latest fix still has to be sent, kept while the subscriber is slow
+        self.pending = np.zeros(ADDRESS_SPACE, dtype=bool)
+        self.has_pending = False
+        self.slow_since = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.peer = transport.get_extra_info("peername")
+        transport.set_write_buffer_limits(high=MAX_BACKLOG_BYTES)
+        self.publisher._add_subscriber(self)
+
+    def connection_lost(self, exc):
+        self.publisher._remove_subscriber(self)
+
+    def pause_writing(self):
+        self.slow_since = time.monotonic()
+
+    def resume_writing(self):
+        self.slow_since = None
+
+    def data_received(self, data):
+        pass
+
+    def mark_pending(self, tags):
+        self.pending[tags] = True
+        self.has_pending = True
+
+    def send(self, frames):
+        for frame in frames:
+            self.transport.write(frame)
+
+    def send_pending(self, latest):
+        tags = np.flatnonzero(self.pending)
+        self.pending[tags] = False
+        self.has_pending = False
+        self.send(encode_fixes(latest[tags]))
+
+
+class PositionPublisher:
+    """
+    Publishes position fixes to local subscribers over TCP and UDP multicast.
+
+    publish() only writes the fixes into a table holding the latest fix of
+    every tag address and marks them dirty, so it costs the ingest path a few
+    array stores no matter how many subscribers there are. A timer on the
+    same event loop sends the dirty fixes every PUBLISH_INTERVAL as batched
+    frames: one encoding shared by all subscribers, one datagram per
+    MAX_FIXES_PER_DATAGRAM fixes to the multicast group.
+
+    The kernel send buffer of a TCP subscriber absorbs short hiccups. Once its
+    backlog passes MAX_BACKLOG_BYTES the subscriber is slow: it gets no more
+    frames, only a mark for every tag that changed, and when it catches up it
+    receives the latest fix of those tags in one frame. A subscriber that
+    stays slow for SLOW_SUBSCRIBER_TIMEOUT is disconnected. Writes never
+    block, so a slow subscriber can't stall the solver.
+    """
+
+    def __init__(self, host=DEFAULT_PUBLISH_HOST, port=DEFAULT_PUBLISH_PORT, multicast=None,
+                 interval=PUBLISH_INTERVAL, metrics=None):
+        """
+        Args:
+            host: Interface the TCP server listens on
+            port: TCP port, None to publish over multicast only
+            multicast: Optional (group, port) to send every frame to
+            interval: Seconds between two published frames
+            metrics: Optional ClientMetrics counting published fixes and dropped subscribers
+        """
+        self.host = host
+        self.port = port
+        self.multicast = multicast
+        self.interval = interval
+        self.metrics = metrics
+
+        # Latest fix of every tag address, and which of them weren't sent yet
+        self.latest = np.zeros(ADDRESS_SPACE, dtype=FIX_DTYPE)
+        self.latest["tag"] = np.arange(ADDRESS_SPACE)
+        self.known = np.zeros(ADDRESS_SPACE, dtype=bool)
+        self.dirty = np.zeros(ADDRESS_SPACE, dtype=bool)
+        # Published times are Unix times, fixes carry monotonic ones
+        self.clock_offset = time.time() - time.monotonic()
+
+        self.subscribers = set()
+        self.server = None
+        self.sock = None
+        self._task = None
+
+        # Counters
+        self.frames_published = 0
+        self.fixes_published = 0
+        self.subscribers_dropped = 0
+
+    async def start(self):
+        """
+        Open the TCP server and multicast socket and start the publish timer.
+        """
+        loop = asyncio.get_running_loop()
+        if self.port is not None:
+            self.server = await loop.create_server(lambda: Subscriber(self), self.host, self.port)
+        if self.multicast is not None:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, MULTICAST_TTL)
+            self.sock.setblocking(False)
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    @property
+    def address(self):
+        """
+        (host, port) the TCP server listens on
+        """
+        return self.server.sockets[0].getsockname()[:2]
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Error publishing fixes: {e}")
+
+    def publish(self, tag_addresses, positions, times):
+        """
+        Queue fixes for the next frame, replacing older unsent fixes of the same tags.
+
+        Args:
+            tag_addresses: Array of tag addresses
+            positions: Array (K, 3) of positions in cm
+            times: Monotonic times of the fixes in seconds (array or scalar)
+        """
+        tags = np.asarray(tag_addresses, dtype=np.int64)
+        positions = np.asarray(positions, dtype=float)
+        latest = self.latest
+        latest["x"][tags] = positions[:, 0]
+        latest["y"][tags] = positions[:, 1]
+        latest["z"][tags] = positions[:, 2]
+        latest["time"][tags] = np.asarray(times, dtype=float) + self.clock_offset
+        self.dirty[tags] = True
+        self.known[tags] = True
+
+    def flush(self):
+        """
+        Send the fixes queued since the last flush to every subscriber.
+        """
+        tags = np.flatnonzero(self.dirty)
+        if not len(tags) and not any(subscriber.has_pending for subscriber in self.subscribers):
+            return
+        self.dirty[tags] = False
+        fixes = self.latest[tags]
+
+        if self.sock is not None and len(tags):
+            for frame in encode_fixes(fixes, MAX_FIXES_PER_DATAGRAM):
+                try:
+                    self.sock.sendto(frame, self.multicast)
+                except OSError as e:
+                    # A full socket buffer drops the frame, the next one has newer fixes
+                    if not isinstance(e, BlockingIOError):
+                        print(f"Error sending fixes to {self.multicast}: {e}")
+
+        frames = None
+        now = time.monotonic()
+        for subscriber in list(self.subscribers):
+            if subscriber.slow_since is not None:
+                subscriber.mark_pending(tags)
+                if now - subscriber.slow_since > SLOW_SUBSCRIBER_TIMEOUT:
+                    print(f"Disconnecting slow subscriber {subscriber.peer}")
+                    self.subscribers_dropped += 1
+                    if self.metrics is not None:
+                        self.metrics.subscribers_dropped.inc()
+                    subscriber.transport.abort()
+            elif subscriber.has_pending:
+                subscriber.mark_pending(tags)
+                subscriber.send_pending(self.latest)
+            elif len(tags):
+                if frames is None:
+                    frames = encode_fixes(fixes)
+                subscriber.send(frames)
+
+        if len(tags):
+            self.frames_published += 1
+            self.fixes_published += len(tags)
+            if self.metrics is not None:
+                self.metrics.fixes_published.inc(len(tags))
+
+    def _add_subscriber(self, subscriber):
+        self.subscribers.add(subscriber)
+        # New subscribers start with the latest fix of every known tag
+        subscriber.mark_pending(np.flatnonzero(self.known))
+        print(f"Subscriber {subscriber.peer} connected ({len(self.subscribers)} subscribers)")
+
+    def _remove_subscriber(self, subscriber):
+        if subscriber in self.subscribers:
+            self.subscribers.discard(subscriber)
+            print(f"Subscriber {subscriber.peer} disconnected ({len(self.subscribers)} subscribers)")
+
+    async def close(self):
+        """
+        Stop publishing and disconnect every subscriber.
+        """
+        if self._task is not None:
+            self._task.cancel()
+        if self.server is not None:
+            self.server.close()
+        for subscriber in list(self.subscribers):
+            subscriber.transport.abort()
+        if self.server is not None:
+            await self.server.wait_closed()
+        if self.sock is not None:
+            self.sock.close()
+
+
+async def subscribe(host=DEFAULT_PUBLISH_HOST, port=DEFAULT_PUBLISH_PORT):
+    """
+    Connect to a publisher over TCP and yield every frame of fixes.
+
+    Yields:
+        Structured arrays of wire_format.FIX_DTYPE
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while True:
+            header = await reader.readexactly(FIX_HEADER.size)
+            _, _, count = FIX_HEADER.unpack(header)
+            body = await reader.readexactly(count * FIX_DTYPE.itemsize)
+            yield decode_fixes(header + body)
+    finally:
+        writer.close()
+
+
+def open_multicast_listener(group=DEFAULT_MULTICAST_GROUP, port=DEFAULT_MULTICAST_PORT):
+    """
+    Returns:
+        UDP socket joined to the multicast group, each datagram is one frame of fixes
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("", port))
+    membership = struct.pack("4s4s", socket.inet_aton(group), socket.inet_aton("0.0.0.0"))
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+    return sock
+
+
+def print_fixes(fixes):
+    for fix in fixes:
+        print(f"Tag {fix['tag']} at ({fix['x']:.1f}, {fix['y']:.1f}, {fix['z']:.1f}) cm, "
+              f"{time.time() - fix['time']:.3f} s ago")
+
+
+async def print_stream(host, port):
+    async for fixes in subscribe(host, port):
+        print_fixes(fixes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print the position fixes published by trilateration.py")
+    parser.add_argument("--host", default=DEFAULT_PUBLISH_HOST, help="publisher host")
+    parser.add_argument("--port", type=int, default=DEFAULT_PUBLISH_PORT, help="publisher TCP port")
+    parser.add_argument("--multicast", action="store_true",
+                        help=f"listen on the multicast group {DEFAULT_MULTICAST_GROUP}:{DEFAULT_MULTICAST_PORT} instead")
+    args = parser.parse_args()
+
+    try:
+        if args.multicast:
+            sock = open_multicast_listener()
+            while True:
+                data, _ = sock.recvfrom(65536)
+                try:
+                    print_fixes(decode_fixes(data))
+                except ValueError as e:
+                    print(f"Invalid frame: {e}")
+        else:
+            asyncio.run(print_stream(args.host, args.port))
+    except (ConnectionError, asyncio.IncompleteReadError) as e:
+        print(f"Connection to publisher lost: {e}")
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
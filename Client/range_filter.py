@@ -0,0 +1,142 @@
+import numpy as np
+
+from tracking import unique_passes
+
+# Number of past readings per (tag, anchor) stream a new reading is compared against
+DEFAULT_WINDOW = 7
+
+# Readings further than this many robust standard deviations from the median are rejected
+DEFAULT_THRESHOLD = 3.0
+
+# Lower bound of the robust standard deviation in cm, so a stream whose recent
+# readings happen to agree doesn't reject ordinary noise (spread of Data_Collection)
+DEFAULT_MIN_SCALE = 20.0
+
+# Readings a stream needs before anything is rejected
+MIN_SAMPLES = 3
+
+# Scales the median absolute deviation to a standard deviation for Gaussian noise
+MAD_SCALE = 1.4826
+
+
+def window_medians(windows, counts):
+    """
+    Median of the first `counts` valid entries of every row, NaN marking empty slots.
+
+    Sorting pushes NaNs to the end of each row, so the median of a row with c
+    readings sits at positions (c - 1) // 2 and c // 2.
+    """
+    ordered = np.sort(windows, axis=1)
+    rows = np.arange(len(windows))
+    return (ordered[rows, (counts - 1) // 2] + ordered[rows, counts // 2]) / 2
+
+
+class HampelFilter:
+    """
+    Streaming Hampel filter on the raw ranges of every (tag, anchor) stream.
+
+    Each stream keeps its last `window` readings in a fixed-size ring buffer.
+    A new reading is rejected when it is further than `threshold` robust
+    standard deviations (scaled median absolute deviation) from the median of
+    the buffer. Every reading, rejected or not, enters the buffer: a single
+    wild value can't move the median, while a real jump (the tag moved fast)
+    is accepted as soon as it makes up half of the window.
+
+    Buffers live in one (T, N, window) array, and a batch is checked with one
+    sort over the windows of all its streams. The window is fixed, so the cost
+    per reading is constant.
+    """
+
+    def __init__(self, num_anchors, window=DEFAULT_WINDOW, threshold=DEFAULT_THRESHOLD,
+                 min_scale=DEFAULT_MIN_SCALE, tag_capacity=64):
+        """
+        Args:
+            num_anchors: Number of anchors (columns of the measurement table)
+            window: Number of past readings kept per stream
+            threshold: Rejection threshold in robust standard deviations
+            min_scale: Smallest robust standard deviation used, in cm
+            tag_capacity: Number of tag rows to preallocate
+        """
+        self.num_anchors = num_anchors
+        self.window = window
+        self.threshold = threshold
+        self.min_scale = min_scale
+        self.capacity = 0
+
+        # Counters
+        self.readings_checked = 0
+        self.readings_rejected = 0
+
+        self.ensure_capacity(max(1, tag_capacity))
+
+    def ensure_capacity(self, num_tags):
+        """
+        Grow the per-tag arrays so they hold at least `num_tags` tags.
+        """
+        if num_tags <= self.capacity:
+            return
+        capacity = max(num_tags, 2 * self.capacity)
+
+        def grow(name, shape, fill, dtype):
+            new = np.full(shape, fill, dtype=dtype)
+            old = getattr(self, name, None)
+            if old is not None:
+                new[:len(old)] = old
+            setattr(self, name, new)
+
+        grow("history", (capacity, self.num_anchors, self.window), np.nan, float)
+        grow("next_slot", (capacity, self.num_anchors), 0, np.int64)
+        grow("counts", (capacity, self.num_anchors), 0, np.int64)
+        self.capacity = capacity
+
+    def update(self, tag_indices, anchor_indices, distances):
+        """
+        Check a batch of readings and add them to their streams.
+
+        A stream may appear more than once in the batch, its readings are
+        checked in order.
+
+        Args:
+            tag_indices: Tag rows of the readings
+            anchor_indices: Anchor columns of the readings
+            distances: Distances in cm
+
+        Returns:
+            Boolean array, True for the readings that passed
+        """
+        tag_indices = np.asarray(tag_indices, dtype=np.int64)
+        anchor_indices = np.asarray(anchor_indices, dtype=np.int64)
+        distances = np.broadcast_to(np.asarray(distances, dtype=float), tag_indices.shape)
+        if len(tag_indices):
+            self.ensure_capacity(int(tag_indices.max()) + 1)
+
+        accepted = np.ones(len(tag_indices), dtype=bool)
+        streams = tag_indices * self.num_anchors + anchor_indices
+        for rows in unique_passes(streams):
+            accepted[rows] = self._update(tag_indices[rows], anchor_indices[rows], distances[rows])
+
+        self.readings_checked += len(tag_indices)
+        self.readings_rejected += int(np.count_nonzero(~accepted))
+        return accepted
+
+    def _update(self, tags, anchors, distances):
+        """
+        Check and insert readings of streams that each appear once.
+        """
+        counts = self.counts[tags, anchors]
+        accepted = np.ones(len(tags), dtype=bool)
+
+        judged = np.flatnonzero(counts >= MIN_SAMPLES)
+        if len(judged):
+            windows = self.history[tags[judged], anchors[judged]]
+            judged_counts = counts[judged]
+            medians = window_medians(windows, judged_counts)
+            deviations = window_medians(np.abs(windows - medians[:, None]), judged_counts)
+            scales = np.maximum(MAD_SCALE * deviations, self.min_scale)
+            accepted[judged] = np.abs(distances[judged] - medians) <= self.threshold * scales
+
+        slots = self.next_slot[tags, anchors]
+        self.history[tags, anchors, slots] = distances
+        self.next_slot[tags, anchors] = (slots + 1) % self.window
+        self.counts[tags, anchors] = np.minimum(counts + 1, self.window)
+        return accepted
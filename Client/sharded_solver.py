@@ -0,0 +1,320 @@
+import multiprocessing
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from location_engine import LocationEngine
+from measurement_table import ADDRESS_SPACE
+
+# One decoded reading as it sits in a shard's ring buffer
+RING_DTYPE = np.dtype([
+    ("tag", "<u2"),
+    ("anchor", "<u2"),
+    ("distance", "<f4"),
+    ("timestamp", "<f8"),
+])
+
+# Latest fix of every tag address, with the number of anchors it was solved
+# from. `version` is a sequence lock: odd while the owning worker is writing
+# the row, so readers can tell a torn copy.
+FIX_DTYPE = np.dtype([
+    ("version", "<u8"),
+    ("x", "<f8"),
+    ("y", "<f8"),
+    ("z", "<f8"),
+    ("time", "<f8"),
+    ("anchors", "<u2"),
+])
+
+# Slots of every shard's row in the control block
+HEAD, TAIL, READINGS_PROCESSED, FIXES_PUBLISHED, READINGS_DROPPED, RUNNING = range(6)
+CONTROL_SLOTS = 8
+
+# Readings every shard's ring can hold
+DEFAULT_RING_CAPACITY = 1 << 16
+
+# Most readings a worker takes from its ring at once
+MAX_WORKER_BATCH = 8192
+
+# Sleep of a worker whose ring is empty, in seconds
+IDLE_SLEEP = 0.001
+
+# Attempts at reading a consistent copy of fixes that are being written
+READ_RETRIES = 3
+
+DEFAULT_ENGINE_OPTIONS = {"quorum": 2, "tracker": True, "range_filter": True, "refine": True, "calibration": None}
+
+
+def build_engine(anchor_addresses, anchor_positions, options):
+    """
+    Build the LocationEngine of one worker from picklable options.
+
+    Args:
+        options: Dict with quorum, epoch_window (optional), tracker, range_filter
+            and refine (booleans), calibration (model path or None) and
+            best_anchors (subset size of a GdopMap, or None)
+    """
+    from calibration import CalibrationModel
+    from gdop import DEFAULT_MARGIN, GdopMap
+    from range_filter import HampelFilter
+    from tracking import TagTracker
+
+    kwargs = {"quorum": options.get("quorum", 2), "refine": options.get("refine", False)}
+    if "epoch_window" in options:
+        kwargs["epoch_window"] = options["epoch_window"]
+    if options.get("tracker"):
+        kwargs["tracker"] = TagTracker()
+    if options.get("range_filter"):
+        kwargs["range_filter"] = HampelFilter(len(anchor_addresses))
+    if options.get("calibration"):
+        kwargs["calibration"] = CalibrationModel.load(options["calibration"]).compile(anchor_addresses)
+    if options.get("best_anchors"):
+        kwargs["anchor_selector"] = GdopMap.around(anchor_positions, DEFAULT_MARGIN, subset_size=options["best_anchors"])
+    return LocationEngine(anchor_addresses, anchor_positions, **kwargs)
+
+
+class SharedArrays:
+    """
+    Numpy views of the shared memory blocks of a sharded solver.
+
+    The creating process owns (and unlinks) the blocks, workers attach to
+    them by name.
+    """
+
+    def __init__(self, num_shards, ring_capacity, names=None):
+        self.num_shards = num_shards
+        self.ring_capacity = ring_capacity
+        create = names is None
+        sizes = [num_shards * CONTROL_SLOTS * 8, ADDRESS_SPACE * FIX_DTYPE.itemsize] + \
+            [ring_capacity * RING_DTYPE.itemsize] * num_shards
+        if create:
+            self.blocks = [shared_memory.SharedMemory(create=True, size=size) for size in sizes]
+        else:
+            self.blocks = [shared_memory.SharedMemory(name=name) for name in names]
+
+        self.control = np.ndarray((num_shards, CONTROL_SLOTS), dtype=np.int64, buffer=self.blocks[0].buf)
+        self.fixes = np.ndarray(ADDRESS_SPACE, dtype=FIX_DTYPE, buffer=self.blocks[1].buf)
+        self.rings = [np.ndarray(ring_capacity, dtype=RING_DTYPE, buffer=block.buf) for block in self.blocks[2:]]
+        if create:
+            self.control[:] = 0
+            self.fixes[:] = np.zeros(1, dtype=FIX_DTYPE)
+            for field in ("x", "y", "z", "time"):
+                self.fixes[field] = np.nan
+
+    @property
+    def names(self):
+        return [block.name for block in self.blocks]
+
+    def close(self, unlink=False):
+        # Views must go before the mappings can be closed
+        self.control = self.fixes = self.rings = None
+        for block in self.blocks:
+            block.close()
+            if unlink:
+                block.unlink()
+
+
+def publish_fixes(fixes_table, tag_addresses, positions, times, anchors):
+    """
+    Write fixes into the shared table under the per-tag sequence lock.
+    """
+    fixes_table["version"][tag_addresses] += 1
+    fixes_table["x"][tag_addresses] = positions[:, 0]
+    fixes_table["y"][tag_addresses] = positions[:, 1]
+    fixes_table["z"][tag_addresses] = positions[:, 2]
+    fixes_table["time"][tag_addresses] = times
+    fixes_table["anchors"][tag_addresses] = anchors
+    fixes_table["version"][tag_addresses] += 1
+
+
+def run_worker(shard, names, num_shards, ring_capacity, anchor_addresses, anchor_positions, options):
+    """
+    Solver worker: drain the shard's ring into its own engine and publish the fixes.
+    """
+    shared = SharedArrays(num_shards, ring_capacity, names)
+    try:
+        drain_shard(shared, shard, build_engine(anchor_addresses, anchor_positions, options))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        shared.close()
+
+
+def drain_shard(shared, shard, engine):
+    """
+    Worker loop, until the shard is stopped. The views of the shared memory
+    it holds go away when it returns, so the blocks can be closed after it.
+    """
+    control = shared.control[shard]
+    ring = shared.rings[shard]
+    window = engine.synchronizer.window
+    last_flush = time.monotonic()
+
+    def publish(fixes, now):
+        tag_indices, positions, valid = fixes
+        if valid.any():
+            tag_indices = tag_indices[valid]
+            tag_addresses = engine.measurements.tag_addresses[tag_indices]
+            anchors = engine.measurements.position_anchors[tag_indices]
+            publish_fixes(shared.fixes, tag_addresses, positions[valid], now, anchors)
+            control[FIXES_PUBLISHED] += int(np.count_nonzero(valid))
+
+    while control[RUNNING]:
+        head, tail = int(control[HEAD]), int(control[TAIL])
+        count = min(head - tail, MAX_WORKER_BATCH)
+        now = time.monotonic()
+        if count:
+            readings = ring[(tail + np.arange(count)) % shared.ring_capacity]
+            control[TAIL] = tail + count
+            publish(engine.process_readings(
+                readings["tag"], readings["anchor"], readings["distance"], readings["timestamp"]
+            ), now)
+            control[READINGS_PROCESSED] += count
+
+        if now - last_flush >= window:
+            publish(engine.flush(now), now)
+            last_flush = now
+        if not count:
+            time.sleep(IDLE_SLEEP)
+
+
+class ShardedSolver:
+    """
+    Solves readings in a pool of worker processes, sharded by tag address.
+
+    The ingest process decodes readings and appends them to the ring buffer of
+    the shard owning each tag (tag address modulo the number of workers). Every
+    ring lives in shared memory and has a single writer (the ingest process)
+    and a single reader (its worker), coordinated by head and tail counters in
+    a shared control block, so readings cross processes without pickling or
+    locks. Each worker runs its own LocationEngine over its tags and writes
+    the fixes into a shared table indexed by tag address, which the ingest
+    process (or a UI) reads directly.
+
+    Since tags never share a worker, throughput grows with the number of
+    workers until the ingest process becomes the bottleneck.
+    """
+
+    def __init__(self, anchor_addresses, anchor_positions, num_workers, ring_capacity=DEFAULT_RING_CAPACITY,
+                 engine_options=None):
+        """
+        Args:
+            anchor_addresses: UWB addresses of the anchors
+            anchor_positions: Anchor coordinates (x, y, z) in cm, in the same order
+            num_workers: Number of solver processes
+            ring_capacity: Readings each shard's ring can hold
+            engine_options: Options of the worker engines, see build_engine
+        """
+        self.num_workers = num_workers
+        self.ring_capacity = ring_capacity
+        self.shared = SharedArrays(num_workers, ring_capacity)
+        self.shared.control[:, RUNNING] = 1
+        options = dict(DEFAULT_ENGINE_OPTIONS, **(engine_options or {}))
+
+        self.workers = [
+            multiprocessing.Process(
+                target=run_worker,
+                args=(shard, self.shared.names, num_workers, ring_capacity,
+                      list(anchor_addresses), np.asarray(anchor_positions, dtype=float), options),
+                daemon=True,
+            )
+            for shard in range(num_workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, tag_addresses, anchor_addresses, distances, timestamps=None):
+        """
+        Hand a batch of readings to the workers owning their tags.
+
+        Readings that don't fit in a full ring are dropped and counted.
+
+        Args:
+            tag_addresses: Array of tag addresses
+            anchor_addresses: Array of anchor addresses
+            distances: Array of distances in cm
+            timestamps: Receive times in seconds (array or scalar), defaults to time.monotonic()
+
+        Returns:
+            Number of readings accepted
+        """
+        tag_addresses = np.asarray(tag_addresses, dtype=np.int64)
+        readings = np.empty(len(tag_addresses), dtype=RING_DTYPE)
+        readings["tag"] = tag_addresses
+        readings["anchor"] = anchor_addresses
+        readings["distance"] = distances
+        readings["timestamp"] = time.monotonic() if timestamps is None else timestamps
+
+        # Stable sort keeps every shard's readings in arrival order
+        shards = tag_addresses % self.num_workers
+        order = np.argsort(shards, kind="stable")
+        bounds = np.searchsorted(shards[order], np.arange(self.num_workers + 1))
+        accepted = 0
+        for shard in range(self.num_workers):
+            rows = order[bounds[shard]:bounds[shard + 1]]
+            if len(rows):
+                accepted += self._push(shard, readings[rows])
+        return accepted
+
+    def _push(self, shard, readings):
+        control = self.shared.control[shard]
+        head, tail = int(control[HEAD]), int(control[TAIL])
+        count = min(len(readings), self.ring_capacity - (head - tail))
+        if count < len(readings):
+            control[READINGS_DROPPED] += len(readings) - count
+        if count:
+            self.shared.rings[shard][(head + np.arange(count)) % self.ring_capacity] = readings[:count]
+            # Publish only after the records are in place
+            control[HEAD] = head + count
+        return count
+
+    def latest_fixes(self, tag_addresses):
+        """
+        Read the latest fixes of a set of tags.
+
+        Returns:
+            Tuple (positions, times, anchors): array of shape (K, 3) in cm,
+            the monotonic time of every fix, NaN for tags without one, and
+            the number of anchors every fix was solved from
+        """
+        tag_addresses = np.asarray(tag_addresses, dtype=np.int64)
+        table = self.shared.fixes
+        result = np.empty(len(tag_addresses), dtype=FIX_DTYPE)
+        pending = np.arange(len(tag_addresses))
+        for _ in range(READ_RETRIES):
+            before = table["version"][tag_addresses[pending]]
+            result[pending] = table[tag_addresses[pending]]
+            after = table["version"][tag_addresses[pending]]
+            pending = pending[(before != after) | (before % 2 == 1)]
+            if not len(pending):
+                break
+        # Rows still being written after the retries keep whatever copy was read last
+        positions = np.stack([result["x"], result["y"], result["z"]], axis=1)
+        return positions, result["time"], result["anchors"]
+
+    def stats(self):
+        """
+        Returns:
+            Dict with readings queued, processed and dropped and fixes published, summed over shards
+        """
+        control = self.shared.control
+        return {
+            "readings_queued": int((control[:, HEAD] - control[:, TAIL]).sum()),
+            "readings_processed": int(control[:, READINGS_PROCESSED].sum()),
+            "readings_dropped": int(control[:, READINGS_DROPPED].sum()),
+            "fixes_published": int(control[:, FIXES_PUBLISHED].sum()),
+        }
+
+    def close(self, timeout=2.0):
+        """
+        Stop the workers and release the shared memory.
+        """
+        if self.shared.control is None:
+            return
+        self.shared.control[:, RUNNING] = 0
+        for worker in self.workers:
+            worker.join(timeout)
+            if worker.is_alive():
+                worker.terminate()
+        self.shared.close(unlink=True)
@@ -0,0 +1,124 @@
+import time
+
+import numpy as np
+
+
+class TagRenderer:
+    """
+    Draws the tag positions of a measurement table on top of a static plot.
+
+    The background (room rectangles, anchors, grid, axes) is rendered once and
+    cached as a bitmap. On every tick only the tag markers and labels are
+    drawn over a copy of it and blitted to the screen. The markers of all
+    tags are a single Line2D updated in place with set_data, each tag has one
+    label that is moved rather than recreated, and nothing is drawn at all
+    when no new fix arrived since the last tick.
+
+    The cached background is refreshed automatically whenever the canvas does
+    a full draw (window resize, axes changes), so callers only need to call
+    canvas.draw() after changing the static part of the plot.
+    """
+
+    def __init__(self, canvas, ax, marker="ro", blit=True, metrics=None):
+        """
+        Args:
+            canvas: Matplotlib canvas the axes are drawn on
+            ax: Axes holding the static background
+            marker: Format string of the tag markers
+            blit: Blit the tags over the cached background, or fall back to
+                full redraws (only when a fix arrived) on canvases that can't blit
+            metrics: Optional ClientMetrics recording the frame time
+        """
+        self.canvas = canvas
+        self.ax = ax
+        self.marker = marker
+        self.blit = blit and getattr(canvas, "supports_blit", False)
+        self.metrics = metrics
+        self.background = None
+        self.canvas.mpl_connect("draw_event", self._on_draw)
+        self.reset()
+
+    def reset(self):
+        """
+        Recreate the tag artists, needed after the axes were cleared.
+        """
+        self.points = self.ax.plot([], [], self.marker, animated=self.blit)[0]
+        self.labels = {}
+        self.background = None
+        # Table update count and per-tag fix times at the last render
+        self.rendered_updates = -1
+        self.rendered_times = np.empty(0)
+
+    def _on_draw(self, event):
+        """
+        A full draw happened: cache the new background and put the tags back on it.
+        """
+        if not self.blit:
+            return
+        self.background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self._draw_tags()
+
+    def _draw_tags(self):
+        self.ax.draw_artist(self.points)
+        for label in self.labels.values():
+            self.ax.draw_artist(label)
+
+    def update(self, measurements):
+        """
+        Render the latest fixes of every tag, if any arrived since the last call.
+
+        Args:
+            measurements: MeasurementTable holding the fixes
+
+        Returns:
+            True if the plot was redrawn
+        """
+        if measurements.position_updates == self.rendered_updates:
+            return False
+        self.rendered_updates = measurements.position_updates
+        start = time.perf_counter()
+
+        num_tags = measurements.num_tags
+        tags = np.flatnonzero(measurements.position_valid[:num_tags])
+        positions = measurements.positions[tags]
+        self.points.set_data(positions[:, 0], -positions[:, 1])
+
+        # Only the labels of tags with a new fix are touched
+        times = measurements.position_timestamps[:num_tags]
+        if len(self.rendered_times) < num_tags:
+            self.rendered_times = np.concatenate([self.rendered_times, np.full(num_tags - len(self.rendered_times), np.nan)])
+        changed = tags[times[tags] != self.rendered_times[tags]]
+        self.rendered_times[changed] = times[changed]
+        for tag in changed:
+            self._move_label(int(measurements.tag_addresses[tag]), measurements.positions[tag])
+
+        self.render()
+        if self.metrics is not None:
+            self.metrics.ui_frame_time.observe(time.perf_counter() - start)
+        return True
+
+    def _move_label(self, tag_address, position):
+        text = f"Tag {tag_address} ({position[0]:.2f}, {position[1]:.2f})"
+        xy = (position[0], -position[1])
+        label = self.labels.get(tag_address)
+        if label is None:
+            self.labels[tag_address] = self.ax.annotate(
+                text, xy, textcoords="offset points", xytext=(5, 5), ha="center", animated=self.blit
+            )
+        else:
+            label.xy = xy
+            label.set_text(text)
+
+    def render(self):
+        """
+        Put the current tag artists on screen.
+        """
+        if not self.blit:
+            self.canvas.draw_idle()
+        elif self.background is None:
+            # Nothing cached yet, the full draw caches the background and draws the tags
+            self.canvas.draw_idle()
+        else:
+            self.canvas.restore_region(self.background)
+            self._draw_tags()
+            self.canvas.blit(self.ax.bbox)
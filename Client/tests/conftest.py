@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The client modules are flat scripts imported by name, as they are when run from Client/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
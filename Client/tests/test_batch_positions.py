@@ -0,0 +1,102 @@
+import json
+
+import numpy as np
+import pytest
+
+import trilateration
+from batch_positions import CaptureSolver
+from gdop import DEFAULT_MARGIN, GdopMap
+from packet_log import PacketRecorder
+from trilateration import ANCHOR_ADDRESSES, ANCHOR_POSITIONS, create_engine
+from wire_format import MAX_READINGS_PER_PACKET, encode_readings
+
+# Unix time the simulated capture starts at
+START_TIME = 1.7e9
+
+
+class RecordingHistory:
+    """
+    Collects the fixes appended to a position history instead of writing them.
+    """
+
+    def __init__(self):
+        self.clock_offset = None
+        self.rows = []
+
+    def append(self, tag_addresses, positions, times, quality=None):
+        for row in zip(tag_addresses, *np.asarray(positions).T, np.broadcast_to(times, len(tag_addresses)), quality):
+            self.rows.append(tuple(float(value) for value in row))
+
+
+def record_capture(path, duration=8.0, num_tags=12, seed=1):
+    """
+    Record a capture of tags walking around the anchors. The first two anchors
+    send binary packets, the third one JSON packets and goes silent for a while.
+    """
+    rng = np.random.default_rng(seed)
+    anchors = np.asarray(ANCHOR_POSITIONS, dtype=float)
+    tags = np.column_stack([rng.uniform(100, 550, num_tags), rng.uniform(100, 500, num_tags), np.full(num_tags, 20.0)])
+    velocities = np.column_stack([rng.normal(0, 40, (num_tags, 2)), np.zeros(num_tags)])
+    phases = rng.uniform(0, 0.1, len(ANCHOR_ADDRESSES))
+    address = ("192.168.1.170", 50000)
+    recorder = PacketRecorder(path)
+    try:
+        for tick in np.arange(0.0, duration, 0.02):
+            tags += velocities * 0.02
+            datagrams = []
+            for anchor, anchor_address in enumerate(ANCHOR_ADDRESSES):
+                polled = np.floor((tick - phases[anchor]) / 0.1) != np.floor((tick - 0.02 - phases[anchor]) / 0.1)
+                if not polled or (anchor == 2 and 3.0 < tick < 5.5):
+                    continue
+                distances = np.linalg.norm(tags - anchors[anchor], axis=1) + rng.normal(0, 3, num_tags)
+                distances[rng.random(num_tags) < 0.02] += 400
+                reported = np.flatnonzero(rng.random(num_tags) > 0.05)
+                if anchor < 2:
+                    for rows in np.array_split(reported, len(reported) // MAX_READINGS_PER_PACKET + 2):
+                        datagrams.append((encode_readings(
+                            np.full(len(rows), anchor_address), rows + 1, distances[rows], np.zeros(len(rows)),
+                            np.zeros(len(rows)),
+                        ), address))
+                else:
+                    for row in reported:
+                        datagrams.append((json.dumps({
+                            "device_address": anchor_address, "tag_address": int(row + 1),
+                            "distance": f"{distances[row]:.1f} cm",
+                        }).encode(), address))
+            if int(tick / 0.02) % 50 == 7:
+                datagrams.append((b"not json", address))
+            rng.shuffle(datagrams)
+            if datagrams:
+                recorder.record_batch(datagrams, START_TIME + tick)
+    finally:
+        recorder.close()
+
+
+def create_selecting_engine(best_anchors):
+    engine = create_engine()
+    if best_anchors:
+        # As with --best-anchors, the anchor going silent takes its subsets offline
+        engine.anchor_selector = GdopMap.around(engine.anchor_positions, DEFAULT_MARGIN, subset_size=3)
+        engine.anchor_selector.set_online(engine.health.healthy())
+    return engine
+
+
+@pytest.mark.parametrize("best_anchors", [False, True])
+def test_batch_solve_matches_replay(tmp_path, monkeypatch, best_anchors):
+    path = str(tmp_path / "capture.uwb")
+    # Enough tags that some anchor subsets are solved for a single tag in a replay
+    record_capture(path, num_tags=40, seed=2)
+
+    replayed = RecordingHistory()
+    monkeypatch.setattr(trilateration, "engine", create_selecting_engine(best_anchors))
+    monkeypatch.setattr(trilateration, "history", replayed)
+    trilateration.replay_capture(path, None)
+
+    solved = RecordingHistory()
+    solver = CaptureSolver(create_selecting_engine(best_anchors), solved)
+    # Small chunks, so receive batches continue across chunks
+    solver.solve(path, chunk_records=97)
+
+    assert len(replayed.rows) > 2000
+    assert {row[-1] for row in replayed.rows} == {2.0, 3.0}
+    assert solved.rows == replayed.rows
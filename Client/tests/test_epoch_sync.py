@@ -0,0 +1,122 @@
+import numpy as np
+
+from epoch_sync import EpochSynchronizer
+
+
+def test_epoch_closes_once_every_anchor_reported():
+    sync = EpochSynchronizer(3)
+
+    tags, distances, times = sync.add([0, 0], [0, 1], [100.0, 200.0], [1.0, 1.01])
+    assert len(tags) == 0
+
+    tags, distances, times = sync.add([0], [2], [300.0], [1.02])
+    np.testing.assert_array_equal(tags, [0])
+    np.testing.assert_array_equal(distances, [[100.0, 200.0, 300.0]])
+    np.testing.assert_array_equal(times, [1.0])
+    assert sync.epochs_emitted == 1
+    assert sync.epochs_incomplete == 0
+
+
+def test_expected_anchors_leave_out_degraded_ones():
+    sync = EpochSynchronizer(4, quorum=3)
+    sync.set_expected([True, True, True, False])
+
+    tags, distances, _ = sync.add([0, 0, 0], [0, 1, 2], [1.0, 2.0, 3.0], [1.0, 1.0, 1.0])
+
+    np.testing.assert_array_equal(tags, [0])
+    assert np.isnan(distances[0, 3])
+    assert sync.epochs_incomplete == 1
+
+
+def test_expired_window_closes_the_epoch_with_quorum():
+    sync = EpochSynchronizer(4, window=0.1, quorum=3)
+    sync.add([0, 0, 0], [0, 1, 2], [1.0, 2.0, 3.0], [1.0, 1.02, 1.04])
+
+    # Nothing expired yet
+    assert len(sync.flush(1.05)[0]) == 0
+    tags, distances, times = sync.flush(1.2)
+
+    np.testing.assert_array_equal(tags, [0])
+    np.testing.assert_array_equal(distances, [[1.0, 2.0, 3.0, np.nan]])
+    np.testing.assert_array_equal(times, [1.0])
+    assert sync.epochs_incomplete == 1
+
+
+def test_late_reading_closes_the_expired_epoch_and_opens_a_new_one():
+    sync = EpochSynchronizer(4, window=0.1, quorum=3)
+    sync.add([0, 0, 0], [0, 1, 2], [1.0, 2.0, 3.0], [1.0, 1.02, 1.04])
+
+    tags, _, times = sync.add([0], [3], [4.0], [1.5])
+
+    np.testing.assert_array_equal(tags, [0])
+    np.testing.assert_array_equal(times, [1.0])
+    assert sync.epoch_start[0] == 1.5
+    assert sync.epoch_received[0].tolist() == [False, False, False, True]
+
+
+def test_anchor_repeat_closes_the_epoch():
+    sync = EpochSynchronizer(4, quorum=3)
+    sync.add([0, 0, 0], [0, 1, 2], [1.0, 2.0, 3.0], [1.0, 1.01, 1.02])
+
+    # Anchor 0 reporting again starts the next round
+    tags, distances, _ = sync.add([0], [0], [1.5], [1.03])
+
+    np.testing.assert_array_equal(tags, [0])
+    np.testing.assert_array_equal(distances, [[1.0, 2.0, 3.0, np.nan]])
+    assert sync.epoch_distances[0, 0] == 1.5
+
+
+def test_newer_sequence_closes_the_epoch_and_repeats_are_replaced():
+    sync = EpochSynchronizer(4, quorum=2)
+    sync.add([0, 0, 0], [0, 1, 1], [1.0, 2.0, 2.5], [1.0, 1.01, 1.02], sequences=[7, 7, 7])
+    assert sync.readings_replaced == 1
+
+    tags, distances, _ = sync.add([0], [0], [1.5], [1.03], sequences=[8])
+
+    np.testing.assert_array_equal(tags, [0])
+    np.testing.assert_array_equal(distances, [[1.0, 2.5, np.nan, np.nan]])
+    assert sync.epoch_sequence[0] == 8
+
+
+def test_stale_readings_are_dropped():
+    sync = EpochSynchronizer(4)
+    sync.add([0], [0], [1.0], [2.0])
+    sync.add([0], [1], [2.0], [1.9])
+    assert sync.readings_stale == 1
+
+    sync.add([0], [1], [2.0], [2.01], sequences=[5])
+    sync.add([0], [2], [3.0], [2.02], sequences=[4])
+    assert sync.readings_stale == 2
+    assert not sync.epoch_received[0, 2]
+
+
+def test_epochs_below_quorum_are_dropped_and_counted():
+    sync = EpochSynchronizer(4, window=0.1, quorum=3)
+    sync.add([0, 0, 1], [0, 1, 0], [1.0, 2.0, 3.0], [1.0, 1.0, 1.0])
+
+    tags, _, _ = sync.flush(2.0)
+
+    assert len(tags) == 0
+    assert sync.epochs_dropped == 2
+    assert sync.readings_dropped == 3
+    assert np.isnan(sync.epoch_start[:2]).all()
+
+
+def test_readings_of_one_tag_in_a_batch_are_taken_in_order():
+    sync = EpochSynchronizer(2, quorum=2)
+
+    tags, distances, _ = sync.add([0, 0, 1, 0, 0], [0, 1, 0, 0, 1], [1.0, 2.0, 5.0, 3.0, 4.0], 1.0)
+
+    np.testing.assert_array_equal(tags, [0, 0])
+    np.testing.assert_array_equal(distances, [[1.0, 2.0], [3.0, 4.0]])
+    assert sync.epoch_received[1].tolist() == [True, False]
+
+
+def test_windows_follow_the_polling_period_but_not_below_the_default():
+    sync = EpochSynchronizer(3, window=0.1, quorum=2)
+    sync.set_windows([0, 1, 2], [0.5, 0.05, np.nan])
+
+    np.testing.assert_array_equal(sync.windows[:3], [0.5, 0.1, 0.1])
+    sync.add([0, 0], [0, 1], [1.0, 2.0], [1.0, 1.0])
+    assert len(sync.flush(1.3)[0]) == 0
+    assert len(sync.flush(1.6)[0]) == 1
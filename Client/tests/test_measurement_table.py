@@ -0,0 +1,62 @@
+import numpy as np
+
+from measurement_table import MeasurementTable
+
+ANCHORS = [10, 11, 12, 13]
+
+
+def test_addresses_map_to_rows_and_columns():
+    table = MeasurementTable(ANCHORS)
+
+    assert [table.anchor_index(address) for address in ANCHORS] == [0, 1, 2, 3]
+    assert table.anchor_index(14) == -1
+    np.testing.assert_array_equal(table.anchor_indices([13, 99, 10]), [3, -1, 0])
+
+    assert table.tag_index(500, create=False) == -1
+    assert table.tag_index(500) == 0
+    np.testing.assert_array_equal(table.tag_indices([7, 500, 7, 65535]), [1, 0, 1, 2])
+    assert table.num_tags == 3
+    np.testing.assert_array_equal(table.tag_addresses[:3], [500, 7, 65535])
+
+
+def test_batches_skip_unknown_anchors_and_keep_the_last_reading():
+    table = MeasurementTable(ANCHORS)
+
+    rows = table.update_many([1, 1, 2, 1], [10, 99, 11, 10], [100.0, 1.0, 200.0, 150.0], [1.0, 2.0, 3.0, 4.0])
+
+    np.testing.assert_array_equal(rows, [0, 1])
+    assert table.distances[0, 0] == 150.0
+    assert table.timestamps[0, 0] == 4.0
+    assert table.distances[1, 1] == 200.0
+    assert np.isnan(table.distances[0, 1:]).all()
+    assert table.update(1, 99, 5.0) == -1
+
+
+def test_storage_grows_and_keeps_what_was_stored():
+    table = MeasurementTable(ANCHORS, tag_capacity=2)
+    table.update_many([1, 2], [10, 11], [100.0, 200.0], 1.0)
+    table.store_positions([0, 1], [[1.0, 2.0, 3.0], [4.0, 5.0, 6.0]], [True, False], 1.0, anchors=[3, 4])
+
+    tags = np.arange(3, 40)
+    table.update_many(tags, np.full(len(tags), 12), tags * 10.0, 2.0)
+
+    assert table.capacity == 64
+    assert table.num_tags == 39
+    assert table.distances[0, 0] == 100.0
+    assert table.distances[1, 1] == 200.0
+    assert table.distances[table.tag_index(39), 2] == 390.0
+    assert table.latest_position(1) == (1.0, 2.0, 3.0)
+    assert table.latest_position(2) is None
+    assert table.position_anchors[0] == 3
+    # Rows added by the growth start out empty
+    assert np.isnan(table.distances[39:]).all()
+    assert not table.position_valid[2:].any()
+    np.testing.assert_array_equal(table.tag_addresses[39:], -1)
+
+
+def test_complete_tags_counts_only_the_given_anchors():
+    table = MeasurementTable(ANCHORS)
+    table.update_many([1, 1, 1, 2, 2, 2], [10, 11, 12, 10, 11, 13], np.full(6, 100.0), 1.0)
+
+    np.testing.assert_array_equal(table.complete_tags(), [0, 1])
+    np.testing.assert_array_equal(table.complete_tags(anchors=np.array([True, True, True, False])), [0])
@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+from multilateration import AnchorGeometry, refine_positions, solve_positions
+
+# Four anchors at the corners of a 6 m x 4 m room, all at the same height
+ANCHORS = np.array([[0.0, 0.0, 80.0], [600.0, 0.0, 80.0], [600.0, 400.0, 80.0], [0.0, 400.0, 80.0]])
+
+
+def ranges(tags, anchors=ANCHORS):
+    return np.linalg.norm(tags[:, None, :] - anchors[None, :, :], axis=2)
+
+
+def test_exact_ranges_give_exact_positions():
+    rng = np.random.default_rng(0)
+    tags = np.column_stack([rng.uniform(0, 600, 50), rng.uniform(0, 400, 50), np.full(50, 80.0)])
+
+    positions, valid = solve_positions(ranges(tags), ANCHORS)
+
+    assert valid.all()
+    np.testing.assert_allclose(positions[:, :2], tags[:, :2], atol=1e-6)
+    np.testing.assert_allclose(positions[:, 2], 80.0)
+
+
+def test_missing_anchors_use_the_remaining_subset():
+    tags = np.array([[150.0, 100.0, 80.0], [300.0, 200.0, 80.0], [450.0, 300.0, 80.0], [100.0, 350.0, 80.0]])
+    distances = ranges(tags)
+    distances[0, 1] = np.nan
+    distances[2, 3] = np.nan
+    # Two anchors are not enough for a fix
+    distances[3, [0, 2]] = np.nan
+
+    positions, valid = solve_positions(distances, AnchorGeometry(ANCHORS))
+
+    np.testing.assert_array_equal(valid, [True, True, True, False])
+    np.testing.assert_allclose(positions[:3, :2], tags[:3, :2], atol=1e-6)
+    assert np.isnan(positions[3]).all()
+
+
+def test_fixes_do_not_depend_on_the_other_tags_of_the_batch():
+    rng = np.random.default_rng(1)
+    tags = np.column_stack([rng.uniform(0, 600, 40), rng.uniform(0, 400, 40), np.full(40, 80.0)])
+    distances = ranges(tags) + rng.normal(0, 5, (40, 4))
+    geometry = AnchorGeometry(ANCHORS)
+
+    together, _ = geometry.solve(distances)
+    alone = np.concatenate([geometry.solve(distances[row:row + 1])[0] for row in range(len(distances))])
+
+    # Bit for bit, so batch_positions.py can solve epochs in other groups than a replay
+    np.testing.assert_array_equal(alone, together)
+
+
+def test_collinear_subset_is_degenerate():
+    anchors = np.array([[0.0, 0.0], [300.0, 0.0], [600.0, 0.0], [0.0, 400.0]])
+    distances = ranges(np.array([[200.0, 150.0]]), anchors)
+    distances[0, 3] = np.nan
+
+    positions, valid = solve_positions(distances, anchors)
+
+    assert not valid[0]
+    assert np.isnan(positions[0]).all()
+
+
+def test_wrong_number_of_distances_is_reported():
+    with pytest.raises(ValueError, match="Expected 4 anchor distances, got 3"):
+        AnchorGeometry(ANCHORS).solve(np.ones((2, 3)))
+
+
+def test_refinement_recovers_height():
+    anchors = ANCHORS.copy()
+    anchors[:, 2] = [80.0, 250.0, 80.0, 250.0]
+    tags = np.array([[150.0, 100.0, 120.0], [420.0, 310.0, 40.0]])
+
+    positions, valid, residuals, _ = refine_positions(ranges(tags, anchors), anchors, tag_height=100.0)
+
+    assert valid.all()
+    np.testing.assert_allclose(positions, tags, atol=1e-3)
+    np.testing.assert_allclose(residuals, 0.0, atol=1e-3)
@@ -0,0 +1,112 @@
+import numpy as np
+
+from epoch_sync import EpochSynchronizer
+from location_engine import LocationEngine
+from polling_scheduler import PERIOD_STEPS_MS, PollingScheduler
+from tracking import TagTracker
+
+ANCHOR_ADDRESSES = [10, 11, 12, 13]
+ANCHORS = np.array([[0.0, 0.0, 80.0], [600.0, 0.0, 80.0], [600.0, 400.0, 80.0], [0.0, 400.0, 80.0]])
+
+# Interval in seconds of the client's flush and polling timers
+TICK = 0.1
+
+
+def simulate(engine, tag_path, duration, seed=0):
+    """
+    Run anchors on unsynchronized timers at the periods the scheduler sends
+    them, with a client flushing epochs and sending updates every TICK. An
+    anchor restarts its timer when it gets a new period, at no particular
+    phase relative to the other anchors.
+
+    Returns:
+        Times of the fixes and the polling period of every anchor at every tick
+    """
+    rng = np.random.default_rng(seed)
+    periods = np.full(len(ANCHORS), 0.1)
+    next_report = rng.uniform(0, 0.1, len(ANCHORS))
+    fix_times, period_log = [], []
+    for now in np.arange(TICK, duration, TICK):
+        times, anchors = [], []
+        for anchor in range(len(ANCHORS)):
+            while next_report[anchor] <= now:
+                times.append(next_report[anchor])
+                anchors.append(anchor)
+                next_report[anchor] += periods[anchor]
+        order = np.argsort(times)
+        times, anchors = np.array(times)[order], np.array(anchors, dtype=np.int64)[order]
+        if len(times):
+            tags = np.array([tag_path(t) for t in times])
+            distances = np.linalg.norm(tags - ANCHORS[anchors], axis=1) + rng.normal(0, 5, len(times))
+            tag_indices, _, valid = engine.process_readings(
+                np.ones(len(times), dtype=np.int64), np.asarray(ANCHOR_ADDRESSES)[anchors], distances, times
+            )
+            fix_times.extend([now] * int(np.count_nonzero(valid)))
+        _, _, valid = engine.flush(now)
+        fix_times.extend([now] * int(np.count_nonzero(valid)))
+        for anchor_indices, period_ms in engine.scheduler.due_updates(now):
+            periods[anchor_indices] = period_ms / 1000
+            next_report[anchor_indices] = now + rng.uniform(0, period_ms / 1000, len(anchor_indices))
+        period_log.append(periods.copy())
+    return np.array(fix_times), np.array(period_log)
+
+
+def make_engine():
+    return LocationEngine(
+        ANCHOR_ADDRESSES, ANCHORS, quorum=2, tracker=TagTracker(), scheduler=PollingScheduler(len(ANCHORS)),
+        refine=True,
+    )
+
+
+def test_stationary_tag_keeps_getting_fixes_at_the_slowest_period():
+    engine = make_engine()
+
+    fix_times, periods = simulate(engine, lambda t: np.array([250.0, 150.0, 80.0]), duration=60.0)
+
+    # The tag is stationary, so the anchors drop to the slowest period...
+    np.testing.assert_array_equal(periods[-1], PERIOD_STEPS_MS[-1] / 1000)
+    # ...and their unsynchronized rounds still make one fix per period
+    late = fix_times[fix_times > 30.0]
+    assert len(late) >= 0.8 * 30.0 / (PERIOD_STEPS_MS[-1] / 1000)
+    assert engine.synchronizer.windows[0] >= PERIOD_STEPS_MS[-1] / 1000
+
+
+def test_tag_that_starts_moving_speeds_the_anchors_up():
+    engine = make_engine()
+
+    def path(t):
+        # Stationary for 40 s, then walking at 1 m/s along the room
+        return np.array([100.0 + 100.0 * max(t - 40.0, 0.0) % 400.0, 200.0, 80.0])
+
+    _, periods = simulate(engine, path, duration=50.0)
+
+    ticks = np.arange(TICK, 50.0, TICK)
+    assert periods[ticks < 40.0][-1].max() == PERIOD_STEPS_MS[-1] / 1000
+    assert periods[ticks > 45.0].max() <= 0.5
+
+
+def test_changing_ranges_raise_the_speed_without_fixes():
+    scheduler = PollingScheduler(1)
+    scheduler.observe_fixes([0], [[100.0, 100.0, 80.0]], 0.0, velocities=[[0.0, 0.0]])
+    assert scheduler.tag_periods([0])[0] == PERIOD_STEPS_MS[-1]
+
+    # Noise alone doesn't count as motion
+    scheduler.observe_ranges([0, 0], [0, 0], [300.0, 330.0], [0.0, 2.0])
+    assert scheduler.tag_periods([0])[0] == PERIOD_STEPS_MS[-1]
+    # 2 m in 2 s is at least (200 - 60) / 2 cm/s, which wants rounds of 20 / 70 s
+    scheduler.observe_ranges([0], [0], [530.0], 4.0)
+    assert scheduler.tag_periods([0])[0] == 200
+
+
+def test_epoch_windows_follow_the_periods_sent():
+    scheduler = PollingScheduler(2)
+    scheduler.observe_readings([0, 0, 1], [0, 1, 1], 0.0)
+    assert np.isnan(scheduler.epoch_windows([0, 1], 0.0)).all()
+
+    scheduler.requested[:] = [2000.0, 500.0]
+    scheduler.applied[:] = True
+    np.testing.assert_array_equal(scheduler.epoch_windows([0, 1], 1.0), [2.0, 0.5])
+
+    synchronizer = EpochSynchronizer(2, window=0.1)
+    synchronizer.set_windows([0, 1, 2], [2.0, np.nan, 0.05])
+    np.testing.assert_array_equal(synchronizer.windows[:3], [2.0, 0.1, 0.1])
@@ -0,0 +1,92 @@
+import os
+
+import numpy as np
+
+from position_history import BLOCK_ROWS, PositionHistory
+
+CHUNK_ROWS = 2 * BLOCK_ROWS
+NUM_CHUNKS = 5
+
+
+def write_history(path):
+    """
+    Fill NUM_CHUNKS chunks with one fix every 10 ms, alternating between tags 1 and 2.
+
+    Returns:
+        Times of the fixes
+    """
+    history = PositionHistory(path, chunk_rows=CHUNK_ROWS, block=True)
+    history.clock_offset = 0.0
+    rows = NUM_CHUNKS * CHUNK_ROWS
+    times = np.arange(rows) * 0.01
+    tags = 1 + np.arange(rows) % 2
+    positions = np.stack([times, -times, np.zeros(rows)], axis=1)
+    history.append(tags, positions, times, quality=3)
+    history.close()
+    return times
+
+
+def loaded_chunks(monkeypatch):
+    """
+    Record the chunk directories every np.load reads from.
+    """
+    chunks = set()
+    load = np.load
+
+    def recording_load(file, *args, **kwargs):
+        directory = os.path.basename(os.path.dirname(file))
+        if directory.isdigit():
+            chunks.add(int(directory))
+        return load(file, *args, **kwargs)
+
+    monkeypatch.setattr(np, "load", recording_load)
+    return chunks
+
+
+def test_query_reads_only_the_chunks_overlapping_its_range(tmp_path, monkeypatch):
+    times = write_history(tmp_path)
+    history = PositionHistory(tmp_path)
+    try:
+        assert len(history.index) == NUM_CHUNKS
+        np.testing.assert_array_equal(history.index["rows"], CHUNK_ROWS)
+
+        # From the second block of chunk 2 into the first block of chunk 3
+        start, end = times[2 * CHUNK_ROWS + BLOCK_ROWS + 100], times[3 * CHUNK_ROWS + 50]
+        chunks = loaded_chunks(monkeypatch)
+        fixes = history.query(start, end)
+
+        assert chunks == {2, 3}
+        expected = times[(times >= start) & (times < end)]
+        np.testing.assert_array_equal(fixes["time"], expected)
+        np.testing.assert_allclose(fixes["x"], expected, rtol=1e-6)
+        np.testing.assert_array_equal(fixes["quality"], 3)
+    finally:
+        history.close()
+
+
+def test_query_outside_the_history_reads_no_chunk(tmp_path, monkeypatch):
+    times = write_history(tmp_path)
+    history = PositionHistory(tmp_path)
+    try:
+        chunks = loaded_chunks(monkeypatch)
+
+        assert len(history.query(times[-1] + 1.0)) == 0
+        assert len(history.query(None, times[0])) == 0
+        assert chunks == set()
+    finally:
+        history.close()
+
+
+def test_query_filters_by_tag_within_a_chunk(tmp_path, monkeypatch):
+    times = write_history(tmp_path)
+    history = PositionHistory(tmp_path)
+    try:
+        start, end = times[CHUNK_ROWS + 10], times[CHUNK_ROWS + 20]
+        chunks = loaded_chunks(monkeypatch)
+        fixes = history.query(start, end, tags=2)
+
+        assert chunks == {1}
+        np.testing.assert_array_equal(fixes["tag"], 2)
+        np.testing.assert_array_equal(fixes["time"], times[CHUNK_ROWS + 11:CHUNK_ROWS + 20:2])
+    finally:
+        history.close()
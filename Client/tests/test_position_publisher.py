@@ -0,0 +1,136 @@
+import asyncio
+import time
+
+import numpy as np
+
+import position_publisher
+from position_publisher import PositionPublisher, Subscriber, subscribe
+from wire_format import decode_fixes
+
+
+class FakeTransport:
+    """
+    Collects the frames written to a subscriber instead of sending them.
+    """
+
+    def __init__(self):
+        self.frames = []
+        self.aborted = False
+
+    def get_extra_info(self, name):
+        return ("127.0.0.1", 0)
+
+    def set_write_buffer_limits(self, high=None):
+        pass
+
+    def write(self, frame):
+        self.frames.append(frame)
+
+    def abort(self):
+        self.aborted = True
+
+    def fixes(self):
+        frames, self.frames = self.frames, []
+        return [decode_fixes(frame) for frame in frames]
+
+
+def connect(publisher):
+    subscriber = Subscriber(publisher)
+    transport = FakeTransport()
+    subscriber.connection_made(transport)
+    return subscriber, transport
+
+
+def test_fixes_of_a_tag_are_coalesced_into_its_latest():
+    publisher = PositionPublisher(port=None)
+    _, transport = connect(publisher)
+
+    publisher.publish([5, 7], [[1.0, 2.0, 3.0], [4.0, 5.0, 6.0]], 10.0)
+    publisher.publish([5], [[7.0, 8.0, 9.0]], 10.1)
+    publisher.flush()
+
+    [fixes] = transport.fixes()
+    np.testing.assert_array_equal(fixes["tag"], [5, 7])
+    np.testing.assert_array_equal(fixes["x"], [7.0, 4.0])
+    np.testing.assert_allclose(fixes["time"], np.array([10.1, 10.0]) + publisher.clock_offset)
+    assert publisher.frames_published == 1
+    assert publisher.fixes_published == 2
+
+    # Nothing new, nothing sent
+    publisher.flush()
+    assert transport.fixes() == []
+
+
+def test_new_subscriber_starts_with_the_latest_fix_of_every_known_tag():
+    publisher = PositionPublisher(port=None)
+    publisher.publish([3, 9], [[1.0, 1.0, 1.0], [2.0, 2.0, 2.0]], 1.0)
+    publisher.flush()
+
+    _, transport = connect(publisher)
+    publisher.flush()
+
+    [fixes] = transport.fixes()
+    np.testing.assert_array_equal(fixes["tag"], [3, 9])
+
+
+def test_slow_subscriber_gets_the_latest_fixes_once_it_catches_up():
+    publisher = PositionPublisher(port=None)
+    slow, slow_transport = connect(publisher)
+    _, fast_transport = connect(publisher)
+
+    slow.pause_writing()
+    publisher.publish([1, 2], [[1.0, 0.0, 0.0], [2.0, 0.0, 0.0]], 1.0)
+    publisher.flush()
+    publisher.publish([1], [[3.0, 0.0, 0.0]], 1.1)
+    publisher.flush()
+
+    assert slow_transport.fixes() == []
+    assert len(fast_transport.fixes()) == 2
+
+    slow.resume_writing()
+    publisher.flush()
+
+    [fixes] = slow_transport.fixes()
+    np.testing.assert_array_equal(fixes["tag"], [1, 2])
+    np.testing.assert_array_equal(fixes["x"], [3.0, 2.0])
+    assert not slow.has_pending
+    # The fast subscriber already had every fix
+    assert fast_transport.fixes() == []
+
+
+def test_subscriber_slow_for_too_long_is_disconnected():
+    publisher = PositionPublisher(port=None)
+    slow, transport = connect(publisher)
+
+    slow.pause_writing()
+    publisher.publish([1], [[1.0, 0.0, 0.0]], 1.0)
+    publisher.flush()
+    assert not transport.aborted
+
+    slow.slow_since = time.monotonic() - position_publisher.SLOW_SUBSCRIBER_TIMEOUT - 1.0
+    publisher.publish([1], [[2.0, 0.0, 0.0]], 1.1)
+    publisher.flush()
+
+    assert transport.aborted
+    assert transport.fixes() == []
+    assert publisher.subscribers_dropped == 1
+
+
+def test_subscriber_receives_fixes_over_tcp():
+    async def run():
+        publisher = await PositionPublisher(port=0, interval=0.01).start()
+        try:
+            stream = subscribe(*publisher.address)
+            receive = asyncio.ensure_future(stream.__anext__())
+            while not publisher.subscribers:
+                await asyncio.sleep(0.01)
+            publisher.publish([4], [[10.0, 20.0, 30.0]], 2.0)
+            fixes = await asyncio.wait_for(receive, 2.0)
+            await stream.aclose()
+            return fixes
+        finally:
+            await publisher.close()
+
+    fixes = asyncio.run(run())
+    np.testing.assert_array_equal(fixes["tag"], [4])
+    np.testing.assert_array_equal([fixes["x"][0], fixes["y"][0], fixes["z"][0]], [10.0, 20.0, 30.0])
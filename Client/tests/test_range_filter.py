@@ -0,0 +1,39 @@
+import numpy as np
+
+from range_filter import HampelFilter
+
+
+def test_outlier_is_rejected_and_noise_passes():
+    rng = np.random.default_rng(0)
+    hampel = HampelFilter(num_anchors=2)
+    ranges = 300.0 + rng.normal(0, 5, 20)
+    ranges[10] = 900.0
+
+    accepted = np.array([hampel.update([0], [1], [r])[0] for r in ranges])
+
+    np.testing.assert_array_equal(np.flatnonzero(~accepted), [10])
+    assert hampel.readings_checked == 20
+    assert hampel.readings_rejected == 1
+
+
+def test_sustained_jump_is_accepted():
+    hampel = HampelFilter(num_anchors=1, window=7)
+    ranges = [300.0] * 7 + [600.0] * 6
+
+    accepted = [bool(hampel.update([0], [0], [r])[0]) for r in ranges]
+
+    # The new range is accepted once it makes up half of the window
+    assert accepted[:7] == [True] * 7
+    assert not accepted[7]
+    assert accepted[-1]
+
+
+def test_streams_are_independent_and_repeats_are_checked_in_order():
+    hampel = HampelFilter(num_anchors=2, tag_capacity=1)
+    for _ in range(5):
+        hampel.update([0, 0, 5], [0, 1, 0], [100.0, 200.0, 400.0])
+
+    # Tag 5 grew the arrays; the repeated stream (0, 0) sees its first reading before the second
+    accepted = hampel.update([0, 0, 0, 5], [0, 0, 1, 0], [100.0, 900.0, 200.0, 100.0])
+
+    np.testing.assert_array_equal(accepted, [True, False, True, False])
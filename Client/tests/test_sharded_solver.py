@@ -0,0 +1,105 @@
+import threading
+import time
+
+import numpy as np
+
+from sharded_solver import RUNNING, SharedArrays, ShardedSolver, build_engine, drain_shard, publish_fixes
+
+ANCHOR_ADDRESSES = [10, 11, 12, 13]
+ANCHORS = np.array([[0.0, 0.0, 80.0], [600.0, 0.0, 80.0], [600.0, 400.0, 80.0], [0.0, 400.0, 80.0]])
+
+
+def make_solver():
+    # Without a pool: only the shared tables, as the ingest process sees them
+    solver = ShardedSolver.__new__(ShardedSolver)
+    solver.num_workers = 1
+    solver.ring_capacity = 16
+    solver.shared = SharedArrays(1, 16)
+    solver.workers = []
+    return solver
+
+
+def test_latest_fixes_reads_published_rows():
+    solver = make_solver()
+    try:
+        publish_fixes(solver.shared.fixes, np.array([5, 9]), np.array([[1.0, 2.0, 3.0], [4.0, 5.0, 6.0]]), 7.0, [3, 4])
+
+        positions, times, anchors = solver.latest_fixes([9, 5, 6])
+
+        np.testing.assert_array_equal(positions[:2], [[4.0, 5.0, 6.0], [1.0, 2.0, 3.0]])
+        assert np.isnan(positions[2]).all()
+        np.testing.assert_array_equal(times[:2], [7.0, 7.0])
+        np.testing.assert_array_equal(anchors, [4, 3, 0])
+    finally:
+        solver.close()
+
+
+def test_latest_fixes_retries_rows_being_written():
+    solver = make_solver()
+    table = solver.shared.fixes
+    try:
+        publish_fixes(table, np.array([5]), np.array([[1.0, 2.0, 3.0]]), 7.0, [3])
+        # A writer is in the middle of row 5, so the reader retries and
+        # gives up with the last copy, without touching the lock
+        table["version"][5] += 1
+        table["x"][5] = 100.0
+
+        solver.latest_fixes([5])
+
+        assert table["version"][5] % 2 == 1
+        # The writer finishes; the next read is consistent
+        table["version"][5] += 1
+        positions, _, _ = solver.latest_fixes([5])
+        np.testing.assert_array_equal(positions[0], [100.0, 2.0, 3.0])
+    finally:
+        solver.close()
+
+
+def test_workers_solve_and_report_anchor_counts():
+    solver = ShardedSolver(ANCHOR_ADDRESSES, ANCHORS, num_workers=2, engine_options={"tracker": False})
+    try:
+        tags = np.array([[150.0, 100.0, 80.0], [420.0, 310.0, 80.0]])
+        distances = np.linalg.norm(tags[:, None] - ANCHORS[None], axis=2)
+        tag_addresses = np.repeat([1, 2], 4)
+        anchor_addresses = np.tile(ANCHOR_ADDRESSES, 2)
+        solver.submit(tag_addresses, anchor_addresses, distances.ravel())
+
+        deadline = time.monotonic() + 10
+        while solver.stats()["fixes_published"] < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        positions, _, anchors = solver.latest_fixes([1, 2])
+
+        # Ranges cross the ring as float32, and z is barely observable in the plane of the anchors
+        np.testing.assert_allclose(positions[:, :2], tags[:, :2], atol=1e-2)
+        np.testing.assert_allclose(positions[:, 2], tags[:, 2], atol=1.0)
+        np.testing.assert_array_equal(anchors, [4, 4])
+    finally:
+        solver.close()
+    assert not any(worker.is_alive() for worker in solver.workers)
+    assert all(worker.exitcode == 0 for worker in solver.workers)
+
+
+def test_drain_shard_publishes_the_anchor_count_of_each_epoch():
+    solver = make_solver()
+    engine = build_engine(ANCHOR_ADDRESSES, ANCHORS, {"tracker": True})
+    solver.shared.control[0, RUNNING] = 1
+    worker = threading.Thread(target=drain_shard, args=(solver.shared, 0, engine))
+    worker.start()
+    try:
+        tag = np.array([150.0, 100.0, 80.0])
+        distances = np.linalg.norm(ANCHORS - tag, axis=1)
+        now = time.monotonic()
+        solver.submit(np.full(4, 7), ANCHOR_ADDRESSES, distances, now)
+        # The fourth anchor keeps its old distance in the engine, but isn't part of the next epoch
+        solver.submit(np.full(3, 7), ANCHOR_ADDRESSES[:3], distances[:3], now + 0.01)
+
+        deadline = time.monotonic() + 10
+        while solver.stats()["fixes_published"] < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        _, _, anchors = solver.latest_fixes([7])
+
+        assert anchors[0] == 3
+    finally:
+        solver.shared.control[0, RUNNING] = 0
+        worker.join()
+        solver.close()
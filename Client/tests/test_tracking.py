@@ -0,0 +1,35 @@
+import numpy as np
+
+from tracking import TagTracker, unique_passes
+
+# Anchors 90 cm above the tag, as with anchors on tables and a tag on the floor
+ANCHORS = np.array([[0.0, 0.0, 100.0], [600.0, 0.0, 100.0], [600.0, 400.0, 100.0], [0.0, 400.0, 100.0]])
+TAG = np.array([250.0, 150.0, 10.0])
+
+
+def test_range_updates_converge_with_slant_ranges():
+    tracker = TagTracker(dim=2)
+    # Start 40 cm off, at the right height
+    tracker.update_positions([0], [TAG + [30.0, -25.0, 0.0]], 0.0)
+    distances = np.linalg.norm(ANCHORS - TAG, axis=1)[None]
+
+    for step in range(1, 51):
+        updated, positions = tracker.update_ranges([0], distances, ANCHORS, step * 0.1)
+
+    assert updated[0]
+    np.testing.assert_allclose(positions[0], TAG, atol=1.0)
+
+
+def test_position_updates_are_applied_in_order():
+    tracker = TagTracker(dim=2)
+    tracker.update_positions([0, 1], [[0.0, 0.0, 50.0], [100.0, 100.0, 50.0]], 0.0)
+
+    filtered = tracker.update_positions([1, 1], [[101.0, 100.0, 60.0], [102.0, 100.0, 70.0]], [0.1, 0.2])
+
+    assert filtered[0, 0] < filtered[1, 0] < 102.0
+    np.testing.assert_array_equal(filtered[:, 2], [60.0, 70.0])
+
+
+def test_unique_passes_split_repeats():
+    passes = unique_passes([3, 1, 3, 3, 2])
+    assert [p.tolist() for p in passes] == [[0, 1, 4], [2], [3]]
@@ -0,0 +1,66 @@
+import json
+
+import numpy as np
+
+import trilateration
+from trilateration import ANCHOR_ADDRESSES, ANCHOR_POSITIONS, create_engine
+from wire_format import encode_readings
+
+TAG_ADDRESS = 9
+TAG = np.array([300.0, 250.0, 20.0])
+
+
+class RecordingHistory:
+    """
+    Collects what record_history appends instead of writing a history directory.
+    """
+
+    def __init__(self):
+        self.rows = []
+
+    def append(self, tag_addresses, positions, times, quality=None):
+        self.rows.extend(zip(tag_addresses, times, quality))
+
+
+def ranges(anchors):
+    return np.linalg.norm(np.asarray(ANCHOR_POSITIONS, dtype=float)[anchors] - TAG, axis=1)
+
+
+def test_history_quality_counts_the_anchors_of_each_epoch(monkeypatch):
+    engine = create_engine()
+    history = RecordingHistory()
+    monkeypatch.setattr(trilateration, "engine", engine)
+    monkeypatch.setattr(trilateration, "history", history)
+    addresses = np.asarray(ANCHOR_ADDRESSES)
+
+    # Every anchor reports, then only two do: the third keeps its old distance
+    # in the table, but the tracker's range update only used two ranges
+    for step in range(5):
+        trilateration.record_history(engine.process_readings(
+            np.full(3, TAG_ADDRESS), addresses, ranges([0, 1, 2]), step * 0.1 + np.arange(3) * 0.01
+        ))
+    trilateration.record_history(engine.process_readings(
+        np.full(2, TAG_ADDRESS), addresses[:2], ranges([0, 1]), [0.5, 0.51]
+    ))
+    trilateration.record_history(engine.flush(1.0))
+
+    assert [quality for _, _, quality in history.rows] == [3, 3, 3, 3, 3, 2]
+    assert engine.measurements.position_anchors[engine.measurements.tag_index(TAG_ADDRESS)] == 2
+
+
+def test_datagrams_are_processed_in_arrival_order(monkeypatch):
+    engine = create_engine()
+    monkeypatch.setattr(trilateration, "engine", engine)
+    address = ("127.0.0.1", 50000)
+    reading = {"device_address": ANCHOR_ADDRESSES[0], "tag_address": TAG_ADDRESS}
+
+    # A JSON reading between two binary packets of the same anchor
+    trilateration.process_datagrams([
+        (encode_readings([ANCHOR_ADDRESSES[0]], [TAG_ADDRESS], [300.0], [0], [0]), address),
+        (json.dumps(dict(reading, distance="305 cm")).encode(), address),
+        (encode_readings([ANCHOR_ADDRESSES[0]], [TAG_ADDRESS], [302.0], [0], [0]), address),
+        (json.dumps(dict(reading, distance="304 cm")).encode(), address),
+    ], 0.0)
+
+    tag = engine.measurements.tag_index(TAG_ADDRESS)
+    assert engine.measurements.distances[tag, 0] == 304.0
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+from wire_format import (
+    FIX_DTYPE, MAX_READINGS_PER_PACKET, decode_binary_packet, decode_binary_records, decode_fixes, encode_fixes,
+    encode_readings, is_binary_packet,
+)
+
+
+def test_readings_round_trip():
+    packet = encode_readings([10, 11, 12], [1, 2, 65535], [123.4, 0.0, 65535.0], [7, 65537, 0], [1000, 2**32 + 5, 0])
+
+    assert is_binary_packet(packet)
+    readings = decode_binary_packet(packet)
+    np.testing.assert_array_equal(readings["anchor"], [10, 11, 12])
+    np.testing.assert_array_equal(readings["tag"], [1, 2, 65535])
+    np.testing.assert_array_equal(readings["distance"], [123, 0, 65535])
+    # Sequence numbers and timestamps wrap like the anchors' counters
+    np.testing.assert_array_equal(readings["sequence"], [7, 1, 0])
+    np.testing.assert_array_equal(readings["timestamp"], [1000, 5, 0])
+
+
+def test_malformed_packets_are_rejected():
+    packet = encode_readings([10], [1], [100.0], [0], [0])
+    with pytest.raises(ValueError):
+        decode_binary_packet(packet[:-1])
+    with pytest.raises(ValueError):
+        decode_binary_packet(b"UW\x02" + packet[3:])
+    with pytest.raises(ValueError):
+        encode_readings(*[np.zeros(MAX_READINGS_PER_PACKET + 1)] * 5)
+
+
+def test_records_decode_like_single_packets():
+    packets = [
+        encode_readings([10, 11], [1, 2], [100.0, 200.0], [1, 2], [10, 20]),
+        b'{"anchor": 10}',
+        encode_readings([12], [3], [300.0], [3], [30]),
+        encode_readings([13], [4], [400.0], [4], [40])[:-1],
+        encode_readings([], [], [], [], []),
+    ]
+    buffer = np.frombuffer(b"".join(packets), dtype=np.uint8)
+    lengths = np.array([len(packet) for packet in packets])
+    offsets = np.cumsum(lengths) - lengths
+
+    readings, records, valid = decode_binary_records(buffer, offsets, lengths)
+
+    np.testing.assert_array_equal(valid, [True, False, True, False, True])
+    np.testing.assert_array_equal(records, [0, 0, 2])
+    expected = np.concatenate([decode_binary_packet(packets[0]), decode_binary_packet(packets[2])])
+    np.testing.assert_array_equal(readings, expected)
+
+
+def test_fixes_round_trip_across_frames():
+    fixes = np.zeros(5, dtype=FIX_DTYPE)
+    fixes["tag"] = np.arange(5)
+    fixes["x"] = np.arange(5) * 1.5
+    fixes["time"] = 1.7e9 + np.arange(5)
+
+    frames = encode_fixes(fixes, max_fixes=2)
+
+    assert len(frames) == 3
+    np.testing.assert_array_equal(np.concatenate([decode_fixes(frame) for frame in frames]), fixes)
@@ -0,0 +1,27 @@
+import numpy as np
+
+from zones import DWELL, ENTER, EXIT, ZoneTracker, load_zones
+
+
+def test_zones_are_in_floor_coordinates():
+    zone_map = load_zones()
+    names = list(zone_map.names)
+
+    # A fix at floor (50, -100) is drawn at (50, 100), inside the green room of ui_test.py
+    inside, zones = zone_map.classify(np.array([[50.0, -100.0], [50.0, 100.0]]))
+
+    assert [names[zone] for zone in zones[inside == 0]] == ["Green room"]
+    assert not np.any(inside == 1)
+
+
+def test_enter_dwell_and_exit_events():
+    tracker = ZoneTracker(load_zones())
+    green = list(tracker.zone_map.names).index("Green room")
+
+    entered = tracker.update([0], [[50.0, -100.0]], 0.0)
+    dwelled = tracker.update([0], [[60.0, -100.0]], 11.0)
+    left = tracker.update([0], [[50.0, 100.0]], 12.0)
+
+    assert (entered["kind"].tolist(), entered["zone"].tolist()) == ([ENTER], [green])
+    assert dwelled["kind"].tolist() == [DWELL]
+    assert (left["kind"].tolist(), left["duration"].tolist()) == ([EXIT], [12.0])
@@ -0,0 +1,292 @@
+import numpy as np
+
+# Standard deviation of the random acceleration driving the motion model, in cm/s^2
+DEFAULT_ACCELERATION_NOISE = 50.0
+
+# Standard deviation of a solved position, in cm
+DEFAULT_POSITION_NOISE = 15.0
+
+# Standard deviation of a single range, in cm (spread of Data_Collection/Distance_Data_Plot.py)
+DEFAULT_RANGE_NOISE = 20.0
+
+# Standard deviation of the velocity of a newly seen tag, in cm/s
+INITIAL_VELOCITY_NOISE = 100.0
+
+
+def unique_passes(tag_indices):
+    """
+    Split a batch into passes in which every tag appears at most once.
+
+    Args:
+        tag_indices: Array of tag rows, possibly with repeats
+
+    Returns:
+        List of index arrays into tag_indices, in order of occurrence
+    """
+    tag_indices = np.asarray(tag_indices)
+    if len(np.unique(tag_indices)) == len(tag_indices):
+        return [np.arange(len(tag_indices))]
+
+    passes = []
+    remaining = np.arange(len(tag_indices))
+    while len(remaining):
+        _, first = np.unique(tag_indices[remaining], return_index=True)
+        passes.append(np.sort(remaining[first]))
+        remaining = np.delete(remaining, first)
+    return passes
+
+
+class TagTracker:
+    """
+    Constant-velocity Kalman filter for every tag at once.
+
+    The state of tag i is [position, velocity] in `dim` dimensions. States and
+    covariances of all tags live in stacked arrays (T, 2*dim) and
+    (T, 2*dim, 2*dim), and predict/update steps work on a whole array of tag
+    rows with batched matrix products, so there is no per-tag Python loop.
+
+    Tags can be updated with solved positions (linear Kalman update) or
+    directly with raw ranges to the anchors (extended Kalman update), which
+    keeps a tag tracked when fewer than three anchors reported.
+    """
+
+    def __init__(
+        self,
+        dim=2,
+        acceleration_noise=DEFAULT_ACCELERATION_NOISE,
+        position_noise=DEFAULT_POSITION_NOISE,
+        range_noise=DEFAULT_RANGE_NOISE,
+        tag_capacity=64,
+    ):
+        """
+        Args:
+            dim: Number of tracked coordinates, 2 for (x, y) or 3 for (x, y, z)
+            acceleration_noise: Process noise in cm/s^2
+            position_noise: Noise of a solved position in cm
+            range_noise: Noise of a single range in cm
+            tag_capacity: Number of tag rows to preallocate
+        """
+        self.dim = dim
+        self.state_size = 2 * dim
+        self.acceleration_noise = acceleration_noise
+        self.position_noise = position_noise
+        self.range_noise = range_noise
+        self.capacity = 0
+        self.ensure_capacity(max(1, tag_capacity))
+
+    def ensure_capacity(self, num_tags):
+        """
+        Grow the per-tag arrays so they hold at least `num_tags` tags.
+        """
+        if num_tags <= self.capacity:
+            return
+        capacity = max(num_tags, 2 * self.capacity)
+        n = self.state_size
+
+        def grow(name, shape, fill, dtype):
+            new = np.full(shape, fill, dtype=dtype)
+            old = getattr(self, name, None)
+            if old is not None:
+                new[:len(old)] = old
+            setattr(self, name, new)
+
+        grow("state", (capacity, n), 0.0, float)
+        grow("covariance", (capacity, n, n), 0.0, float)
+        grow("last_update", capacity, np.nan, float)
+        grow("initialized", capacity, False, bool)
+        # Height of every tag when only (x, y) is tracked
+        grow("height", capacity, np.nan, float)
+        self.capacity = capacity
+
+    def predict(self, tag_indices, times):
+        """
+        Propagate the given tags to the given times.
+
+        Args:
+            tag_indices: Rows of the tags to propagate (initialized tags only)
+            times: Target time in seconds per tag, or one time for all of them
+        """
+        tag_indices = np.asarray(tag_indices, dtype=np.int64)
+        times = np.broadcast_to(np.asarray(times, dtype=float), tag_indices.shape)
+        dt = np.maximum(times - self.last_update[tag_indices], 0.0)
+        d = self.dim
+
+        # Position += velocity * dt
+        F = np.broadcast_to(np.eye(self.state_size), (len(tag_indices), self.state_size, self.state_size)).copy()
+        F[:, np.arange(d), np.arange(d) + d] = dt[:, None]
+
+        # Discretized white-noise acceleration model
+        q = self.acceleration_noise**2
+        Q = np.zeros_like(F)
+        eye = np.eye(d)
+        Q[:, :d, :d] = (q * dt**3 / 3)[:, None, None] * eye
+        Q[:, :d, d:] = (q * dt**2 / 2)[:, None, None] * eye
+        Q[:, d:, :d] = Q[:, :d, d:]
+        Q[:, d:, d:] = (q * dt)[:, None, None] * eye
+
+        self.state[tag_indices] = np.einsum("kij,kj->ki", F, self.state[tag_indices])
+        self.covariance[tag_indices] = F @ self.covariance[tag_indices] @ F.transpose(0, 2, 1) + Q
+        self.last_update[tag_indices] = times
+
+    def update_positions(self, tag_indices, positions, times):
+        """
+        Update tags with solved positions. Tags seen for the first time are
+        initialized at the position with an uncertain velocity.
+
+        A tag may appear more than once, its measurements are applied in order.
+
+        Args:
+            tag_indices: Rows of the tags
+            positions: Array of shape (K, 3) with the solved positions in cm
+            times: Measurement time in seconds per tag, or one time for all of them
+
+        Returns:
+            Array of shape (K, 3) with the filtered positions
+        """
+        tag_indices = np.asarray(tag_indices, dtype=np.int64)
+        positions = np.asarray(positions, dtype=float).reshape(-1, 3)
+        times = np.broadcast_to(np.asarray(times, dtype=float), tag_indices.shape)
+        if len(tag_indices):
+            self.ensure_capacity(int(tag_indices.max()) + 1)
+
+        filtered = np.empty((len(tag_indices), 3))
+        for rows in unique_passes(tag_indices):
+            filtered[rows] = self._update_positions(tag_indices[rows], positions[rows], times[rows])
+        return filtered
+
+    def _update_positions(self, tag_indices, positions, times):
+        """
+        Position update for tags that each appear once.
+        """
+        d = self.dim
+        measured = positions[:, :d]
+        if d == 2:
+            self.height[tag_indices] = positions[:, 2]
+
+        new = ~self.initialized[tag_indices]
+        self._initialize(tag_indices[new], measured[new], times[new])
+
+        tracked = tag_indices[~new]
+        if len(tracked):
+            self.predict(tracked, times[~new])
+            H = np.zeros((d, self.state_size))
+            H[:, :d] = np.eye(d)
+            H = np.broadcast_to(H, (len(tracked), d, self.state_size))
+            residuals = measured[~new] - self.state[tracked, :d]
+            R = np.broadcast_to(self.position_noise**2 * np.eye(d), (len(tracked), d, d))
+            self._update(tracked, H, residuals, R)
+
+        return self.positions(tag_indices)
+
+    def update_ranges(self, tag_indices, distances, anchor_positions, times):
+        """
+        Update tags directly with raw ranges (extended Kalman update).
+
+        Works with any number of reporting anchors, missing ranges are NaN.
+        Tags that were never initialized from a position are skipped, since a
+        couple of ranges alone don't pin down a starting point.
+
+        Args:
+            tag_indices: Rows of the tags
+            distances: Array of shape (K, N) with ranges in cm, NaN where missing
+            anchor_positions: Array of shape (N, 2) or (N, 3) with anchor coordinates in cm
+            times: Measurement time in seconds per tag, or one time for all of them
+
+        Returns:
+            Tuple (updated, positions): a boolean mask of the rows that were
+            updated and an array of shape (K, 3) with their filtered positions
+        """
+        tag_indices = np.asarray(tag_indices, dtype=np.int64)
+        distances = np.asarray(distances, dtype=float).reshape(len(tag_indices), len(anchor_positions))
+        times = np.broadcast_to(np.asarray(times, dtype=float), tag_indices.shape)
+        if len(tag_indices):
+            self.ensure_capacity(int(tag_indices.max()) + 1)
+
+        updated = self.initialized[tag_indices].copy()
+        positions = np.full((len(tag_indices), 3), np.nan)
+        for rows in unique_passes(tag_indices):
+            rows = rows[updated[rows]]
+            if len(rows):
+                positions[rows] = self._update_ranges(tag_indices[rows], distances[rows], anchor_positions, times[rows])
+        return updated, positions
+
+    def _update_ranges(self, tag_indices, distances, anchor_positions, times):
+        """
+        Range update for initialized tags that each appear once.
+        """
+        self.predict(tag_indices, times)
+        d = self.dim
+        anchor_positions = np.asarray(anchor_positions, dtype=float)
+        anchors = anchor_positions[:, :d]
+
+        # Predicted ranges and their Jacobian d|p - a| / dp = (p - a) / |p - a|
+        offsets = self.state[tag_indices, None, :d] - anchors[None, :, :]
+        squared = np.sum(offsets**2, axis=2)
+        if d == 2 and anchor_positions.shape[1] > 2:
+            # Measured ranges are slant ranges, so the height difference to every anchor
+            # counts too, with the tag at its last known height
+            squared += np.nan_to_num(self.height[tag_indices, None] - anchor_positions[None, :, 2])**2
+        predicted = np.sqrt(squared)
+        present = ~np.isnan(distances) & (predicted > 1e-6)
+        H = np.zeros((len(tag_indices), anchors.shape[0], self.state_size))
+        H[:, :, :d] = np.where(present[:, :, None], offsets / np.maximum(predicted, 1e-6)[:, :, None], 0.0)
+
+        # Missing ranges get a zero row and unit noise so they carry no information
+        residuals = np.where(present, distances - predicted, 0.0)
+        R = np.where(present, self.range_noise**2, 1.0)[:, :, None] * np.eye(anchors.shape[0])
+        self._update(tag_indices, H, residuals, R)
+
+        return self.positions(tag_indices)
+
+    def _initialize(self, tag_indices, positions, times):
+        """
+        Start tracking tags at the given positions.
+        """
+        d = self.dim
+        self.state[tag_indices] = 0.0
+        self.state[tag_indices, :d] = positions
+        covariance = np.zeros((self.state_size, self.state_size))
+        covariance[:d, :d] = self.position_noise**2 * np.eye(d)
+        covariance[d:, d:] = INITIAL_VELOCITY_NOISE**2 * np.eye(d)
+        self.covariance[tag_indices] = covariance
+        self.last_update[tag_indices] = times
+        self.initialized[tag_indices] = True
+
+    def _update(self, tag_indices, H, residuals, R):
+        """
+        Batched Kalman measurement update.
+
+        Args:
+            tag_indices: Rows of the tags, shape (K,)
+            H: Measurement matrices, shape (K, m, n)
+            residuals: Measurement minus prediction, shape (K, m)
+            R: Measurement noise covariances, shape (K, m, m)
+        """
+        P = self.covariance[tag_indices]
+        PHt = P @ H.transpose(0, 2, 1)
+        S = H @ PHt + R
+        # K = P H^T S^-1, computed as (S^-1 H P)^T since S and P are symmetric
+        K = np.linalg.solve(S, PHt.transpose(0, 2, 1)).transpose(0, 2, 1)
+
+        self.state[tag_indices] += np.einsum("kij,kj->ki", K, residuals)
+        P = P - K @ H @ P
+        self.covariance[tag_indices] = (P + P.transpose(0, 2, 1)) / 2
+
+    def positions(self, tag_indices):
+        """
+        Returns:
+            Array of shape (K, 3) with the filtered positions of the given tags
+        """
+        tag_indices = np.asarray(tag_indices, dtype=np.int64)
+        positions = np.empty((len(tag_indices), 3))
+        positions[:, :self.dim] = self.state[tag_indices, :self.dim]
+        if self.dim == 2:
+            positions[:, 2] = self.height[tag_indices]
+        return positions
+
+    def velocities(self, tag_indices):
+        """
+        Returns:
+            Array of shape (K, dim) with the filtered velocities of the given tags in cm/s
+        """
+        return self.state[np.asarray(tag_indices, dtype=np.int64), self.dim:]
@@ -1,38 +1,121 @@
-import socket
+import argparse
+import asyncio
 import json
 import math
+import time
+
+import numpy as np
+
+from anchor_health import AnchorHealth
+from anchor_placement import load_anchor_config
+from calibration import CalibrationModel
+from gdop import DEFAULT_MARGIN, GdopMap
+from ingest_server import IngestServer, bind_socket
+from location_engine import LocationEngine
+from measurement_table import DEFAULT_TAG_ADDRESS
+from metrics import DEFAULT_METRICS_PORT, ClientMetrics, MetricsServer, RateLimitedPrinter
+from multilateration import refine_positions
+from occupancy import OccupancyGrid
+from packet_log import PacketRecorder, replay_log
+from polling_scheduler import PollingScheduler
+from position_history import PositionHistory
+from position_publisher import (
+    DEFAULT_MULTICAST_GROUP, DEFAULT_MULTICAST_PORT, DEFAULT_PUBLISH_PORT, PUBLISH_INTERVAL, PositionPublisher,
+)
+from range_filter import HampelFilter
+from sharded_solver import ShardedSolver
+from tracking import TagTracker
+from wire_format import decode_binary_packet, is_binary_packet
+from zones import EVENT_NAMES, ZoneTracker, load_zones
 
 # Default anchor positions (x, y, z) in centimeters
 ANCHOR_1_POSITION = (0, 0, 90)
 ANCHOR_2_POSITION = (660, 0, 90)
 ANCHOR_3_POSITION = (250, 600, 90)
 
+# UWB addresses of the anchors, in the same order as ANCHOR_POSITIONS
+ANCHOR_ADDRESSES = [10, 11, 12]
+ANCHOR_POSITIONS = [ANCHOR_1_POSITION, ANCHOR_2_POSITION, ANCHOR_3_POSITION]
+
+# Polling period sent to the anchors when adaptive polling is off, in milliseconds
+DEFAULT_POLLING_PERIOD_MS = 100
+
+# The heatmap of --heatmap covers the anchors plus this margin in cm, and is saved this often in seconds
+HEATMAP_MARGIN = 300
+HEATMAP_SAVE_INTERVAL = 60.0
+
+# Seconds between two checks for polling updates to send
+POLLING_UPDATE_INTERVAL = 0.1
+
 # Server configuration
 SERVER_IP = "0.0.0.0"  # Listen on all available interfaces
 SERVER_PORT = 50000    # Port number
 
-# Anchor addresses (example IPs and ports)
+# Anchor addresses (example IPs and ports), in the same order as ANCHOR_ADDRESSES
 ANCHOR_IPS = [
     ("192.168.1.170", 50000),
     ("192.168.1.171", 50000),
     ("192.168.1.173", 50000)
 ]
 
-# Create a UDP socket
-socket_connection = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-socket_connection.bind((SERVER_IP, SERVER_PORT))
+# UDP socket the anchors send to, bound by main() so importing this module
+# (e.g. for its solver) doesn't take the port
+socket_connection = None
+
+# Counters and histograms of the client, served in the Prometheus format with --metrics-port
+metrics = ClientMetrics()
+
+# Groups readings into epochs and solves them. Its measurement table holds the
+# latest distance from every tag to every anchor and the latest position of every tag.
+# Wild ranges are dropped by a Hampel filter before they reach the solver, and
+# fixes are smoothed by a Kalman tracker, which also takes epochs where only two anchors reported.
+# The polling scheduler picks every anchor's polling period from how fast its tags move,
+# and epochs stop waiting for anchors the health monitor saw go silent.
+def create_engine(metrics=None, anchor_addresses=ANCHOR_ADDRESSES, anchor_positions=ANCHOR_POSITIONS):
+    """
+    Build the location engine of the client. batch_positions.py builds its
+    engine here too, so captures are solved exactly like they are replayed,
+    and benchmark.py does with the anchors it simulates.
+
+    Args:
+        metrics: Optional ClientMetrics the engine reports to
+        anchor_addresses: UWB addresses of the anchors
+        anchor_positions: Anchor coordinates (x, y, z) in cm, in the same order
+    """
+    return LocationEngine(
+        anchor_addresses, anchor_positions, quorum=2, tracker=TagTracker(), metrics=metrics,
+        range_filter=HampelFilter(len(anchor_addresses)), scheduler=PollingScheduler(len(anchor_addresses)),
+        health=AnchorHealth(anchor_addresses), refine=True,
+    )
+
+engine = create_engine(metrics)
+metrics.bind_engine(engine)
+metrics.bind_health(engine.health)
+
+# Pool of solver processes sharded by tag, started with --workers. When it
+# runs, readings go to the workers instead of the engine above.
+sharded_solver = None
+
+# Sends the fixes to subscribers over TCP (and multicast with --multicast), see position_publisher.py
+publisher = None
 
-print(f"Listening for UDP packets on {SERVER_IP}:{SERVER_PORT}...")
+# Every fix is appended to the on-disk history of --history, see position_history.py
+history = None
 
-# Variables to store the latest distances
-distance_from_anchor_1 = None
-distance_from_anchor_2 = None
-distance_from_anchor_3 = None
-latest_tag_position = None  # Variable to store the latest calculated tag position
+# Dwell and traffic heatmaps of --heatmap, see occupancy.py
+heatmap = None
+
+# Enter, exit and dwell events of the tags in the zones of --zones, if given
+zone_tracker = None
+
+# Per-packet console output is off unless --verbose is given, and all of them are rate-limited
+packet_output = RateLimitedPrinter(enabled=False)
+error_output = RateLimitedPrinter()
+zone_output = RateLimitedPrinter()
 
 def calculate_position(anchor1_pos, anchor2_pos, anchor3_pos, distance1, distance2, distance3):
     """
-    Calculate the position of the tag using trilateration from three anchors.
+    Calculate the 3D position of the tag using trilateration from three anchors.
     
     Args:
         anchor1_pos: Position of the first anchor (x, y, z)
@@ -43,21 +126,177 @@ def calculate_position(anchor1_pos, anchor2_pos, anchor3_pos, distance1, distanc
         distance3: Distance from third anchor in cm
         
     Returns:
-        Tuple (x, y, z) with position coordinates
-    """
-    # Trilateration algorithm
-    A = 2*anchor2_pos[0] - 2*anchor1_pos[0]
-    B = 2*anchor2_pos[1] - 2*anchor1_pos[1]
-    C = distance1**2 - distance2**2 - anchor1_pos[0]**2 + anchor2_pos[0]**2 - anchor1_pos[1]**2 + anchor2_pos[1]**2
-    D = 2*anchor3_pos[0] - 2*anchor2_pos[0]
-    E = 2*anchor3_pos[1] - 2*anchor2_pos[1]
-    F = distance2**2 - distance3**2 - anchor2_pos[0]**2 + anchor3_pos[0]**2 - anchor2_pos[1]**2 + anchor3_pos[1]**2
+        Tuple (x, y, z) with position coordinates, or None if the anchors are collinear
+    """
+    positions, valid, _, _ = refine_positions(
+        [[distance1, distance2, distance3]],
+        [anchor1_pos, anchor2_pos, anchor3_pos]
+    )
+    if not valid[0]:
+        return None
+
+    x, y, z = positions[0]
+    return x, y, z
+
+def parse_reading(json_data):
+    """
+    Validate a JSON reading from an anchor and extract its values.
+    
+    Args:
+        json_data: JSON data containing a distance measurement
+        
+    Returns:
+        Tuple (tag_address, anchor_address, distance) or None if the reading is invalid
+    """
+    # Ensure required keys exist
+    if not all(k in json_data for k in ("device_address", "distance")):
+        metrics.parse_failures.inc(1, "missing_keys")
+        error_output("Invalid JSON format or missing keys.")
+        return None
     
-    x = (C*E - F*B) / (E*A - B*D)
-    y = (C*D - A*F) / (B*D - A*E)
-    z = anchor1_pos[2]  # Z coordinate remains the same as anchors
+    device_address = json_data.get("device_address")
+    distance_str = json_data.get("distance")
+
+    # Validate the distance format
+    if not isinstance(distance_str, str) or "cm" not in distance_str:
+        metrics.parse_failures.inc(1, "distance_format")
+        error_output(f"Invalid distance format: {distance_str}")
+        return None
     
-    return x, y, z
+    # Extract distance value
+    distance_value = float(distance_str.replace(" cm", "").strip())
+    tag_address = int(json_data.get("tag_address", DEFAULT_TAG_ADDRESS))
+    anchor_address = int(device_address)
+
+    if engine.measurements.anchor_index(anchor_address) < 0:
+        metrics.parse_failures.inc(1, "unknown_anchor")
+        error_output(f"Ignoring reading from unknown anchor {device_address}")
+        return None
+    if packet_output.enabled:
+        packet_output(f"Anchor {device_address} distance to tag {tag_address} updated to: {distance_value} cm")
+    return tag_address, anchor_address, distance_value
+
+def update_zones(fixes):
+    """
+    Check the valid fixes against the zones and print the zone events.
+    
+    Args:
+        fixes: Tuple (tag_indices, positions, valid) as returned by the engine
+    """
+    tag_indices, positions, valid = fixes
+    if zone_tracker is None or not valid.any():
+        return
+    tag_indices = tag_indices[valid]
+    events = zone_tracker.update(
+        tag_indices, positions[valid], engine.measurements.position_timestamps[tag_indices]
+    )
+    if len(events):
+        metrics.zone_events.inc_many(np.asarray(EVENT_NAMES)[events["kind"]])
+        for event in events:
+            zone_output(zone_tracker.describe(event, engine.measurements.tag_addresses[event["tag"]]))
+
+def publish_fixes(fixes):
+    """
+    Hand the valid fixes to the publisher, which sends them on its own timer.
+    
+    Args:
+        fixes: Tuple (tag_indices, positions, valid) as returned by the engine
+    """
+    tag_indices, positions, valid = fixes
+    if publisher is None or not valid.any():
+        return
+    tag_indices = tag_indices[valid]
+    publisher.publish(
+        engine.measurements.tag_addresses[tag_indices], positions[valid],
+        engine.measurements.position_timestamps[tag_indices],
+    )
+
+def record_history(fixes):
+    """
+    Append the valid fixes to the position history, with the number of
+    anchor ranges each was solved from as its quality.
+    
+    Args:
+        fixes: Tuple (tag_indices, positions, valid) as returned by the engine
+    """
+    tag_indices, positions, valid = fixes
+    if history is None or not valid.any():
+        return
+    measurements = engine.measurements
+    tag_indices = tag_indices[valid]
+    history.append(
+        measurements.tag_addresses[tag_indices], positions[valid], measurements.position_timestamps[tag_indices],
+        measurements.position_anchors[tag_indices],
+    )
+
+def update_heatmap(fixes):
+    """
+    Add the valid fixes to the dwell and traffic heatmaps.
+    
+    Args:
+        fixes: Tuple (tag_indices, positions, valid) as returned by the engine
+    """
+    tag_indices, positions, valid = fixes
+    if heatmap is None or not valid.any():
+        return
+    tag_indices = tag_indices[valid]
+    heatmap.add(tag_indices, positions[valid], engine.measurements.position_timestamps[tag_indices])
+
+async def save_heatmap_periodically(path):
+    while True:
+        await asyncio.sleep(HEATMAP_SAVE_INTERVAL)
+        heatmap.save(path)
+
+async def publish_sharded_fixes():
+    """
+    Publish and record the fixes the solver workers wrote to the shared fix table since the last check.
+    """
+    versions = sharded_solver.shared.fixes["version"]
+    published = versions.copy()
+    while True:
+        await asyncio.sleep(PUBLISH_INTERVAL)
+        # Odd versions are being written, they are picked up on the next pass
+        tag_addresses = np.flatnonzero((versions != published) & (versions % 2 == 0))
+        if len(tag_addresses):
+            published[tag_addresses] = versions[tag_addresses]
+            positions, times, anchors = sharded_solver.latest_fixes(tag_addresses)
+            if publisher is not None:
+                publisher.publish(tag_addresses, positions, times)
+            if history is not None:
+                history.append(tag_addresses, positions, times, anchors)
+            if heatmap is not None:
+                # Tag rows of the local table, which the workers' readings don't go through
+                heatmap.add(engine.measurements.tag_indices(tag_addresses), positions, times)
+
+def report_fixes(fixes):
+    """
+    Publish and record the position fixes produced by the location engine,
+    update the zones and heatmaps with them and print them (with --verbose).
+    
+    Args:
+        fixes: Tuple (tag_indices, positions, valid) as returned by the engine
+    """
+    publish_fixes(fixes)
+    record_history(fixes)
+    update_zones(fixes)
+    update_heatmap(fixes)
+    if not packet_output.enabled:
+        return
+    for tag_index, tag_position, is_valid in zip(*fixes):
+        tag_address = engine.measurements.tag_addresses[tag_index]
+        if is_valid:
+            packet_output(f"Tag {tag_address} position calculated at: ({tag_position[0]:.2f}, {tag_position[1]:.2f}, {tag_position[2]:.2f}) cm")
+        else:
+            packet_output(f"No valid solution found for tag {tag_address} position.")
+
+def check_anchor_health(now=None):
+    """
+    Mark anchors that went silent as degraded and print the anchors that went down or came back.
+    """
+    now = time.monotonic() if now is None else now
+    degraded, recovered = engine.check_health(now)
+    for anchor in np.concatenate([degraded, recovered]):
+        print(engine.health.describe(anchor, now))
 
 def process_incoming_data(json_data):
     """
@@ -66,99 +305,350 @@ def process_incoming_data(json_data):
     Args:
         json_data: JSON data containing distance measurements
     """
-    global distance_from_anchor_1, distance_from_anchor_2, distance_from_anchor_3, latest_tag_position
-
     try:
-        # Ensure required keys exist
-        if not all(k in json_data for k in ("device_address", "distance")):
-            print("Invalid JSON format or missing keys.")
-            return
-        
-        device_address = json_data.get("device_address")
-        distance_str = json_data.get("distance")
+        reading = parse_reading(json_data)
+        if reading is not None:
+            tag_address, anchor_address, distance_value = reading
+            report_fixes(engine.process_readings([tag_address], [anchor_address], [distance_value]))
+    except Exception as e:
+        metrics.parse_failures.inc(1, "reading")
+        error_output(f"Error processing incoming JSON data: {e}")
 
-        # Validate the distance format
-        if not isinstance(distance_str, str) or "cm" not in distance_str:
-            print(f"Invalid distance format: {distance_str}")
-            return
-        
-        # Extract distance value
-        distance_value = float(distance_str.replace(" cm", "").strip())
-
-        # Update respective distances based on device address
-        if device_address == "10":
-            distance_from_anchor_1 = distance_value
-            print(f"Anchor 1 distance updated to: {distance_from_anchor_1} cm")
-        elif device_address == "11":
-            distance_from_anchor_2 = distance_value
-            print(f"Anchor 2 distance updated to: {distance_from_anchor_2} cm")
-        elif device_address == "12":
-            distance_from_anchor_3 = distance_value
-            print(f"Anchor 3 distance updated to: {distance_from_anchor_3} cm")
-
-        # Calculate tag position if all distances are available
-        if all(distance is not None for distance in [distance_from_anchor_1, distance_from_anchor_2, distance_from_anchor_3]):
-            tag_position = calculate_position(
-                ANCHOR_1_POSITION, ANCHOR_2_POSITION, ANCHOR_3_POSITION, 
-                distance_from_anchor_1, distance_from_anchor_2, distance_from_anchor_3
+def process_datagrams(datagrams, recv_time=None):
+    """
+    Process a burst of UDP datagrams as one batch of readings.
+    
+    Binary packets (see wire_format.py) are decoded in place, JSON packets go
+    through parse_reading. Every epoch completed by the burst is solved once.
+    
+    Args:
+        datagrams: List of (data, (ip, port)) tuples as received from the anchors
+        recv_time: Receive time of the burst in seconds, defaults to time.monotonic().
+            Replays pass the recorded time so epochs are grouped as they were live.
+    """
+    # One segment of readings per datagram, concatenated in arrival order
+    tag_addresses, anchor_addresses, distances = [], [], []
+    binary_packets = binary_readings = 0
+    for data, (ip, port) in datagrams:
+        if is_binary_packet(data):
+            try:
+                readings = decode_binary_packet(data)
+            except ValueError as e:
+                metrics.parse_failures.inc(1, "binary")
+                error_output(f"Invalid binary packet from {ip}:{port}: {e}")
+                continue
+            tag_addresses.append(readings["tag"])
+            anchor_addresses.append(readings["anchor"])
+            distances.append(readings["distance"])
+            binary_packets += 1
+            binary_readings += len(readings)
+            continue
+
+        try:
+            # Decode and parse the JSON data
+            json_data = json.loads(bytes(data).decode('utf-8'))
+            if packet_output.enabled:
+                packet_output(f"Received from {ip}:{port}:\n{json.dumps(json_data, indent=4)}")
+
+            reading = parse_reading(json_data)
+            if reading is not None:
+                tag_address, anchor_address, distance = reading
+                tag_addresses.append([tag_address])
+                anchor_addresses.append([anchor_address])
+                distances.append([distance])
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            metrics.parse_failures.inc(1, "json")
+            error_output(f"Invalid JSON received:\n{bytes(data).decode('utf-8', errors='replace')}")
+        except Exception as e:
+            metrics.parse_failures.inc(1, "reading")
+            error_output(f"Error processing incoming JSON data: {e}")
+
+    if binary_packets:
+        packet_output(f"Received {binary_readings} binary readings in {binary_packets} packets")
+
+    if sharded_solver is not None:
+        # The workers solve, track and flush on their own
+        if distances:
+            sharded_solver.submit(
+                np.concatenate(tag_addresses), np.concatenate(anchor_addresses), np.concatenate(distances), recv_time
             )
+        return
 
-            if tag_position:
-                print(f"Tag position calculated at: ({tag_position[0]:.2f}, {tag_position[1]:.2f}, {tag_position[2]:.2f}) cm")
-                latest_tag_position = tag_position
-            else:
-                print("No valid solution found for tag position.")
-    except Exception as e:
-        print(f"Error processing incoming JSON data: {e}")
+    if distances:
+        report_fixes(engine.process_readings(
+            np.concatenate(tag_addresses), np.concatenate(anchor_addresses), np.concatenate(distances), recv_time
+        ))
+    report_fixes(engine.flush(recv_time))
+    check_anchor_health(recv_time)
 
-def send_polling_update(polling_period_ms):
+def replay_capture(path, speed):
     """
-    Send polling period update to all anchors.
+    Feed a recorded capture back through process_datagrams.
+    
+    Args:
+        path: Capture file written with --record
+        speed: Replay speed relative to real time, or None for as fast as possible
+    """
+    print(f"Replaying {path} at {'maximum' if speed is None else f'{speed}x'} speed...")
+    if history is not None:
+        # Replayed fixes carry the recorded Unix times
+        history.clock_offset = 0.0
+    start = time.perf_counter()
+    replayed, last_time = replay_log(path, process_datagrams, speed)
+    if last_time is not None:
+        # Close the epochs that were still open at the end of the capture
+        report_fixes(engine.flush(last_time + 2 * engine.synchronizer.windows.max()))
+    elapsed = time.perf_counter() - start
+    print(f"Replayed {replayed} packets in {elapsed:.2f} s ({replayed / max(elapsed, 1e-9):.0f} packets/s)")
+    print(f"{metrics.fixes.get()} fixes from {metrics.solves.get()} solves, "
+          f"{metrics.degenerate_geometry.get()} with degenerate geometry, "
+          f"{sum(metrics.parse_failures.values.values())} parse failures")
+
+async def flush_expired_epochs():
+    """
+    Periodically solve epochs that expired while no packets were arriving,
+    and notice anchors that went silent.
+    """
+    while True:
+        await asyncio.sleep(engine.synchronizer.window)
+        report_fixes(engine.flush())
+        check_anchor_health()
+
+async def send_polling_updates():
+    """
+    Periodically send the polling updates the scheduler decided on, including
+    resends to anchors that didn't apply an update yet.
+    """
+    scheduler = engine.scheduler
+    while True:
+        for anchor_indices, polling_period_ms in scheduler.due_updates(time.monotonic()):
+            send_polling_update(polling_period_ms, [ANCHOR_IPS[i] for i in anchor_indices])
+            metrics.polling_updates.inc_many(engine.measurements.anchor_addresses[anchor_indices])
+        await asyncio.sleep(POLLING_UPDATE_INTERVAL)
+
+async def run_client(ingest_server, heatmap_path=None):
+    """
+    Serve the ingest server together with the epoch flush and polling timers,
+    and the periodic heatmap save to `heatmap_path`.
+    """
+    tasks = [asyncio.create_task(flush_expired_epochs()), asyncio.create_task(send_polling_updates())]
+    if publisher is not None:
+        try:
+            await publisher.start()
+            outputs = []
+            if publisher.port is not None:
+                outputs.append(f"tcp://{publisher.host}:{publisher.port}")
+            if publisher.multicast is not None:
+                outputs.append(f"udp://{publisher.multicast[0]}:{publisher.multicast[1]}")
+            print(f"Publishing fixes on {' and '.join(outputs)}")
+        except OSError as e:
+            print(f"Could not publish fixes: {e}")
+    if heatmap_path is not None:
+        tasks.append(asyncio.create_task(save_heatmap_periodically(heatmap_path)))
+    if sharded_solver is not None and (publisher is not None or history is not None or heatmap is not None):
+        tasks.append(asyncio.create_task(publish_sharded_fixes()))
+    try:
+        await ingest_server.serve()
+    finally:
+        for task in tasks:
+            task.cancel()
+        if publisher is not None:
+            await publisher.close()
+
+def save_heatmap(path):
+    """
+    Save the heatmaps a last time.
+    """
+    if heatmap is None:
+        return
+    heatmap.save(path)
+    print(f"Saved the heatmaps of {heatmap.fixes_added} fixes to {path}")
+
+def close_history():
+    """
+    Write the buffered fixes of the position history and close it.
+    """
+    if history is None:
+        return
+    history.close()
+    print(f"Recorded {history.rows_written} fixes to {history.path}"
+          + (f", dropped {history.rows_dropped}" if history.rows_dropped else ""))
+
+def send_polling_update(polling_period_ms, anchor_ips=ANCHOR_IPS):
+    """
+    Send polling period update to anchors.
     
     Args:
         polling_period_ms: Polling period in milliseconds
+        anchor_ips: List of (ip, port) of the anchors, all anchors by default
     """
     polling_message = json.dumps({"polling_period": polling_period_ms})
-    for anchor_ip, anchor_port in ANCHOR_IPS:
+    for anchor_ip, anchor_port in anchor_ips:
         socket_connection.sendto(polling_message.encode('utf-8'), (anchor_ip, anchor_port))
-    print(f"Sent polling period update to anchors: {polling_message}")
+    print(f"Sent polling period update to {len(anchor_ips)} anchors: {polling_message}")
 
 def main():
     """
     Main function that listens for UDP packets and processes them.
     """
+    parser = argparse.ArgumentParser(description="UWB location tracking client")
+    parser.add_argument("--record", metavar="PATH", help="append every received packet to a capture file")
+    parser.add_argument("--replay", metavar="PATH", help="process a capture file instead of listening")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="replay speed relative to real time, 0 for as fast as possible (default: 1)")
+    parser.add_argument("--verbose", action="store_true", help="print every packet and fix (rate-limited)")
+    parser.add_argument("--metrics-port", type=int, default=DEFAULT_METRICS_PORT,
+                        help=f"serve Prometheus metrics on this local port, 0 to disable (default: {DEFAULT_METRICS_PORT})")
+    parser.add_argument("--calibration", metavar="PATH", help="correct ranges with a model fitted by calibration.py")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="solve in this many processes sharded by tag, 0 to solve in-process (default: 0)")
+    parser.add_argument("--polling-period", type=int, metavar="MS",
+                        help="poll all anchors at this fixed period instead of adapting it to the motion of the tags")
+    parser.add_argument("--publish-port", type=int, default=DEFAULT_PUBLISH_PORT,
+                        help=f"stream fixes to TCP subscribers on this local port, 0 to disable (default: {DEFAULT_PUBLISH_PORT})")
+    parser.add_argument("--multicast", action="store_true",
+                        help=f"also send fixes to the multicast group {DEFAULT_MULTICAST_GROUP}:{DEFAULT_MULTICAST_PORT}")
+    parser.add_argument("--zones", metavar="PATH",
+                        help="report zone enter, exit and dwell events for the zones in this file, e.g. zones.json")
+    parser.add_argument("--heatmap", metavar="PATH",
+                        help="accumulate dwell and traffic heatmaps and save them to this .npz file every minute and on exit")
+    parser.add_argument("--heatmap-half-life", type=float, metavar="S",
+                        help="let the heatmaps fade with this half-life in seconds instead of accumulating forever")
+    parser.add_argument("--history", metavar="PATH",
+                        help="append every fix to the position history in this directory (query it with position_history.py)")
+    parser.add_argument("--anchor-config", metavar="PATH",
+                        help="use the anchor positions of a config written by anchor_placement.py")
+    parser.add_argument("--best-anchors", type=int, metavar="K",
+                        help="solve every tag with the K anchors with the best geometry around its last fix (see gdop.py)")
+    args = parser.parse_args()
+    packet_output.enabled = args.verbose
+
+    global ANCHOR_POSITIONS
+    if args.anchor_config:
+        try:
+            _, positions = load_anchor_config(args.anchor_config, ANCHOR_ADDRESSES)
+            ANCHOR_POSITIONS = [tuple(position) for position in positions.tolist()]
+            engine.set_anchor_positions(ANCHOR_POSITIONS)
+            print(f"Anchor positions loaded from {args.anchor_config}")
+        except (OSError, ValueError) as e:
+            print(f"Could not load anchor config {args.anchor_config}: {e}")
+
+    global zone_tracker
+    if args.zones:
+        try:
+            zone_tracker = ZoneTracker(load_zones(args.zones))
+            print(f"Tracking {zone_tracker.zone_map.num_zones} zones from {args.zones}")
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Could not load zones {args.zones}: {e}")
+
+    global history
+    if args.history:
+        try:
+            history = PositionHistory(args.history)
+            metrics.bind_history(history)
+            print(f"Recording fixes to the position history in {args.history}")
+        except (OSError, ValueError) as e:
+            print(f"Could not open position history {args.history}: {e}")
+
+    global heatmap
+    if args.heatmap:
+        heatmap = OccupancyGrid.around(ANCHOR_POSITIONS, HEATMAP_MARGIN, half_life=args.heatmap_half_life)
+        print(f"Accumulating {heatmap.shape[1]}x{heatmap.shape[0]} cell heatmaps to {args.heatmap}")
+
+    if args.best_anchors:
+        engine.anchor_selector = GdopMap.around(ANCHOR_POSITIONS, DEFAULT_MARGIN, subset_size=args.best_anchors)
+        engine.anchor_selector.set_online(engine.health.healthy())
+        print(f"Solving with the best {engine.anchor_selector.subset_size} of {len(ANCHOR_POSITIONS)} anchors "
+              f"({len(engine.anchor_selector.subsets)} subsets on a {engine.anchor_selector.cell_size:.0f} cm grid)")
+
+    if args.calibration:
+        try:
+            engine.calibration = CalibrationModel.load(args.calibration).compile(ANCHOR_ADDRESSES)
+            print(f"Correcting ranges with calibration model {args.calibration}")
+        except (OSError, ValueError) as e:
+            print(f"Could not load calibration model {args.calibration}: {e}")
+
+    global sharded_solver
+    if args.workers > 0:
+        if args.replay:
+            print("Ignoring --workers, captures are replayed in-process so epochs match the live run")
+        else:
+            sharded_solver = ShardedSolver(
+                ANCHOR_ADDRESSES, ANCHOR_POSITIONS, args.workers,
+                engine_options={"calibration": args.calibration, "best_anchors": args.best_anchors},
+            )
+            for name in ("readings_queued", "readings_processed", "readings_dropped", "fixes_published"):
+                metrics.registry.gauge(f"uwb_sharded_{name}", f"Sharded solver {name.replace('_', ' ')}",
+                                       lambda name=name: sharded_solver.stats()[name])
+            print(f"Solving in {args.workers} worker processes")
+            if zone_tracker is not None:
+                print("Zone events are not reported when solving in worker processes")
+
+    metrics_server = None
+    if args.metrics_port:
+        try:
+            metrics_server = MetricsServer(metrics.registry, args.metrics_port).start()
+            print(f"Serving metrics on http://127.0.0.1:{args.metrics_port}/metrics")
+        except OSError as e:
+            print(f"Could not serve metrics on port {args.metrics_port}: {e}")
+
+    if args.replay:
+        try:
+            replay_capture(args.replay, args.speed if args.speed > 0 else None)
+        except KeyboardInterrupt:
+            print("\nReplay interrupted.")
+        finally:
+            close_history()
+            save_heatmap(args.heatmap)
+            if metrics_server is not None:
+                metrics_server.close()
+        return
+
+    global socket_connection
+    socket_connection = bind_socket(SERVER_IP, SERVER_PORT)
     print("Starting location tracking system...")
     print(f"Anchor 1 position: {ANCHOR_1_POSITION}")
     print(f"Anchor 2 position: {ANCHOR_2_POSITION}")
     print(f"Anchor 3 position: {ANCHOR_3_POSITION}")
+
+    # Without the engine seeing the readings (--workers) the scheduler can't adapt
+    if args.polling_period is None and sharded_solver is not None:
+        args.polling_period = DEFAULT_POLLING_PERIOD_MS
+    engine.scheduler.set_fixed_period(args.polling_period)
+    if args.polling_period is None:
+        print("Adapting the polling period of every anchor to the motion of its tags")
     
-    # Default polling period in milliseconds
-    default_polling_period = 100
-    send_polling_update(default_polling_period)
-    
-    # Main loop for UDP listening
+
+    global publisher
+    if args.publish_port or args.multicast:
+        publisher = PositionPublisher(
+            port=args.publish_port or None,
+            multicast=(DEFAULT_MULTICAST_GROUP, DEFAULT_MULTICAST_PORT) if args.multicast else None,
+            metrics=metrics,
+        )
+        metrics.bind_publisher(publisher)
+
+    # Event loop for UDP listening, bursts of packets are processed together
+    recorder = PacketRecorder(args.record) if args.record else None
+    if recorder is not None:
+        print(f"Recording packets to {args.record}")
+    ingest_server = IngestServer(socket_connection, process_datagrams, recorder=recorder, metrics=metrics)
     try:
-        while True:
-            # Receive data from the anchors
-            data, addr = socket_connection.recvfrom(1024)  # Buffer size is 1024 bytes
-            ip, port = addr
-            
-            try:
-                # Decode and parse the JSON data
-                json_data = json.loads(data.decode('utf-8'))
-                print(f"Received from {ip}:{port}:\n{json.dumps(json_data, indent=4)}")
-                
-                # Process the data
-                process_incoming_data(json_data)
-
-            except json.JSONDecodeError:
-                print("Invalid JSON received:")
-                print(data.decode('utf-8'))
+        asyncio.run(run_client(ingest_server, args.heatmap))
     except KeyboardInterrupt:
         print("\nShutting down...")
     finally:
         socket_connection.close()
         print("Socket closed.")
+        if metrics_server is not None:
+            metrics_server.close()
+        if sharded_solver is not None:
+            sharded_solver.close()
+        if recorder is not None:
+            recorder.close()
+            print(f"Recorded {recorder.records_written} packets to {args.record}")
+        close_history()
+        save_heatmap(args.heatmap)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,63 +1,110 @@
-import socket
+import argparse
+import asyncio
 import json
 import math
-import tkinter as tk
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-import matplotlib.patches as patches 
-import matplotlib.pyplot as plt
+import threading
+import time
 import numpy as np
 
+from ingest_server import IngestServer, bind_socket
+from measurement_table import DEFAULT_TAG_ADDRESS, MeasurementTable
+from anchor_health import AnchorHealth
+from anchor_placement import load_anchor_config
+from metrics import DEFAULT_METRICS_PORT, ClientMetrics, MetricsServer, RateLimitedPrinter
+from polling_scheduler import PollingScheduler
+from multilateration import MIN_ANCHORS, AnchorGeometry, refine_positions
+from occupancy import OccupancyGrid
+from tag_renderer import TagRenderer
+from zones import load_zones
+
 # default anchor positions
 anchor_1_position = (0, 0, 70)
 anchor_2_position = (350, 0, 70)
 anchor_3_position = (180, 200, 70)
 
+# UWB addresses of the three anchors, in the same order as the anchor positions
+ANCHOR_ADDRESSES = [7, 8, 10]
+
 # Server configuration
 UDP_IP = "0.0.0.0"  # Listen on all available interfaces
 UDP_PORT = 50000  # Match the port number used in the ESP32 code
 
-# Anchor addresses (example IPs and ports)
+# Anchor addresses (example IPs and ports), in the same order as ANCHOR_ADDRESSES
 ANCHOR_IPS = [("192.168.1.170", 50000), ("192.168.1.171", 50000), ("192.168.1.173", 50000)]
 
-# Create a UDP socket
-sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-sock.bind((UDP_IP, UDP_PORT))
+# Floor extent shown by the UI in cm. Tags are drawn at (x, -y), see TagRenderer.
+PLOT_XLIM = (-300, 500)
+PLOT_YLIM = (-300, 1250)
+
+# Seconds between two redraws of the heatmap while it is shown
+HEATMAP_REDRAW_INTERVAL = 5.0
+
+# Polling period the slider starts at, in milliseconds
+DEFAULT_POLLING_PERIOD_MS = 100
+
+# Seconds between two rounds of polling updates and anchor health checks
+UPDATE_INTERVAL = 0.1
+
+# UDP socket the anchors send to, bound by main() so importing this module has no side effects
+sock = None
+
+# Ingest server receiving on sock, created by main(). Polling updates are sent through it from either thread.
+ingest_server = None
+
+# GUI and plotting libraries, imported by load_gui() so --headless starts without them
+tk = None
+patches = None
+plt = None
+FigureCanvasTkAgg = None
+
+# Latest distance from every tag to every anchor, and the latest position of every tag
+measurements = MeasurementTable(ANCHOR_ADDRESSES)
+
+# Anchor positions with the solver factorizations cached, updated by TagPositionUI.update_anchor_positions
+geometry = AnchorGeometry([anchor_1_position, anchor_2_position, anchor_3_position])
+
+# Dwell and traffic of the tags over the floor the UI shows, optionally fading (--heatmap-half-life)
+heatmap = OccupancyGrid(PLOT_XLIM, (-PLOT_YLIM[1], -PLOT_YLIM[0]))
+
+# Last seen time, report rate, jitter and range variance of every anchor. Anchors that went silent are left out of solves.
+health = AnchorHealth(ANCHOR_ADDRESSES)
+
+# Sends the polling period of the slider once it settles, and again to anchors that didn't apply it
+scheduler = PollingScheduler(len(ANCHOR_ADDRESSES))
 
-print(f"Listening for UDP packets on {UDP_IP}:{UDP_PORT}...")
+# Guards the state above, which the ingest thread updates while the Tk thread
+# draws it, moves the anchors and runs the polling and health timers
+state_lock = threading.Lock()
 
-# Variables to store the latest distances
-distance_1 = None
-distance_2 = None
-latest_tag_position = None  # Variable to store the latest calculated tag position
+# Counters and histograms of the client, served in the Prometheus format on --metrics-port
+metrics = ClientMetrics()
+
+# Per-packet console output is off unless --verbose is given, and both are rate-limited
+packet_output = RateLimitedPrinter(enabled=False)
+error_output = RateLimitedPrinter()
 
 
 def calculate_tag_position(anchor1, anchor2, anchor3, distance1, distance2, distance3):
-    
-    # Calculate U (displacement in x-axis between first two anchors)
-    U = anchor2[0] - anchor1[0]
-    
-    # Calculate V2 (squared distance of third anchor from origin in XZ plane)
-    V2 = anchor3[0]**2 + anchor3[2]**2
-    
-    # Trilateration formulas
-    x = (distance1**2 - distance2**2 + U**2) / (2 * U)
-    y = (distance1**2 - distance3**2 + V2 - 2 * anchor3[0] * x) / (2 * anchor3[2])
-    
-    # Calculate z (we'll set it to 0 as per the original function)
-    z = 0
-    
-    # Create and return the position vector
-    return x,y,z
+    """
+    Calculate the 3D position of a tag from three anchors using the shared Gauss-Newton solver.
+    :return: Tuple (x, y, z) of the tag's position, or None if the anchors are collinear
+    """
+    positions, valid, _, _ = refine_positions(
+        [[distance1, distance2, distance3]], [anchor1, anchor2, anchor3]
+    )
+    if not valid[0]:
+        return None
 
+    x, y, z = positions[0]
+    return x, y, z
 
 
 def process_incoming_data(json_data, ui):
-    global distance_1, distance_2, distance_3, latest_tag_position
-
     try:
         # Ensure required keys exist
         if not all(k in json_data for k in ("device_address", "distance")):
-            print("Invalid JSON format or missing keys.")
+            metrics.parse_failures.inc(1, "missing_keys")
+            error_output("Invalid JSON format or missing keys.")
             return
         
         device_address = json_data.get("device_address")
@@ -65,38 +112,115 @@ def process_incoming_data(json_data, ui):
 
         # Validate the distance format
         if not isinstance(distance_str, str) or "cm" not in distance_str:
-            print(f"Invalid distance format: {distance_str}")
+            metrics.parse_failures.inc(1, "distance_format")
+            error_output(f"Invalid distance format: {distance_str}")
             return
         
         # Process distance
         distance_value = float(distance_str.replace(" cm", "").strip())
+        tag_address = int(json_data.get("tag_address", DEFAULT_TAG_ADDRESS))
 
-        # Update respective distances
-        if device_address == "7":
-            distance_1 = distance_value
-            print(f"Anchor 1 distance updated to: {distance_1} cm")
-        elif device_address == "8":
-            distance_2 = distance_value
-            print(f"Anchor 2 distance updated to: {distance_2} cm")
-        elif device_address == "10":
-            distance_3 = distance_value
-            print(f"Anchor 3 distance updated to: {distance_3} cm")
-
-        # Attempt to calculate tag position if both distances are available
-        if distance_1 is not None and distance_2 is not None and distance_3 is not None:
-            # Define anchor positions (you can adjust these coordinates)
-
-            tag_position = calculate_tag_position(
-                ui.anchor_1_position, ui.anchor_2_position, ui.anchor_3_position, distance_1, distance_2, distance_3
-            )
-
-            if tag_position:
-                print(f"Tag position calculated at: {tag_position}")
-                latest_tag_position = tag_position
-            else:
-                print("No valid solution found for tag position.")
+        # Update the distance of the reporting anchor
+        anchor_index = measurements.anchor_index(int(device_address))
+        metrics.readings_received.inc(1, int(device_address))
+        if anchor_index < 0:
+            metrics.parse_failures.inc(1, "unknown_anchor")
+            return
+        with state_lock:
+            now = time.monotonic()
+            tag_index = measurements.tag_index(tag_address)
+            health.observe([anchor_index], now, [distance_value], [measurements.distances[tag_index, anchor_index]])
+            measurements.store([tag_index], [anchor_index], [distance_value], now)
+            scheduler.observe_readings([tag_index], [anchor_index], now)
+            packet_output(f"Anchor {device_address} distance updated to: {distance_value} cm")
+
+            # Attempt to calculate tag position if the distances of all healthy anchors are
+            # available. Anchors that went silent are left out instead of solving with their last distance.
+            usable = health.healthy()
+            if np.count_nonzero(usable) >= MIN_ANCHORS and not np.isnan(measurements.distances[tag_index, usable]).any():
+                start = time.perf_counter()
+                _, positions, valid = measurements.solve(geometry, [tag_index], anchors=usable, refine=True)
+                metrics.solve_latency.observe(time.perf_counter() - start)
+                metrics.solves.inc()
+
+                if valid[0]:
+                    packet_output(f"Tag position calculated at: {tuple(positions[0])}")
+                    metrics.fixes.inc()
+                    heatmap.add([tag_index], positions[:1], now)
+                else:
+                    metrics.degenerate_geometry.inc()
+                    packet_output("No valid solution found for tag position.")
     except Exception as e:
-        print(f"Error processing incoming JSON data: {e}")
+        metrics.parse_failures.inc(1, "reading")
+        error_output(f"Error processing incoming JSON data: {e}")
+
+
+def load_gui():
+    """
+    Import tkinter and matplotlib into the module globals the UI uses.
+    """
+    global tk, patches, plt, FigureCanvasTkAgg
+    import tkinter as tk
+    import matplotlib.patches as patches
+    import matplotlib.pyplot as plt
+    from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+
+
+def check_anchor_health():
+    """
+    Mark anchors that went silent as degraded and print the anchors that went down or came back.
+
+    Returns:
+        True if an anchor changed health
+    """
+    now = time.monotonic()
+    with state_lock:
+        degraded, recovered = health.check(now)
+        changes = [health.describe(anchor, now) for anchor in list(degraded) + list(recovered)]
+    for change in changes:
+        print(change)
+    return bool(len(degraded) or len(recovered))
+
+
+def send_polling_updates():
+    """
+    Send the polling updates that are due, including resends to anchors that didn't apply one yet.
+    """
+    with state_lock:
+        updates = list(scheduler.due_updates(time.monotonic()))
+    for anchor_indices, polling_period in updates:
+        # The ingest server sends from its event loop, so this is safe from the Tk thread
+        ingest_server.send_polling_update(polling_period, [ANCHOR_IPS[anchor_index] for anchor_index in anchor_indices])
+        polling_message = json.dumps({"polling_period": polling_period})
+        print(f"Sent polling period update to {len(anchor_indices)} anchors: {polling_message}")
+
+
+def save_heatmap(path):
+    """
+    Export the heatmaps to a .npz file, if a path was given.
+    """
+    if not path:
+        return
+    with state_lock:
+        heatmap.save(path)
+    print(f"Saved the heatmaps of {heatmap.fixes_added} fixes to {path}")
+
+
+async def run_headless(ingest_server):
+    """
+    Serve the ingest server with the polling and health timers of the UI, but without a UI.
+    """
+    async def run_timers():
+        while True:
+            await asyncio.sleep(UPDATE_INTERVAL)
+            send_polling_updates()
+            check_anchor_health()
+
+    timers = asyncio.create_task(run_timers())
+    try:
+        await ingest_server.serve()
+    finally:
+        timers.cancel()
 
 
 # Set up the UI with matplotlib integration
@@ -105,21 +229,24 @@ class TagPositionUI:
         self.master = master
         self.master.title("Tag Position UI Grid")
         self.latest_position = None
-        self.polling_period = 100  # Default polling period in milliseconds
+        self.polling_period = DEFAULT_POLLING_PERIOD_MS
 
         # Default anchor positions
         self.anchor_1_position = list(anchor_1_position)  # Use a mutable list
         self.anchor_2_position = list(anchor_2_position)
         self.anchor_3_position = list(anchor_3_position)
 
+        # Rooms drawn behind the tags
+        self.zone_map = load_zones()
+
         # Set up matplotlib figure and canvas
         self.fig, self.ax = plt.subplots()
         self.canvas = FigureCanvasTkAgg(self.fig, master)
         self.canvas.get_tk_widget().pack(fill=tk.BOTH, expand=1)
 
         # Set up axes limits
-        self.ax.set_xlim(-300, 500)
-        self.ax.set_ylim(-300, 1250)
+        self.ax.set_xlim(*PLOT_XLIM)
+        self.ax.set_ylim(*PLOT_YLIM)
         self.ax.set_xlabel("X Coordinate")
         self.ax.set_ylabel("Y Coordinate")
         self.ax.grid()
@@ -133,9 +260,12 @@ class TagPositionUI:
         # Create polling period slider
         self.create_polling_slider()
 
-        # References for dynamically plotted elements
-        self.current_tag_point = None
-        self.current_annotation = None
+        # Heatmap toggle, the heatmap is part of the background and redrawn every HEATMAP_REDRAW_INTERVAL
+        self.create_heatmap_toggle()
+        self.heatmap_drawn_at = time.monotonic()
+
+        # Tags are blitted over the cached background instead of redrawing the whole figure
+        self.tag_renderer = TagRenderer(self.canvas, self.ax, metrics=metrics)
 
         # Call the update function periodically
         self.master.after(100, self.update_plot)
@@ -210,41 +340,57 @@ class TagPositionUI:
                 float(self.anchor_3_z_entry.get()),
             ]
 
-            # Redraw the background and anchors
-            self.ax.clear()
-            self.ax.set_xlim(-300, 500)
-            self.ax.set_ylim(-300, 1250)
-            self.ax.set_xlabel("X Coordinate")
-            self.ax.set_ylabel("Y Coordinate")
-            self.ax.grid()
-            self.draw_background_squares()
+            # The cached solver factorizations only hold for the old positions
+            with state_lock:
+                geometry.set_positions([self.anchor_1_position, self.anchor_2_position, self.anchor_3_position])
 
+            self.redraw_background()
             print(f"Anchor positions updated to: {self.anchor_1_position}, {self.anchor_2_position}, {self.anchor_3_position}")
-
-            # Redraw tag position if available
-            if latest_tag_position:
-                self.update_tag_position(latest_tag_position)
-
-            self.canvas.draw()
         except ValueError:
             print("Invalid input for anchor positions. Please enter numeric values.")
 
+    def redraw_background(self):
+        """
+        Redraw the background and anchors, e.g. after the anchors moved or one changed health.
+        """
+        self.ax.clear()
+        self.ax.set_xlim(*PLOT_XLIM)
+        self.ax.set_ylim(*PLOT_YLIM)
+        self.ax.set_xlabel("X Coordinate")
+        self.ax.set_ylabel("Y Coordinate")
+        self.ax.grid()
+        self.draw_background_squares()
+
+        # Clearing the axes removed the tag artists, the full draw caches the new background
+        self.tag_renderer.reset()
+        self.canvas.draw()
+        with state_lock:
+            self.tag_renderer.update(measurements)
+
     def draw_background_squares(self):
         """
         Draw background squares that remain constant and act as a permanent background.
         """
-        # Add background rectangles as before (unchanged)
-        self.ax.add_patch(patches.Rectangle((0, 0), -200, 200, linewidth=0, edgecolor='blue', facecolor='blue', alpha=0.3))
-        self.ax.add_patch(patches.Rectangle((-200, 200), 200, 300, linewidth=0, edgecolor='red', facecolor='red', alpha=0.3))
-        self.ax.add_patch(patches.Rectangle((0, 0), 375, 300, linewidth=0, edgecolor='green', facecolor='green', alpha=0.3))
-        self.ax.add_patch(patches.Rectangle((0, 300), 100, 700, linewidth=0, edgecolor='yellow', facecolor='yellow', alpha=0.3))
-        self.ax.add_patch(patches.Rectangle((-200, 500), 200, 150, linewidth=0, edgecolor='yellow', facecolor='yellow', alpha=0.3))
-        self.ax.add_patch(patches.Rectangle((100, 300), 275, 400, linewidth=0, edgecolor='purple', facecolor='purple', alpha=0.3))
-        self.ax.add_patch(patches.Rectangle((100, 700), 275, 500, linewidth=0, edgecolor='brown', facecolor='brown', alpha=0.3))
-        self.ax.add_patch(patches.Rectangle((-200, 650), 200, 550, linewidth=0, edgecolor='orange', facecolor='orange', alpha=0.3))
-
-        # Redraw anchors
-        self.ax.plot(self.anchor_1_position[0], self.anchor_1_position[1], 'rs', markersize=10)
+        # Rooms and hallways of zones.json, in floor coordinates, so their y is flipped like the tags'
+        for zone in range(self.zone_map.num_zones):
+            color = self.zone_map.colors[zone]
+            self.ax.add_patch(patches.Polygon(
+                self.zone_map.polygon(zone) * (1, -1), closed=True, linewidth=0, edgecolor=color, facecolor=color,
+                alpha=0.3,
+            ))
+
+        # Dwell time heatmap under the tags, whose y is flipped like theirs
+        if self.show_heatmap.get():
+            with state_lock:
+                dwell, _ = heatmap.snapshot()
+            xmin, xmax, ymin, ymax = heatmap.extent
+            self.ax.imshow(np.ma.masked_equal(dwell, 0), extent=(xmin, xmax, -ymin, -ymax), origin="lower",
+                           cmap="hot_r", alpha=0.6, aspect="auto", interpolation="nearest", zorder=0)
+
+        # Redraw anchors, degraded ones in black
+        with state_lock:
+            healthy = health.healthy()
+        self.ax.plot(self.anchor_1_position[0], self.anchor_1_position[1], 'rs' if healthy[0] else 'ks', markersize=10)
         self.ax.annotate(
             "Anchor 1",
             (self.anchor_1_position[0], self.anchor_1_position[1]),
@@ -252,7 +398,7 @@ class TagPositionUI:
             xytext=(5, -15),
             ha="center",
         )
-        self.ax.plot(self.anchor_2_position[0], self.anchor_2_position[1], 'rs', markersize=10)
+        self.ax.plot(self.anchor_2_position[0], self.anchor_2_position[1], 'rs' if healthy[1] else 'ks', markersize=10)
         self.ax.annotate(
             "Anchor 2",
             (self.anchor_2_position[0], self.anchor_2_position[1]),
@@ -260,7 +406,7 @@ class TagPositionUI:
             xytext=(5, -15),
             ha="center",
         )
-        self.ax.plot(self.anchor_3_position[0], self.anchor_3_position[1], 'rs', markersize=10)
+        self.ax.plot(self.anchor_3_position[0], self.anchor_3_position[1], 'rs' if healthy[2] else 'ks', markersize=10)
         self.ax.annotate(
             "Anchor 3",
             (self.anchor_3_position[0], self.anchor_3_position[1]),
@@ -285,87 +431,114 @@ class TagPositionUI:
         self.polling_slider.set(self.polling_period)
         self.polling_slider.pack(fill=tk.X, expand=True)
 
+    def create_heatmap_toggle(self):
+        self.show_heatmap = tk.BooleanVar(value=False)
+        tk.Checkbutton(
+            self.master, text="Show dwell heatmap", variable=self.show_heatmap, command=self.redraw_background
+        ).pack(anchor=tk.W, padx=10)
+
     def update_polling_period(self, value):
+        # Dragging the slider calls this for every step, the scheduler only
+        # sends the value it settles on (see send_polling_updates)
         self.polling_period = int(value)
-        print(f"Polling period updated to: {self.polling_period} ms")
-
-        # Send the updated polling period to the anchors
-        polling_message = json.dumps({"polling_period": self.polling_period})
-        for anchor_ip, anchor_port in ANCHOR_IPS:
-            sock.sendto(polling_message.encode('utf-8'), (anchor_ip, anchor_port))
-        print(f"Sent polling period update to anchors: {polling_message}")
-
-    def update_tag_position(self, position):
-        """
-        Updates the red dot and its annotation for the tag position dynamically.
-        Clears the previous red dot and annotation if they exist.
-        """
-        # Remove the previous red dot and annotation if they exist
-        if self.current_tag_point:
-            self.current_tag_point.remove()
-            self.current_tag_point = None
-        if self.current_annotation:
-            self.current_annotation.remove()
-            self.current_annotation = None
-
-        # Plot new red dot
-        self.current_tag_point = self.ax.plot(position[0], -position[1], 'ro')[0]
-        # Add new annotation
-        self.current_annotation = self.ax.annotate(
-            f"Tag ({position[0]:.2f}, {position[1]:.2f})",
-            (position[0], -position[1]),
-            textcoords="offset points",
-            xytext=(5, 5),
-            ha="center",
-        )
+        with state_lock:
+            scheduler.set_fixed_period(self.polling_period)
 
     def update_plot(self):
         """
-        Periodically called to check for updates in the latest tag position and redraw the dynamic plot.
+        Periodically called to draw the latest tag positions. Only the tags are
+        blitted over the cached background, and only when a new fix arrived.
+        Polling updates that are due and anchor health checks run on the same timer.
         """
-        # Avoid clearing the permanent background - only draw dynamic elements
-        self.ax.set_xlim(-300, 500)
-        self.ax.set_ylim(-300, 1250)
-
-        # Redraw the tag position if available
-        if latest_tag_position:
-            self.update_tag_position(latest_tag_position)
-
-        # Redraw only the dynamic parts
-        self.canvas.draw()
-        self.master.after(100, self.update_plot)  # Reschedule this function
+        with state_lock:
+            self.tag_renderer.update(measurements)
+        send_polling_updates()
+        # Redraw the anchors when one went down or came back, and the heatmap now and then
+        now = time.monotonic()
+        heatmap_due = self.show_heatmap.get() and now - self.heatmap_drawn_at > HEATMAP_REDRAW_INTERVAL
+        if check_anchor_health() or heatmap_due:
+            self.heatmap_drawn_at = now
+            self.redraw_background()
+        self.master.after(int(1000 * UPDATE_INTERVAL), self.update_plot)  # Reschedule this function
 
 
 # Main loop for receiving UDP packets and starting UI
 def main():
-    # Start Tkinter UI
-    root = tk.Tk()
-    ui = TagPositionUI(root)
-
-    # Thread or main loop for UDP listening
-    def udp_listener():
-        while True:
-            # Receive data from the ESP32
-            data, addr = sock.recvfrom(1024)  # Buffer size is 1024 bytes
-            ip, port = addr
+    parser = argparse.ArgumentParser(description="UWB tag position UI")
+    parser.add_argument("--verbose", action="store_true", help="print every packet and fix (rate-limited)")
+    parser.add_argument("--metrics-port", type=int, default=DEFAULT_METRICS_PORT,
+                        help=f"serve Prometheus metrics on this local port, 0 to disable (default: {DEFAULT_METRICS_PORT})")
+    parser.add_argument("--headless", action="store_true",
+                        help="receive and solve without the UI, tkinter and matplotlib aren't loaded")
+    parser.add_argument("--heatmap", metavar="PATH", help="save the dwell and traffic heatmaps to this .npz file on exit")
+    parser.add_argument("--heatmap-half-life", type=float, metavar="S",
+                        help="let the heatmaps fade with this half-life in seconds instead of accumulating forever")
+    parser.add_argument("--anchor-config", metavar="PATH",
+                        help="start with the anchor positions of a config written by anchor_placement.py")
+    args = parser.parse_args()
+    packet_output.enabled = args.verbose
+
+    global anchor_1_position, anchor_2_position, anchor_3_position
+    # Loaded before the ingest thread starts, so the geometry needs no lock yet
+    if args.anchor_config:
+        try:
+            _, positions = load_anchor_config(args.anchor_config, ANCHOR_ADDRESSES)
+            anchor_1_position, anchor_2_position, anchor_3_position = (tuple(p) for p in positions.tolist())
+            geometry.set_positions(positions)
+            print(f"Anchor positions loaded from {args.anchor_config}")
+        except (OSError, ValueError) as e:
+            print(f"Could not load anchor config {args.anchor_config}: {e}")
+    heatmap.half_life = args.heatmap_half_life
+    if args.metrics_port:
+        try:
+            MetricsServer(metrics.registry, args.metrics_port).start()
+            print(f"Serving metrics on http://127.0.0.1:{args.metrics_port}/metrics")
+        except OSError as e:
+            print(f"Could not serve metrics on port {args.metrics_port}: {e}")
+
+    global sock, ingest_server
+    sock = bind_socket(UDP_IP, UDP_PORT)
+
+    ui = None
+    if not args.headless:
+        load_gui()
+        root = tk.Tk()
+        ui = TagPositionUI(root)
+
+    # Event loop for UDP listening, bursts of packets are handed over together
+    def handle_batch(datagrams):
+        for data, (ip, port) in datagrams:
             try:
                 # Decode and parse the JSON data
                 json_data = json.loads(data.decode('utf-8'))
-                print(f"Received from {ip}:{port}:\n{json.dumps(json_data, indent=4)}")
+                if packet_output.enabled:
+                    packet_output(f"Received from {ip}:{port}:\n{json.dumps(json_data, indent=4)}")
                 
                 # Process the data
                 process_incoming_data(json_data, ui)
 
-            except json.JSONDecodeError:
-                print("Invalid JSON received:")
-                print(data.decode('utf-8'))
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                metrics.parse_failures.inc(1, "json")
+                error_output(f"Invalid JSON received:\n{data.decode('utf-8', errors='replace')}")
+
+    ingest_server = IngestServer(sock, handle_batch, metrics=metrics)
+    if args.headless:
+        # Anchors poll at the period the slider would start at
+        scheduler.set_fixed_period(DEFAULT_POLLING_PERIOD_MS)
+        try:
+            asyncio.run(run_headless(ingest_server))
+        except KeyboardInterrupt:
+            print("\nShutting down...")
+        finally:
+            sock.close()
+            save_heatmap(args.heatmap)
+        return
 
-    import threading
-    listener_thread = threading.Thread(target=udp_listener, daemon=True)
-    listener_thread.start()
+    ingest_server.start_in_thread()
 
     # Start the Tkinter mainloop
     root.mainloop()
+    save_heatmap(args.heatmap)
 
 
 if __name__ == "__main__":
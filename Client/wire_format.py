@@ -0,0 +1,189 @@
+import struct
+
+import numpy as np
+
+# Binary anchor packets start with this magic so they can't be mistaken for JSON ('{')
+PACKET_MAGIC = b"UW"
+PACKET_VERSION = 1
+
+# Header: magic, version, number of readings that follow
+PACKET_HEADER = struct.Struct("<2sBB")
+
+# One fixed-size, little-endian reading (12 bytes):
+#   anchor     UWB address of the anchor that measured the distance
+#   tag        UWB address of the tag
+#   distance   distance in whole centimeters
+#   sequence   per-anchor ranging counter, wraps at 65536
+#   timestamp  anchor clock (millis()) when the distance was measured
+READING_DTYPE = np.dtype([
+    ("anchor", "<u2"),
+    ("tag", "<u2"),
+    ("distance", "<u2"),
+    ("sequence", "<u2"),
+    ("timestamp", "<u4"),
+])
+
+# Most readings that fit in one datagram of the client's 1024 byte receive buffer
+MAX_READINGS_PER_PACKET = (1024 - PACKET_HEADER.size) // READING_DTYPE.itemsize
+
+
+def is_binary_packet(data):
+    """
+    Check whether a datagram uses the binary format rather than JSON.
+    """
+    return data[:2] == PACKET_MAGIC
+
+
+def encode_readings(anchors, tags, distances, sequences, timestamps):
+    """
+    Pack readings into one binary datagram.
+
+    Args:
+        anchors: Anchor addresses
+        tags: Tag addresses
+        distances: Distances in cm, rounded to whole centimeters
+        sequences: Sequence numbers
+        timestamps: Anchor timestamps in ms
+
+    Returns:
+        Bytes of the encoded datagram
+    """
+    readings = np.empty(len(anchors), dtype=READING_DTYPE)
+    if len(readings) > MAX_READINGS_PER_PACKET:
+        raise ValueError(f"At most {MAX_READINGS_PER_PACKET} readings fit in one packet, got {len(readings)}")
+
+    readings["anchor"] = anchors
+    readings["tag"] = tags
+    readings["distance"] = np.rint(distances)
+    readings["sequence"] = np.asarray(sequences, dtype=np.int64) & 0xFFFF
+    readings["timestamp"] = np.asarray(timestamps, dtype=np.int64) & 0xFFFFFFFF
+    return PACKET_HEADER.pack(PACKET_MAGIC, PACKET_VERSION, len(readings)) + readings.tobytes()
+
+
+def decode_binary_packet(data):
+    """
+    Decode a binary datagram without copying it.
+
+    Args:
+        data: The received datagram (bytes, bytearray or memoryview)
+
+    Returns:
+        Read-only structured array of READING_DTYPE viewing the datagram's buffer
+
+    Raises:
+        ValueError: If the header is wrong or the length doesn't match the reading count
+    """
+    view = memoryview(data)
+    if len(view) < PACKET_HEADER.size:
+        raise ValueError(f"Binary packet too short: {len(view)} bytes")
+
+    magic, version, count = PACKET_HEADER.unpack_from(view)
+    if magic != PACKET_MAGIC or version != PACKET_VERSION:
+        raise ValueError(f"Unsupported binary packet (magic {magic!r}, version {version})")
+
+    expected_length = PACKET_HEADER.size + count * READING_DTYPE.itemsize
+    if len(view) != expected_length:
+        raise ValueError(f"Binary packet length {len(view)} does not match {count} readings")
+
+    return np.frombuffer(view, dtype=READING_DTYPE, count=count, offset=PACKET_HEADER.size)
+
+
+def decode_binary_records(buffer, offsets, lengths):
+    """
+    Decode many binary datagrams stored in one buffer (e.g. a mapped capture
+    file) with a single gather, instead of one decode_binary_packet per datagram.
+
+    Datagrams that aren't binary packets, or are malformed, are skipped, as
+    decode_binary_packet would reject them.
+
+    Args:
+        buffer: uint8 array holding the datagrams
+        offsets: Offset of every datagram in the buffer
+        lengths: Length of every datagram in bytes
+
+    Returns:
+        Tuple (readings, records, valid): array of READING_DTYPE with the
+        readings of all valid datagrams in order, the index of the datagram
+        every reading came from, and a boolean mask of the valid datagrams
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    valid = lengths >= PACKET_HEADER.size
+    header = buffer[offsets[valid, None] + np.arange(PACKET_HEADER.size)]
+    counts = np.zeros(len(offsets), dtype=np.int64)
+    counts[valid] = header[:, 3]
+    valid[valid] = (
+        (header[:, 0] == PACKET_MAGIC[0]) & (header[:, 1] == PACKET_MAGIC[1]) & (header[:, 2] == PACKET_VERSION)
+    )
+    valid &= lengths == PACKET_HEADER.size + counts * READING_DTYPE.itemsize
+    counts[~valid] = 0
+
+    # Byte offset of every reading, then all of their bytes in one gather
+    records = np.repeat(np.arange(len(offsets)), counts)
+    ranks = np.arange(len(records)) - np.repeat(np.cumsum(counts) - counts, counts)
+    starts = offsets[records] + PACKET_HEADER.size + ranks * READING_DTYPE.itemsize
+    raw = buffer[starts[:, None] + np.arange(READING_DTYPE.itemsize)]
+    return raw.view(READING_DTYPE).reshape(-1), records, valid
+
+
+# Frames of position fixes published by the client (position_publisher.py)
+# start with their own magic. The count is 16-bit so a TCP frame can carry
+# every tag at once.
+FIX_MAGIC = b"UF"
+FIX_VERSION = 1
+FIX_HEADER = struct.Struct("<2sBH")
+
+# One published fix (22 bytes):
+#   tag   UWB address of the tag
+#   x, y, z  position in cm
+#   time  Unix time of the fix in seconds
+FIX_DTYPE = np.dtype([
+    ("tag", "<u2"),
+    ("x", "<f4"),
+    ("y", "<f4"),
+    ("z", "<f4"),
+    ("time", "<f8"),
+])
+
+# Most fixes per frame, and per multicast datagram so it isn't fragmented on Ethernet
+MAX_FIXES_PER_FRAME = 0xFFFF
+MAX_FIXES_PER_DATAGRAM = (1472 - FIX_HEADER.size) // FIX_DTYPE.itemsize
+
+
+def encode_fixes(fixes, max_fixes=MAX_FIXES_PER_FRAME):
+    """
+    Pack fixes into frames.
+
+    Args:
+        fixes: Structured array of FIX_DTYPE
+        max_fixes: Most fixes per frame, MAX_FIXES_PER_DATAGRAM for UDP
+
+    Returns:
+        List of frames (bytes)
+    """
+    return [
+        FIX_HEADER.pack(FIX_MAGIC, FIX_VERSION, len(chunk)) + chunk.tobytes()
+        for chunk in (fixes[start:start + max_fixes] for start in range(0, len(fixes), max_fixes))
+    ]
+
+
+def decode_fixes(data):
+    """
+    Decode one frame of fixes without copying it.
+
+    Raises:
+        ValueError: If the header is wrong or the length doesn't match the fix count
+    """
+    view = memoryview(data)
+    if len(view) < FIX_HEADER.size:
+        raise ValueError(f"Fix frame too short: {len(view)} bytes")
+
+    magic, version, count = FIX_HEADER.unpack_from(view)
+    if magic != FIX_MAGIC or version != FIX_VERSION:
+        raise ValueError(f"Unsupported fix frame (magic {magic!r}, version {version})")
+
+    expected_length = FIX_HEADER.size + count * FIX_DTYPE.itemsize
+    if len(view) != expected_length:
+        raise ValueError(f"Fix frame length {len(view)} does not match {count} fixes")
+
+    return np.frombuffer(view, dtype=FIX_DTYPE, count=count, offset=FIX_HEADER.size)
@@ -0,0 +1,340 @@
+import json
+import os
+
+import numpy as np
+
+from tracking import unique_passes
+
+# Zone config used when none is given, the rooms drawn by ui_test.py
+DEFAULT_ZONES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "zones.json")
+
+# Time in seconds a tag has to stay in a zone before a dwell event
+DEFAULT_DWELL_TIME = 10.0
+
+# Upper bound of grid cells per axis, so huge sites with tiny zones stay bounded
+MAX_GRID_CELLS = 256
+
+# Event kinds
+ENTER, EXIT, DWELL = 0, 1, 2
+EVENT_NAMES = ("enter", "exit", "dwell")
+
+EVENT_DTYPE = np.dtype([
+    ("tag", np.int64),        # tag row of the caller's measurement table
+    ("zone", np.int32),       # index into ZoneMap.names
+    ("kind", np.uint8),       # ENTER, EXIT or DWELL
+    ("time", np.float64),     # time of the fix that triggered the event
+    ("duration", np.float64), # time spent in the zone, for exit and dwell
+])
+
+
+def rectangle_vertices(x, y, width, height):
+    """
+    Corners of a rectangle given like matplotlib.patches.Rectangle((x, y), width, height).
+    Width and height may be negative.
+    """
+    return [(x, y), (x + width, y), (x + width, y + height), (x, y + height)]
+
+
+def load_zones(path=DEFAULT_ZONES_PATH):
+    """
+    Load zones from a JSON config.
+
+    The file holds {"zones": [...]} where every zone has a name, optionally a
+    color and dwell time in seconds, and either a rectangle
+    "rect": [x, y, width, height] or a polygon "polygon": [[x, y], ...], in cm.
+    Coordinates are floor coordinates, the ones fixes are solved in, not the
+    flipped plot coordinates of ui_test.py.
+
+    Returns:
+        ZoneMap
+
+    Raises:
+        ValueError: If a zone has neither a rectangle nor a polygon
+    """
+    with open(path) as f:
+        config = json.load(f)
+
+    names, polygons, rectangles, colors, dwell_times = [], [], [], [], []
+    for zone in config["zones"]:
+        if "rect" in zone:
+            polygons.append(rectangle_vertices(*zone["rect"]))
+            rectangles.append(True)
+        elif "polygon" in zone:
+            polygons.append([tuple(vertex) for vertex in zone["polygon"]])
+            rectangles.append(False)
+        else:
+            raise ValueError(f"Zone {zone.get('name')} in {path} has neither a rect nor a polygon")
+        names.append(zone["name"])
+        colors.append(zone.get("color"))
+        dwell_times.append(zone.get("dwell", config.get("dwell", DEFAULT_DWELL_TIME)))
+    return ZoneMap(names, polygons, rectangles, colors, dwell_times)
+
+
+class ZoneMap:
+    """
+    Zones of the site with a uniform grid index over them.
+
+    Every grid cell lists the zones whose bounding box overlaps it, stored as
+    one flat array with per-cell offsets. Classifying points looks up each
+    point's cell, expands the candidate (point, zone) pairs with np.repeat,
+    and tests all pairs at once: a bounding box test, which is exact for
+    rectangles, then a vectorized crossing-number test over the padded edges
+    of the polygon candidates.
+    """
+
+    def __init__(self, names, polygons, rectangles=None, colors=None, dwell_times=None, cell_size=None):
+        """
+        Args:
+            names: Name of every zone
+            polygons: Vertices [(x, y), ...] of every zone in cm
+            rectangles: Whether each zone is an axis-aligned rectangle, defaults to False
+            colors: Optional drawing color of every zone
+            dwell_times: Dwell time of every zone in seconds, defaults to DEFAULT_DWELL_TIME
+            cell_size: Grid cell size in cm, defaults to the typical zone size
+        """
+        self.names = list(names)
+        self.num_zones = len(self.names)
+        self.colors = list(colors) if colors is not None else [None] * self.num_zones
+        self.rectangles = np.asarray(rectangles if rectangles is not None else [False] * self.num_zones, dtype=bool)
+        self.dwell_times = np.asarray(
+            dwell_times if dwell_times is not None else [DEFAULT_DWELL_TIME] * self.num_zones, dtype=float
+        )
+
+        # Vertices padded to the largest polygon by repeating the first vertex,
+        # which adds zero-length edges that never cross anything
+        self.vertex_counts = np.array([len(polygon) for polygon in polygons], dtype=np.int64)
+        max_vertices = int(self.vertex_counts.max()) if self.num_zones else 3
+        self.vertices = np.empty((self.num_zones, max_vertices, 2))
+        for i, polygon in enumerate(polygons):
+            polygon = np.asarray(polygon, dtype=float)
+            self.vertices[i, :len(polygon)] = polygon
+            self.vertices[i, len(polygon):] = polygon[0]
+        self.bounds_min = self.vertices.min(axis=1) if self.num_zones else np.zeros((0, 2))
+        self.bounds_max = self.vertices.max(axis=1) if self.num_zones else np.zeros((0, 2))
+        self._build_grid(cell_size)
+
+    def polygon(self, zone):
+        """
+        Returns:
+            Array (V, 2) with the vertices of a zone, without padding
+        """
+        return self.vertices[zone, :self.vertex_counts[zone]]
+
+    def _build_grid(self, cell_size):
+        if self.num_zones == 0:
+            self.origin = np.zeros(2)
+            self.cell_size = 1.0
+            self.grid_shape = np.array([1, 1])
+            self.cell_offsets = np.zeros(2, dtype=np.int64)
+            self.cell_zones = np.zeros(0, dtype=np.int32)
+            return
+
+        self.origin = self.bounds_min.min(axis=0)
+        extent = np.maximum(self.bounds_max.max(axis=0) - self.origin, 1e-9)
+        if cell_size is None:
+            sizes = self.bounds_max - self.bounds_min
+            cell_size = float(np.median(np.sqrt(np.maximum(sizes[:, 0] * sizes[:, 1], 1.0))))
+        cell_size = max(cell_size, float(extent.max()) / (MAX_GRID_CELLS - 1))
+        self.cell_size = cell_size
+        self.grid_shape = np.floor(extent / cell_size).astype(np.int64) + 1
+
+        # (cell, zone) pairs for every cell overlapped by a zone's bounding box
+        low = self._cells(self.bounds_min)
+        high = self._cells(self.bounds_max)
+        cells, zones = [], []
+        for zone in range(self.num_zones):
+            xs, ys = np.meshgrid(np.arange(low[zone, 0], high[zone, 0] + 1), np.arange(low[zone, 1], high[zone, 1] + 1))
+            zone_cells = (xs * self.grid_shape[1] + ys).ravel()
+            cells.append(zone_cells)
+            zones.append(np.full(len(zone_cells), zone, dtype=np.int32))
+        cells = np.concatenate(cells)
+        zones = np.concatenate(zones)
+        order = np.argsort(cells, kind="stable")
+        self.cell_zones = zones[order]
+        counts = np.bincount(cells, minlength=int(self.grid_shape.prod()))
+        self.cell_offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    def _cells(self, points):
+        return np.clip(np.floor((points - self.origin) / self.cell_size).astype(np.int64), 0, self.grid_shape - 1)
+
+    def classify(self, points):
+        """
+        Find the zones containing each point.
+
+        Args:
+            points: Array of shape (P, 2) or (P, 3) in cm, NaN rows are in no zone
+
+        Returns:
+            Tuple (point_indices, zone_indices) of every (point, zone) pair
+            where the point lies inside the zone
+        """
+        points = np.asarray(points, dtype=float)[:, :2]
+        # Candidate lookup only for points inside the grid's extent
+        grid_max = self.origin + self.grid_shape * self.cell_size
+        inside_grid = np.all((points >= self.origin) & (points < grid_max), axis=1)
+        point_ids = np.flatnonzero(inside_grid)
+        cells = self._cells(points[point_ids])
+        cells = cells[:, 0] * self.grid_shape[1] + cells[:, 1]
+
+        # Expand every point into its candidate zones
+        starts = self.cell_offsets[cells]
+        counts = self.cell_offsets[cells + 1] - starts
+        pair_points = np.repeat(point_ids, counts)
+        ranks = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        pair_zones = self.cell_zones[np.repeat(starts, counts) + ranks]
+
+        # Bounding boxes first, exact for rectangles
+        xy = points[pair_points]
+        inside = np.all((xy >= self.bounds_min[pair_zones]) & (xy <= self.bounds_max[pair_zones]), axis=1)
+        polygons = inside & ~self.rectangles[pair_zones]
+        if polygons.any():
+            inside[polygons] = self._crossing_test(xy[polygons], pair_zones[polygons])
+        return pair_points[inside], pair_zones[inside]
+
+    def _crossing_test(self, xy, zones):
+        """
+        Even-odd rule for (point, polygon) pairs, all edges of all pairs at once.
+        """
+        start = self.vertices[zones]
+        end = np.roll(start, -1, axis=1)
+        x = xy[:, 0, None]
+        y = xy[:, 1, None]
+        straddles = (start[:, :, 1] > y) != (end[:, :, 1] > y)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            crossing_x = start[:, :, 0] + (y - start[:, :, 1]) * (end[:, :, 0] - start[:, :, 0]) / (end[:, :, 1] - start[:, :, 1])
+        crossings = straddles & (x < crossing_x)
+        return np.count_nonzero(crossings, axis=1) % 2 == 1
+
+    def membership(self, points):
+        """
+        Returns:
+            Boolean array of shape (P, Z), True where point p is in zone z
+        """
+        inside = np.zeros((len(points), self.num_zones), dtype=bool)
+        inside[self.classify(points)] = True
+        return inside
+
+
+class ZoneTracker:
+    """
+    Enter, exit and dwell events of tags moving between zones.
+
+    The zones every tag is in are kept in a (T, Z) boolean array with the time
+    it entered each. Every update classifies all given fixes in one pass and
+    diffs the result against that state, so events for all tags and zones
+    come out of a few array operations.
+    """
+
+    def __init__(self, zone_map, tag_capacity=64):
+        """
+        Args:
+            zone_map: ZoneMap with the zones to watch
+            tag_capacity: Number of tag rows to preallocate
+        """
+        self.zone_map = zone_map
+        self.capacity = 0
+        self.events_emitted = 0
+        self.ensure_capacity(max(1, tag_capacity))
+
+    def ensure_capacity(self, num_tags):
+        """
+        Grow the per-tag arrays so they hold at least `num_tags` tags.
+        """
+        if num_tags <= self.capacity:
+            return
+        capacity = max(num_tags, 2 * self.capacity)
+        num_zones = self.zone_map.num_zones
+
+        def grow(name, shape, fill, dtype):
+            new = np.full(shape, fill, dtype=dtype)
+            old = getattr(self, name, None)
+            if old is not None:
+                new[:len(old)] = old
+            setattr(self, name, new)
+
+        grow("inside", (capacity, num_zones), False, bool)
+        grow("entered_at", (capacity, num_zones), np.nan, float)
+        grow("dwell_reported", (capacity, num_zones), False, bool)
+        self.capacity = capacity
+
+    def update(self, tag_indices, positions, times):
+        """
+        Classify new fixes and emit the resulting events.
+
+        A tag may appear more than once, its fixes are applied in order.
+
+        Args:
+            tag_indices: Tag rows of the fixes
+            positions: Array of shape (K, 2) or (K, 3) in cm
+            times: Time of every fix in seconds, or one time for all of them
+
+        Returns:
+            Structured array of EVENT_DTYPE, exits before enters, then dwells
+        """
+        tag_indices = np.asarray(tag_indices, dtype=np.int64)
+        positions = np.asarray(positions, dtype=float)
+        times = np.broadcast_to(np.asarray(times, dtype=float), tag_indices.shape)
+        if len(tag_indices) == 0:
+            return np.zeros(0, dtype=EVENT_DTYPE)
+        self.ensure_capacity(int(tag_indices.max()) + 1)
+
+        passes = unique_passes(tag_indices)
+        if len(passes) > 1:
+            return np.concatenate([self._update(tag_indices[rows], positions[rows], times[rows]) for rows in passes])
+        return self._update(tag_indices, positions, times)
+
+    def _update(self, tag_indices, positions, times):
+        """
+        Update for tags that each appear once.
+        """
+        now_inside = self.zone_map.membership(positions)
+        was_inside = self.inside[tag_indices]
+        entered_at = self.entered_at[tag_indices]
+        row_times = times[:, None]
+
+        exits = np.nonzero(was_inside & ~now_inside)
+        enters = np.nonzero(now_inside & ~was_inside)
+        durations = np.where(was_inside, row_times - entered_at, 0.0)
+        entered_at = np.where(now_inside & ~was_inside, row_times, np.where(now_inside, entered_at, np.nan))
+
+        # Dwell is reported once per stay
+        reported = self.dwell_reported[tag_indices] & now_inside
+        stayed = np.where(now_inside, row_times - entered_at, 0.0)
+        dwells = np.nonzero(now_inside & ~reported & (stayed >= self.zone_map.dwell_times[None, :]))
+        reported[dwells] = True
+
+        self.inside[tag_indices] = now_inside
+        self.entered_at[tag_indices] = entered_at
+        self.dwell_reported[tag_indices] = reported
+
+        events = np.zeros(len(exits[0]) + len(enters[0]) + len(dwells[0]), dtype=EVENT_DTYPE)
+        offset = 0
+        for kind, (rows, zones), duration in (
+            (EXIT, exits, durations), (ENTER, enters, None), (DWELL, dwells, stayed)
+        ):
+            block = events[offset:offset + len(rows)]
+            block["tag"] = tag_indices[rows]
+            block["zone"] = zones
+            block["kind"] = kind
+            block["time"] = times[rows]
+            block["duration"] = 0.0 if duration is None else duration[rows, zones]
+            offset += len(rows)
+        self.events_emitted += len(events)
+        return events
+
+    def occupants(self, zone):
+        """
+        Returns:
+            Tag rows currently inside a zone
+        """
+        return np.flatnonzero(self.inside[:, zone])
+
+    def describe(self, event, tag_address=None):
+        """
+        Human-readable description of one event.
+        """
+        tag = event["tag"] if tag_address is None else tag_address
+        text = f"Tag {tag} {EVENT_NAMES[event['kind']]} {self.zone_map.names[event['zone']]}"
+        if event["kind"] != ENTER:
+            text += f" after {event['duration']:.1f} s"
+        return text
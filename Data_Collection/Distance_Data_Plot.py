@@ -1,39 +1,14 @@
+import os
+
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 
-# Data from the inputs, organized by distance marker
-data = {
-    "1m": [133, 118, 130, 113, 123, 127, 143, 140],
-    "2m": [230, 214, 236, 232, 221, 219, 237, 206],
-    "3m": [378, 387, 350, 341, 387, 395],
-    "4m": [448, 367, 441, 435, 452, 431, 477],
-    "5m": [562, 616, 650, 602, 625, 603, 553],
-    "6m": [651, 649, 650, 630, 632, 702, 629, 637],
-    "7m": [800, 836, 797, 817, 831, 801, 811, 845],
-    "8m": [890, 931, 926, 846, 922, 843, 845, 855, 876],
-    "9m": [1052, 1054, 1041, 1047, 1045, 1056, 1023, 1024, 1024],
-    "10m": [1110, 1141, 1131, 1107, 1119, 1111, 1111, 1116],
-    "11m": [1228, 1212, 12215, 1211, 1244, 1217, 1214, 1200],  # Note: 12215 might be a typo
-    "12m": [1300, 1319, 1285, 1291, 1294, 1298, 1289, 1318],
-    "13m": [1405, 1412, 1404, 1406, 1403, 1409, 1411, 1403, 1405, 1412],
-    "14m": [1515, 1516, 1504, 1509, 1551, 1510, 1538, 1550, 1523, 1526, 1482],
-    "15m": [1485, 1582, 1610, 1617, 1484, 1589, 1605, 1581, 1596, 1607],
-    "16m": [1658, 1684, 1673, 1670, 1684, 1688, 1699, 1690],
-    "17m": [1807, 1831, 1842, 1828, 1830, 1814, 1828, 1798],
-    "18m": [1931, 1928, 1913, 1909, 1918, 1975, 1980, 1920],
-    "19m": [2019, 2059, 2053, 2033, 2022, 2024, 2031, 2059],
-    "20m": [2108, 2149, 2135, 2111],
-    "21m": [2266, 2289, 2206],
-    "22m": [2311, 2287, 2292],
-    "23m": [2413, 2422, 2374],
-    "24m": [2475, 2476, 2477, 2472],
-    "25m": [2602, 2632, 2612, 2627, 2622],
-    "26m": [2749, 2681, 2652, 2687, 2702, 2716],
-    "27m": [2773, 2801, 2726, 2783],
-    "28m": [2803, 2905, 2899, 2903, 2855],
-    "29m": [2817, 2979, 2970, 2950, 2991]
-}
+# Data from the inputs, organized by distance marker. The raw readings live in
+# distance_measurements.csv (distance marker in m, measured value in cm) so the
+# client's simulator and calibration can use the same data.
+measurements = pd.read_csv(os.path.join(os.path.dirname(os.path.abspath(__file__)), "distance_measurements.csv"))
+data = {f"{distance}m": group["measured_cm"].tolist() for distance, group in measurements.groupby("distance_m")}
 
 # Check for and fix the potential typo in the 11m data
 if 12215 in data["11m"]: